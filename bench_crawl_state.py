@@ -0,0 +1,111 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import tracemalloc
+
+from crawler.engine import FrontierEntry
+from fingerprints import BloomFilter, FingerprintSet
+
+# The history of the measures
+RESULTS_FILE = "./logs/crawl_state.jsonl"
+
+
+# Urls shaped like the links of the supplier pages
+def sample_urls(count):
+	return [
+	    f"https://www.supplier{i % 50}.com/products/safety-data-sheets/{i}/msds-{i}-en.pdf?lang=en&region=eu"
+	    for i in range(count)
+	]
+
+
+# Memory allocated by a function, in bytes
+def allocated(build):
+	tracemalloc.start()
+	try:
+		before = tracemalloc.get_traced_memory()[0]
+		kept = build()
+		after = tracemalloc.get_traced_memory()[0]
+	finally:
+		tracemalloc.stop()
+	del kept
+	return after - before
+
+
+# Measure the crawl state
+def measure(count):
+	"""
+	Params:
+			count (int): The number of urls.
+
+	Returns:
+			dict: The bytes per url of each structure, the url strings excluded
+			(they are shared with the pages that link them).
+	"""
+	urls = sample_urls(count)
+	visited_strings = allocated(lambda: set(urls))
+	visited_fingerprints = allocated(lambda: _fill(FingerprintSet(), urls))
+	bloom = allocated(lambda: _fill(BloomFilter(count), urls))
+	# the per link state of the previous recursive crawl: a dict of the crawl parameters
+	link_dicts = allocated(lambda: [{
+	    "downloaded_files_count": 0,
+	    "download_limit": 5,
+	    "url_visit_count": None,
+	    "domain_visit_count": None,
+	    "max_url_visits": 5,
+	    "max_domain_visits": 10,
+	    "report_list": None,
+	} for _ in urls])
+	frontier_entries = allocated(lambda: [FrontierEntry(url, 2) for url in urls])
+	# strings of a set are kept by the set, the other structures only keep their hash
+	string_bytes = sum(sys.getsizeof(url) for url in urls)
+	return {
+	    "urls": count,
+	    "visited_set_of_strings": round((visited_strings + string_bytes) / count, 1),
+	    "visited_fingerprint_set": round(visited_fingerprints / count, 1),
+	    "bloom_filter_1pct": round(bloom / count, 1),
+	    "per_link_dict": round(link_dicts / count, 1),
+	    "per_link_frontier_entry": round(frontier_entries / count, 1),
+	}
+
+
+def _fill(structure, urls):
+	for url in urls:
+		structure.add(url)
+	return structure
+
+
+def _git_commit():
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+		                      capture_output=True,
+		                      text=True).stdout.strip() or None
+	except OSError:
+		return None
+
+
+# Benchmark the memory of the crawl state
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Measure the memory per url of the crawl state.")
+	parser.add_argument("--urls", nargs="*", type=int, default=[10000, 100000],
+	                    help="The numbers of urls to measure.")
+	parser.add_argument("--no-save", action="store_true",
+	                    help=f"Do not append the results to {RESULTS_FILE}.")
+	args = parser.parse_args()
+
+	results = [measure(count) for count in args.urls]
+	for result in results:
+		print(result)
+
+	if not args.no_save:
+		os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+		with open(RESULTS_FILE, "a") as f:
+			f.write(json.dumps({
+			    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+			    "commit": _git_commit(),
+			    "python": sys.version.split()[0],
+			    "results": results,
+			}) + "\n")
+		print(f"Results appended to {RESULTS_FILE}")
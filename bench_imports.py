@@ -0,0 +1,76 @@
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+# Modules measured by default: the entry points and the heavy libraries they load on first use
+MODULES = ["main", "worker", "scout", "scout_excel", "fitz", "pandas", "bs4", "googlesearch"]
+# The history of the measures
+RESULTS_FILE = "./logs/import_times.jsonl"
+
+
+# Import time of a module in a fresh interpreter
+def measure(module):
+	"""
+	Params:
+			module (str): The module to import.
+
+	Returns:
+			dict: The cumulative import time of the module reported by -X importtime
+			and the wall time of the interpreter, in milliseconds.
+	"""
+	started = time.perf_counter()
+	process = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+	                         capture_output=True,
+	                         text=True)
+	wall = (time.perf_counter() - started) * 1000
+	if process.returncode != 0:
+		return {"error": process.stderr.strip().splitlines()[-1]}
+
+	cumulative = None
+	for line in process.stderr.splitlines():
+		# import time: self [us] | cumulative | imported package
+		parts = line.split("|")
+		if len(parts) == 3 and parts[2].strip() == module:
+			cumulative = int(parts[1].strip()) / 1000
+	return {"import_ms": cumulative, "wall_ms": round(wall, 1)}
+
+
+def _git_commit():
+	try:
+		return subprocess.run(["git", "rev-parse", "--short", "HEAD"],
+		                      capture_output=True,
+		                      text=True).stdout.strip() or None
+	except OSError:
+		return None
+
+
+# Benchmark the import times
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Measure the import time of the scout modules.")
+	parser.add_argument("--modules", nargs="*", default=MODULES, help="The modules to measure.")
+	parser.add_argument("--repeat", type=int, default=3,
+	                    help="The number of runs per module, the fastest is kept.")
+	parser.add_argument("--no-save", action="store_true",
+	                    help=f"Do not append the results to {RESULTS_FILE}.")
+	args = parser.parse_args()
+
+	results = {}
+	for module in args.modules:
+		runs = [measure(module) for _ in range(args.repeat)]
+		runs = [run for run in runs if "error" not in run] or runs[:1]
+		results[module] = min(runs, key=lambda run: run.get("wall_ms", 0))
+		print(f"{module:<15} {results[module]}")
+
+	if not args.no_save:
+		os.makedirs(os.path.dirname(RESULTS_FILE), exist_ok=True)
+		with open(RESULTS_FILE, "a") as f:
+			f.write(json.dumps({
+			    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+			    "commit": _git_commit(),
+			    "python": sys.version.split()[0],
+			    "results": results,
+			}) + "\n")
+		print(f"Results appended to {RESULTS_FILE}")
@@ -0,0 +1,24 @@
+"""
+The crawl engine shared by the single lookups (scout.py), the excel files
+(scout_excel.py) and the batches (scout_batch.py).
+
+A crawl chains the stages search -> discover -> probe -> fetch -> verify -> store
+(see stages.py). What differs between the modes (timeouts, skipped urls, limits,
+how the pdfs are stored) is a ModePolicy, and the caching and instrumentation are
+hooks wrapping the stages (see hooks.py).
+"""
+from crawler.engine import Crawl, Query, run
+from crawler.hooks import HOOKS, STAGES, STATS
+from crawler.policy import ModePolicy
+from crawler.verify import SDS_PATTERN, MultiMatcher
+
+__all__ = ["Crawl", "Query", "run", "HOOKS", "STAGES", "STATS", "ModePolicy", "SDS_PATTERN", "MultiMatcher"]
+
+
+# Stats
+def stats():
+	"""
+	Returns:
+			dict: The calls, errors and time spent in each stage by this process.
+	"""
+	return STATS.snapshot()
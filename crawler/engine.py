@@ -0,0 +1,278 @@
+import os
+import shutil
+import uuid
+from urllib.parse import urlparse
+
+import discovery
+import domain_stats
+import negative_cache
+import normalize
+from crawler import stages
+from fingerprints import FingerprintSet, fingerprint
+from crawler.hooks import HOOKS
+from crawler.verify import SDS_PATTERN, MultiMatcher
+
+
+class Query:
+	"""
+	A query of a crawl (a single lookup, a row of an excel file or an entry of /scout/batch).
+
+	Params:
+			id (str, optional): The id of the query (eg. the serial no of the row).
+			cas (str, optional): The CAS number.
+			name (str, optional): The Element name.
+			row (int, optional): The index of the row in its excel file.
+	"""
+
+	__slots__ = ("id", "cas", "name", "row", "key", "term", "downloads", "results")
+
+	def __init__(self, id=None, cas=None, name=None, row=None):
+		self.id = id
+		self.row = row
+		self.cas = cas or None
+		self.name = name or None
+		self.downloads = 0
+		self.results = []
+		try:
+			cas, name = normalize.normalize_query(cas, name)
+		except normalize.InvalidQuery as e:
+			print(f"Skipping query {id}: {e}")
+			self.term = self.key = ""
+			return
+		# a pdf verifies a query if it contains its CAS number, or its name if there is no CAS
+		self.term = cas or name
+		# equivalent queries share the same key (see normalize.canonical_key)
+		self.key = normalize.canonical_key(cas, name)
+
+	def to_dict(self):
+		return {
+		    "id": self.id,
+		    "cas": self.cas,
+		    "name": self.name,
+		    "downloads": self.downloads,
+		    "results": self.results,
+		}
+
+
+class FrontierEntry:
+	"""
+	A url waiting to be crawled, at `depth` levels from the end of the crawl.
+	"""
+
+	__slots__ = ("url", "depth")
+
+	def __init__(self, url, depth):
+		self.url = url
+		self.depth = depth
+
+
+# Hard link (or copy) a file under a new temporary name
+def _stage_copy(file_path):
+	folder, file_name = os.path.split(file_path)
+	staged = os.path.join(folder, uuid.uuid4().hex[:8] + "_" + file_name)
+	try:
+		os.link(file_path, staged)
+	except OSError:
+		shutil.copyfile(file_path, staged)
+	return staged
+
+
+class Crawl:
+	"""
+	One crawl serving many queries: every page and pdf is fetched and parsed once,
+	and the text of every pdf is matched against all the outstanding queries.
+	The stages (search, discover, probe, fetch, verify, store) run through HOOKS.
+
+	Params:
+			session (aiohttp.ClientSession): The session to use for making an async http request.
+			queries (list): The Query of the crawl.
+			policy (ModePolicy): The limits of the crawl and how the pdfs are stored.
+			checkpoint (callable, optional): Called with a query each time a pdf is stored for it.
+	"""
+
+	def __init__(self, session, queries, policy, checkpoint=None):
+		self.session = session
+		self.queries = queries
+		self.policy = policy
+		self.checkpoint = checkpoint
+		# the urls visited by the crawl, as 64-bit fingerprints of their canonical form
+		self.visited = FingerprintSet()
+		# the depth the pages were visited at, by fingerprint: a page reached at a lower
+		# depth (eg. a search result linked from an earlier root) is crawled again deeper
+		self.page_depths = {}
+		# the max visits of the domains limited for the root being crawled, {domain: visits}
+		self.domain_limits = {}
+		self.outstanding = {}
+		for query in queries:
+			# the queries resumed from a checkpoint may have reached their limit already
+			if query.key and query.downloads < policy.download_limit:
+				self.outstanding.setdefault(query.key, []).append(query)
+		self._build_matcher()
+
+	def _build_matcher(self):
+		self.matcher = MultiMatcher([queries[0] for queries in self.outstanding.values()],
+		                            similar=self.policy.similar)
+
+	async def search(self, max_search_results):
+		"""
+		Search every outstanding query.
+
+		Returns:
+				dict: {root url: set of query keys}, in search order.
+		"""
+		roots = {}
+		for key, queries in list(self.outstanding.items()):
+			for url in await HOOKS.run("search", stages.search, queries[0].term, max_search_results):
+				roots.setdefault(url, set()).add(key)
+		return roots
+
+	async def run(self, max_search_results=None):
+		"""
+		Search and crawl until every query reached its download limit or every root is crawled.
+
+		Returns:
+				list: The Query of the crawl, with their downloads and results.
+		"""
+		roots = await self.search(max_search_results or self.policy.max_search_results)
+		# Order the results by the expected yield of their domain
+		for root in domain_stats.rank(roots):
+			# crawl a root while one of the queries it was found for is outstanding
+			if not roots[root] & self.outstanding.keys():
+				continue
+			# Visit less of the domains without any yield so far, or skip them
+			visits = domain_stats.crawl_visits(root, self.policy.max_domain_visits)
+			if not visits:
+				print(f"Skipping {root}, its domain never yielded a MSDS")
+				continue
+			self.domain_limits = {domain_stats.domain_of(root): visits}
+			domain_stats.record_crawl(root)
+			try:
+				# look for the pdfs listed by the sitemaps of the domain first
+				domain_count = {}
+				terms = [self.outstanding[key][0].term for key in roots[root] if key in self.outstanding]
+				for candidate in await HOOKS.run("discover", stages.discover, self.session, root, terms):
+					await self.crawl(candidate, 1, root, domain_count)
+				await self.crawl(root, self.policy.depth, root, domain_count)
+			except Exception as e:
+				print(f"An error occurred while processing URL {root}: {e}")
+			if not self.outstanding:
+				break
+		domain_stats.flush()
+		return self.queries
+
+	async def crawl(self, url, depth, root, domain_count):
+		"""
+		Crawl a url depth first, a page at the last level is not fetched (only pdfs are).
+		"""
+		frontier = [FrontierEntry(url, depth)]
+		while frontier and self.outstanding:
+			entry = frontier.pop()
+			links = await self.visit(entry.url, entry.depth, root, domain_count)
+			# the links are pushed in reverse, so that they are crawled in page order
+			frontier.extend(
+			    FrontierEntry(link, entry.depth - 1) for link in reversed(links)
+			    if not self.was_visited(link, entry.depth - 1))
+
+	def was_visited(self, url, depth):
+		"""
+		Returns:
+				bool: Whether the url was visited at this depth or deeper (a pdf or a skipped url at any depth).
+		"""
+		if url not in self.visited:
+			return False
+		return self.page_depths.get(fingerprint(url), depth) >= depth
+
+	async def visit(self, url, depth, root, domain_count):
+		"""
+		Returns:
+				list: The links of the url if it is a page to expand, else an empty list.
+		"""
+		if depth <= 0 or self.was_visited(url, depth):
+			return []
+		netloc = urlparse(url).netloc
+		max_visits = self.domain_limits.get(domain_stats.domain_of(url), self.policy.max_domain_visits)
+		if domain_count.get(netloc, 0) >= max_visits:
+			# not marked visited, the visits of a domain are counted per root
+			print(f"Skipped: {url}, domain {netloc} visited {max_visits} times")
+			return []
+		self.visited.add(url)
+		if self.policy.skips(url):
+			print(f"Skipped: {url}")
+			return []
+		# Respect the robots.txt of the discovered domains
+		if not discovery.allowed(url):
+			print(f"Skipped: {url}, disallowed by robots.txt")
+			return []
+
+		kind = await HOOKS.run("probe", stages.probe, self.session, url, self.policy,
+		                       tuple(self.outstanding))
+		if kind == "page":
+			self.page_depths[fingerprint(url)] = depth
+		if kind is None or (kind == "page" and depth == 1):
+			return []
+		domain_count[netloc] = domain_count.get(netloc, 0) + 1
+
+		if kind == "pdf":
+			file_path = await HOOKS.run("fetch", stages.fetch_pdf, self.session, url, self.policy)
+			if file_path:
+				await self.match_pdf(url, file_path, root)
+			return []
+		return await HOOKS.run("fetch", stages.fetch_links, self.session, url, self.policy)
+
+	async def match_pdf(self, url, file_path, root):
+		"""
+		Match a downloaded pdf against every outstanding query and store it for the matched ones.
+		"""
+		try:
+			text, matches = await HOOKS.run("verify", stages.verify, self.matcher, file_path)
+			provider = urlparse(root).netloc
+			domain_stats.record_pdf(root, "same" if "same" in matches.values() else
+			                        "similar" if matches else False)
+
+			if not matches:
+				print(f"Verification status: {file_path} is not a MSDS of the query")
+				# a failed extraction says nothing about the pdf, it is only skipped for a while
+				is_sds = bool(SDS_PATTERN.search(text)) if text and text.strip() else None
+				for key in self.outstanding:
+					negative_cache.record_rejection(url, key, is_sds)
+					if not is_sds:
+						break
+
+			done = False
+			for key, status in matches.items():
+				print(f"Verification status: {file_path} matches {key} ({status})")
+				if status == "same":
+					# learn the name <-> CAS synonyms
+					normalize.learn(text, self.outstanding[key][0].cas, self.outstanding[key][0].name)
+				for query in self.outstanding[key]:
+					staged = _stage_copy(file_path)
+					if await HOOKS.run("store", stages.store, self.policy, query, staged, status, provider,
+					                  url):
+						query.downloads += 1
+						if self.checkpoint:
+							self.checkpoint(query)
+					elif os.path.exists(staged):
+						os.remove(staged)
+				if min(query.downloads for query in self.outstanding[key]) >= self.policy.download_limit:
+					del self.outstanding[key]
+					done = True
+			if done:
+				self._build_matcher()
+		finally:
+			os.remove(file_path)
+
+
+# Crawl for some queries
+async def run(session, queries, policy, max_search_results=None, checkpoint=None):
+	"""
+	Params:
+			session (aiohttp.ClientSession): The session to use for making an async http request.
+			queries (list): The Query of the crawl, a single lookup is a crawl of one query.
+			policy (ModePolicy): The policy of the mode (see scout.POLICY and scout_excel.POLICY).
+			max_search_results (int, optional): The number of search results per query. Defaults to the one of the policy.
+			checkpoint (callable, optional): Called with a query each time a pdf is stored for it.
+
+	Returns:
+			list: The queries, with their downloads and results.
+	"""
+	return await Crawl(session, queries, policy, checkpoint).run(max_search_results)
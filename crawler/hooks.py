@@ -0,0 +1,107 @@
+import asyncio
+import time
+from collections import defaultdict
+from functools import partial
+
+import negative_cache
+
+# The stages of the crawl pipeline
+STAGES = ("search", "discover", "probe", "fetch", "verify", "store")
+
+
+class Hooks:
+	"""
+	The hooks of the crawl stages. A hook wraps a stage, it is called with the
+	next callable of the chain followed by the arguments of the stage, and returns
+	the result of the stage:
+
+		async def hook(call, *args):
+			... before
+			result = await call(*args)
+			... after
+			return result
+
+	A hook can also return without calling the stage (eg. to serve a cached result).
+	"""
+
+	def __init__(self):
+		self.hooks = {stage: [] for stage in STAGES}
+
+	def register(self, stage, hook):
+		"""
+		Params:
+				stage (str): One of STAGES.
+				hook (callable): The async hook, the first registered hook runs first.
+		"""
+		if stage not in self.hooks:
+			raise ValueError(f"Unknown crawl stage {stage}, expected one of {', '.join(STAGES)}")
+		self.hooks[stage].append(hook)
+
+	def unregister(self, stage, hook):
+		self.hooks[stage].remove(hook)
+
+	async def run(self, stage, func, *args):
+		"""
+		Run a stage through its hooks.
+		"""
+		call = func
+		for hook in reversed(self.hooks[stage]):
+			call = partial(hook, call)
+		return await call(*args)
+
+
+class StageStats:
+	"""
+	Instrumentation hook: the calls, errors and time spent in each stage.
+	"""
+
+	def __init__(self):
+		self.calls = defaultdict(int)
+		self.errors = defaultdict(int)
+		self.seconds = defaultdict(float)
+
+	def hook(self, stage):
+
+		async def timed(call, *args):
+			started = time.monotonic()
+			try:
+				return await call(*args)
+			except Exception:
+				self.errors[stage] += 1
+				raise
+			finally:
+				self.calls[stage] += 1
+				self.seconds[stage] += time.monotonic() - started
+
+		return timed
+
+	def snapshot(self):
+		return {
+		    stage: {
+		        "calls": self.calls[stage],
+		        "errors": self.errors[stage],
+		        "seconds": round(self.seconds[stage], 3),
+		        "mean": round(self.seconds[stage] / self.calls[stage], 4) if self.calls[stage] else None,
+		    }
+		    for stage in STAGES
+		}
+
+
+# Skip the urls known as junk (dead, not a pdf, rejected pdf ...) before probing them
+async def skip_known_junk(call, session, url, policy, scopes=()):
+	# a pdf rejected for every outstanding query is skipped as well
+	# (the lookups may read the database, they run off the event loop)
+	outcomes = await asyncio.to_thread(
+	    lambda: [negative_cache.lookup(url, scope) for scope in scopes] or [negative_cache.lookup(url)])
+	if all(outcomes):
+		print(f"Skipping {url}, known as {outcomes[0]}")
+		return None
+	return await call(session, url, policy, scopes)
+
+
+# The hooks of the process
+HOOKS = Hooks()
+STATS = StageStats()
+for _stage in STAGES:
+	HOOKS.register(_stage, STATS.hook(_stage))
+HOOKS.register("probe", skip_known_junk)
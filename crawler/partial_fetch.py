@@ -0,0 +1,506 @@
+import os
+import re
+import zlib
+from collections import Counter
+
+from crawler.verify import SDS_PATTERN
+from fetch import fetch
+
+# Partial fetch of the pdfs with Range requests (0 disables it)
+ENABLED = os.environ.get("SCOUT_PARTIAL_FETCH", "1") != "0"
+# Leading bytes requested first, most MSDS are smaller
+LEAD_BYTES = int(os.environ.get("SCOUT_PARTIAL_LEAD_BYTES", 64 * 1024))
+# Bytes requested at once from the end of the file, for the cross-reference tables
+TAIL_BYTES = 16 * 1024
+# Max bytes fetched to build the first pages, the pdf is downloaded whole past it
+MAX_PARTIAL_BYTES = int(os.environ.get("SCOUT_PARTIAL_MAX_BYTES", 1024 * 1024))
+# Objects bigger than this (images, embedded files) are not fetched
+MAX_OBJECT_BYTES = 256 * 1024
+# Ranges closer than this are fetched with a single request
+MERGE_GAP = 8 * 1024
+# Max objects followed from the catalog to the first pages
+MAX_OBJECTS = 300
+# Pages checked before rejecting a pdf, the ones the verification reads (see stages.extract_text),
+# so a cover page or a table of contents does not hide the safety data sheet
+MATCH_PAGES = 5
+# First pages with less text than this (eg. scans) are never rejected
+MIN_TEXT = 200
+
+# Outcomes of fetch_pdf
+WRITTEN = "written"  # the whole pdf is written to the file
+NOT_PDF = "not_pdf"  # not served as a pdf
+NOT_SDS = "not_sds"  # the first pages are not the ones of a safety data sheet
+UNSUPPORTED = "unsupported"  # no Range support or an unusual pdf, download it whole
+
+# Values not followed from the catalog to the first pages (only the page tree, the
+# resources and the contents of the first pages are needed to extract their text)
+SKIPPED_KEYS = ("Parent", "Outlines", "Names", "Dests", "AcroForm", "StructTreeRoot", "Metadata",
+                "Threads", "OpenAction", "AA", "PageLabels", "Annots", "Thumb", "B", "PieceInfo",
+                "FontFile", "FontFile2", "FontFile3", "CIDSet")
+_SKIPPED = re.compile(r"/(?:%s)(?![\w.])\s*(?:\[[^\]]*\]|\d+\s+\d+\s+R)" % "|".join(SKIPPED_KEYS))
+_KIDS_TEXT = re.compile(r"/Kids\s*\[([^\]]*)\]")
+_REF = re.compile(r"(\d+)\s+\d+\s+R\b")
+_CONTENT_RANGE = re.compile(r"bytes\s+(\d+)-(\d+)/(\d+)")
+_OBJ = re.compile(rb"\d+\s+\d+\s+obj\b")
+_KIDS = re.compile(rb"/Kids\s*\[([^\]]*)\]")
+_KID = re.compile(rb"\d+\s+\d+\s+R")
+_COUNT = re.compile(rb"/Count\s+\d+")
+
+# Outcomes and bytes of the process, see stats()
+STATS = Counter()
+
+
+class _Unsupported(Exception):
+	pass
+
+
+def _accept_pdf(headers):
+	return headers.get("content-type", "").startswith("application/pdf")
+
+
+def _int(key, text, default=None):
+	match = re.search(rf"/{key}\s+(\d+)", text)
+	return int(match.group(1)) if match else default
+
+
+# Dictionary of an object, without its stream
+def _dict_text(raw):
+	return re.split(r"\bstream\b", raw.decode("latin-1"), maxsplit=1)[0]
+
+
+# Decoded stream of an object
+def _stream(raw):
+	head, sep, data = raw.partition(b"stream")
+	if not sep:
+		raise _Unsupported("no stream")
+	data = data[2:] if data.startswith(b"\r\n") else data[1:]
+	text = head.decode("latin-1")
+	length = _int("Length", re.sub(r"/Length\s+\d+\s+\d+\s+R", "", text))
+	data = data[:length] if length is not None else data[:data.rfind(b"endstream")]
+	filters = re.findall(r"/(\w+Decode)\b", text)
+	if filters != ["FlateDecode"]:
+		raise _Unsupported(f"stream filters {filters}")
+	data = zlib.decompress(data)
+	predictor = _int("Predictor", text, 1)
+	if predictor >= 10:
+		data = _png_unpredict(data, _int("Columns", text, 1))
+	elif predictor != 1:
+		raise _Unsupported(f"predictor {predictor}")
+	return data
+
+
+# Undo the png predictors of a stream
+def _png_unpredict(data, columns):
+	rows, previous = [], bytearray(columns)
+	for start in range(0, len(data), columns + 1):
+		kind, row = data[start], bytearray(data[start + 1:start + 1 + columns])
+		for i in range(len(row)):
+			left = row[i - 1] if i else 0
+			up = previous[i]
+			if kind == 1:
+				row[i] = (row[i] + left) & 0xFF
+			elif kind == 2:
+				row[i] = (row[i] + up) & 0xFF
+			elif kind == 3:
+				row[i] = (row[i] + (left + up) // 2) & 0xFF
+			elif kind == 4:
+				upper_left = previous[i - 1] if i else 0
+				p = left + up - upper_left
+				pa, pb, pc = abs(p - left), abs(p - up), abs(p - upper_left)
+				row[i] = (row[i] + (left if pa <= pb and pa <= pc else up if pb <= pc else upper_left)) & 0xFF
+		rows.append(bytes(row))
+		previous = row
+	return b"".join(rows)
+
+
+class PartialPdf:
+	"""
+	The bytes of a pdf fetched so far, by ranges.
+
+	Params:
+			session (aiohttp.ClientSession): The session to use for making an async http request.
+			url (str): The url of the pdf.
+			policy (fetch.RetryPolicy): The retries and timeouts of the requests.
+	"""
+
+	def __init__(self, session, url, policy):
+		self.session = session
+		self.url = url
+		self.policy = policy
+		self.total = None
+		self.validator = None
+		self.chunks = {}  # {start: bytes}
+		self.fetched = 0
+
+	async def get(self, start, end=None):
+		"""
+		Request the bytes [start, end) of the pdf (to the end of the file if end is None).
+
+		Returns:
+				fetch.FetchResult: The response, its status is 200 if the server ignored the range.
+		"""
+		headers = {"Range": f"bytes={start}-{'' if end is None else end - 1}"}
+		if self.validator:
+			# the whole (new) file is served if it changed since the first request
+			headers["If-Range"] = self.validator
+		result = await fetch(self.session, self.url, policy=self.policy, accept=_accept_pdf, headers=headers)
+		self.fetched += len(result.body or b"")
+		return result
+
+	def covered(self, start, end):
+		return any(offset <= start and end <= offset + len(data) for offset, data in self.chunks.items())
+
+	def read(self, start, end):
+		for offset, data in self.chunks.items():
+			if offset <= start and end <= offset + len(data):
+				return data[start - offset:end - offset]
+		return None
+
+	async def ensure(self, ranges):
+		"""
+		Fetch the missing ranges, the close ones with a single request.
+		"""
+		ranges = [(max(0, start), min(end, self.total)) for start, end in ranges]
+		missing = sorted((start, end) for start, end in ranges if start < end and not self.covered(start, end))
+		merged = []
+		for start, end in missing:
+			if merged and start - merged[-1][1] <= MERGE_GAP:
+				merged[-1][1] = max(merged[-1][1], end)
+			else:
+				merged.append([start, end])
+		for start, end in merged:
+			if self.fetched + end - start > MAX_PARTIAL_BYTES:
+				raise _Unsupported("too many bytes for the first pages")
+			result = await self.get(start, end)
+			match = _CONTENT_RANGE.match(result.headers.get("content-range", ""))
+			if result.status != 206 or result.body is None or not match or int(match.group(1)) != start:
+				raise _Unsupported("range not served")
+			self.chunks[start] = result.body
+
+	async def read_object(self, start, limit):
+		"""
+		Returns:
+				bytes: The bytes of the object starting at `start` (an object or xref table), up to `limit` bytes.
+		"""
+		size = min(TAIL_BYTES, limit)
+		while True:
+			await self.ensure([(start, start + size)])
+			raw = self.read(start, min(start + size, self.total))
+			end = raw.find(b"endobj") if not raw.lstrip().startswith(b"xref") else raw.find(b"startxref")
+			if end >= 0 or size >= limit or start + size >= self.total:
+				return raw
+			size = min(size * 4, limit)
+
+	def patch(self, start, end, func):
+		"""
+		Replace the bytes [start, end) of the fetched ranges with func(bytes), of the same length.
+		"""
+		for offset, data in self.chunks.items():
+			if offset <= start and end <= offset + len(data):
+				patched = func(data[start - offset:end - offset])
+				if len(patched) == end - start:
+					self.chunks[offset] = data[:start - offset] + patched + data[end - offset:]
+				return
+
+	def write(self, file_path):
+		"""
+		Write the fetched ranges to a file of the size of the pdf, the missing bytes are zeros.
+		"""
+		with open(file_path, "wb") as f:
+			f.truncate(self.total)
+			for offset, data in self.chunks.items():
+				f.seek(offset)
+				f.write(data)
+
+
+class _FirstPages:
+	"""
+	Fetch the objects needed to extract the text of the first MATCH_PAGES pages: the
+	cross-reference sections from the end of the file, then the objects from the catalog
+	down to the first pages, their resources and contents.
+	"""
+
+	def __init__(self, pdf):
+		self.pdf = pdf
+		self.entries = {}  # {object number: ("offset", offset) or ("stream", stream number, index)}
+		self.offsets = []  # start offsets of the objects and xref sections, to bound the objects
+		self.object_streams = {}
+		self.root = None
+
+	async def load_xref(self):
+		pdf = self.pdf
+		await pdf.ensure([(pdf.total - TAIL_BYTES, pdf.total)])
+		tail = pdf.read(max(0, pdf.total - TAIL_BYTES), pdf.total)
+		matches = re.findall(rb"startxref\s+(\d+)", tail)
+		if not matches:
+			raise _Unsupported("no startxref")
+		offset, seen = int(matches[-1]), set()
+		while offset is not None and offset not in seen and len(seen) < 20:
+			seen.add(offset)
+			self.offsets.append(offset)
+			raw = await pdf.read_object(offset, MAX_PARTIAL_BYTES)
+			if raw.lstrip().startswith(b"xref"):
+				trailer = self._parse_table(raw)
+			elif _OBJ.match(raw.lstrip()):
+				trailer = self._parse_stream(raw)
+			else:
+				raise _Unsupported("bad startxref")
+			self.root = self.root or _int("Root", trailer)
+			offset = _int("Prev", trailer)
+		if not self.root:
+			raise _Unsupported("no catalog")
+		self.offsets.append(pdf.total)
+		self.offsets.sort()
+
+	def _add(self, number, entry):
+		# the newest section is read first
+		self.entries.setdefault(number, entry)
+		if entry[0] == "offset":
+			self.offsets.append(entry[1])
+
+	def _parse_table(self, raw):
+		text = raw.decode("latin-1")
+		table, _, trailer = text.partition("trailer")
+		tokens = table.split()[1:]
+		i = 0
+		while i + 1 < len(tokens):
+			first, count = int(tokens[i]), int(tokens[i + 1])
+			i += 2
+			for number in range(first, first + count):
+				offset, state = tokens[i], tokens[i + 2]
+				i += 3
+				if state == "n":
+					self._add(number, ("offset", int(offset)))
+		return trailer.split("startxref")[0]
+
+	def _parse_stream(self, raw):
+		text = _dict_text(raw)
+		widths = [int(w) for w in re.search(r"/W\s*\[([^\]]*)\]", text).group(1).split()]
+		index = re.search(r"/Index\s*\[([^\]]*)\]", text)
+		index = [int(n) for n in index.group(1).split()] if index else [0, _int("Size", text)]
+		data, size, position = _stream(raw), sum(widths), 0
+		for first, count in zip(index[::2], index[1::2]):
+			for number in range(first, first + count):
+				fields, start = [], position
+				for width in widths:
+					fields.append(int.from_bytes(data[start:start + width], "big") if width else None)
+					start += width
+				position += size
+				kind = 1 if fields[0] is None else fields[0]
+				if kind == 1:
+					self._add(number, ("offset", fields[1]))
+				elif kind == 2:
+					self._add(number, ("stream", fields[1], fields[2]))
+		return text
+
+	def _bounds(self, offset):
+		from bisect import bisect_right
+		return offset, self.offsets[min(bisect_right(self.offsets, offset), len(self.offsets) - 1)]
+
+	async def _object_stream(self, number):
+		if number not in self.object_streams:
+			entry = self.entries.get(number)
+			if not entry or entry[0] != "offset":
+				raise _Unsupported("object stream not found")
+			start, end = self._bounds(entry[1])
+			await self.pdf.ensure([(start, end)])
+			raw = self.pdf.read(start, end)
+			data = _stream(raw)
+			text = _dict_text(raw)
+			first = _int("First", text)
+			header = data[:first].split()
+			offsets = [int(offset) for offset in header[1::2]] + [len(data) - first]
+			self.object_streams[number] = [
+			    data[first + offsets[i]:first + offsets[i + 1]].decode("latin-1")
+			    for i in range(len(offsets) - 1)
+			]
+		return self.object_streams[number]
+
+	async def _objects(self, numbers):
+		# fetch the objects of a level of the graph together
+		ranges = []
+		for number in numbers:
+			entry = self.entries.get(number)
+			if entry and entry[0] == "offset":
+				start, end = self._bounds(entry[1])
+				if end - start <= MAX_OBJECT_BYTES:
+					ranges.append((start, end))
+		await self.pdf.ensure(ranges)
+		texts = {}
+		for number in numbers:
+			entry = self.entries.get(number)
+			if not entry:
+				continue
+			if entry[0] == "offset":
+				start, end = self._bounds(entry[1])
+				raw = self.pdf.read(start, end)
+				if raw is not None:
+					texts[number] = _dict_text(raw)
+			else:
+				stream = await self._object_stream(entry[1])
+				if entry[2] < len(stream):
+					texts[number] = stream[entry[2]]
+		return texts
+
+	async def load(self):
+		await self.load_xref()
+		catalog = (await self._objects([self.root])).get(self.root, "")
+		pages = re.search(r"/Pages\s+(\d+)\s+\d+\s+R", catalog)
+		if not pages:
+			raise _Unsupported("no page tree")
+		level, seen = [int(pages.group(1))], {self.root}
+		kids = {}  # {page tree node: its first kids}
+		while level and len(seen) < MAX_OBJECTS:
+			seen.update(level)
+			texts = await self._objects(level)
+			level = []
+			for number, text in texts.items():
+				match = _KIDS_TEXT.search(text)
+				if match:
+					# the first MATCH_PAGES pages are under the first MATCH_PAGES kids of each node
+					refs = _REF.findall(match.group(1))[:MATCH_PAGES]
+					kids[number] = [int(ref) for ref in refs]
+					text = text[:match.start()] + "/Kids [%s]" % " ".join(f"{ref} 0 R" for ref in refs) + \
+					    text[match.end():]
+				text = _SKIPPED.sub("", text)
+				level.extend(n for n in map(int, _REF.findall(text)) if n not in seen and n not in level)
+
+		# the copy of the page tree only lists the first pages, the pdf reader
+		# would fail on the other pages (their bytes are zeros)
+		for number in kids:
+			entry = self.entries[number]
+			if entry[0] == "offset":
+				count = _leaves(number, kids)
+				self.pdf.patch(*self._bounds(entry[1]), lambda raw, count=count: _first_kids_only(raw, count))
+
+
+# Number of pages under a node of the reduced page tree
+def _leaves(number, kids, parents=()):
+	if number not in kids or number in parents:
+		return 1
+	return sum(_leaves(kid, kids, parents + (number, )) for kid in kids[number])
+
+
+# Page tree node reduced to its first kids, the other kids are not fetched
+def _first_kids_only(raw, count):
+	raw = _KIDS.sub(lambda m: (b"/Kids[" + b" ".join(_KID.findall(m.group(1))[:MATCH_PAGES]) + b"]").ljust(
+	    len(m.group(0))), raw)
+	return _COUNT.sub(lambda m: (b"/Count %d" % count).ljust(len(m.group(0))), raw)
+
+
+# Text of the first pages of a (partial) pdf
+def _first_pages_text(file_path):
+	try:
+		import fitz  # PyMuPDF, loaded on first use
+		with fitz.open(file_path) as doc:
+			if not doc.page_count:
+				return None
+			return "".join(page.get_text() for page in doc.pages(0, min(MATCH_PAGES, doc.page_count)))
+	except Exception as e:
+		print(f"An error occurred while extracting text from the partial pdf {file_path}: {e}")
+		return None
+
+
+# Linearized pdfs have the objects of their first page in their first /E bytes
+def _first_page_end(lead, total):
+	head = lead[:1024].decode("latin-1")
+	if "/Linearized" not in head or _int("L", head) != total:
+		return None
+	return _int("E", head)
+
+
+def _write(file_path, *chunks):
+	with open(file_path, "wb") as f:
+		for chunk in chunks:
+			f.write(chunk)
+
+
+# Download a pdf, rejecting it from its first pages if possible
+async def fetch_pdf(session, url, policy, file_path):
+	"""
+	Fetch the leading bytes of a pdf with a Range request. A small pdf is complete.
+	For a bigger one, only the objects of its first MATCH_PAGES pages are fetched (from the
+	first /E bytes of a linearized pdf, and the cross-reference tail and the objects it points
+	to), and the rest is only fetched if these pages may be the ones of a safety data sheet.
+	They are the pages the verification reads, so a rejected pdf would have been rejected
+	once downloaded whole.
+
+	Params:
+			session (aiohttp.ClientSession): The session to use for making an async http request.
+			url (str): The url of the pdf.
+			policy (fetch.RetryPolicy): The retries and timeouts of the requests.
+			file_path (str): The file the pdf is written to.
+
+	Returns:
+			str: WRITTEN, NOT_PDF, NOT_SDS or UNSUPPORTED (download the pdf whole).
+
+	Raises:
+			fetch.FetchError: If a request failed after its retries.
+	"""
+	pdf = PartialPdf(session, url, policy)
+	result = await pdf.get(0, LEAD_BYTES)
+	STATS["attempts"] += 1
+	if result.body is None:
+		return NOT_PDF
+	match = _CONTENT_RANGE.match(result.headers.get("content-range", ""))
+	if result.status != 206 or not match:
+		# the server ignored the range, the body is the whole pdf
+		STATS["no_range"] += 1
+		_write(file_path, result.body)
+		return WRITTEN
+	lead, pdf.total = result.body, int(match.group(3))
+	if len(lead) >= pdf.total:
+		STATS["small"] += 1
+		_write(file_path, lead)
+		return WRITTEN
+
+	etag = result.headers.get("etag", "")
+	pdf.validator = etag if etag and not etag.startswith("W/") else result.headers.get("last-modified")
+	pdf.chunks[0] = lead
+	try:
+		end = _first_page_end(lead, pdf.total)
+		if end and len(lead) < end <= MAX_PARTIAL_BYTES:
+			await pdf.ensure([(len(lead), end)])
+		await _FirstPages(pdf).load()
+	except _Unsupported as e:
+		print(f"Downloading {url} whole, {e}")
+		STATS["unsupported"] += 1
+		return UNSUPPORTED
+	except (ValueError, IndexError, AttributeError, zlib.error) as e:
+		print(f"Downloading {url} whole, unreadable cross-reference: {e}")
+		STATS["unsupported"] += 1
+		return UNSUPPORTED
+
+	pdf.write(file_path)
+	text = _first_pages_text(file_path)
+	if text is not None and len(text.strip()) >= MIN_TEXT and not SDS_PATTERN.search(text):
+		os.remove(file_path)
+		STATS["rejected"] += 1
+		STATS["bytes_fetched"] += pdf.fetched
+		STATS["bytes_saved"] += pdf.total - pdf.fetched
+		print(f"Skipping {url}, its first pages are not a MSDS ({pdf.fetched} of {pdf.total} bytes fetched)")
+		return NOT_SDS
+
+	# fetch the rest of the pdf
+	STATS["passed"] += 1
+	result = await pdf.get(len(lead))
+	if result.body is None:
+		return UNSUPPORTED
+	if result.status == 200:
+		# the pdf changed since the first request, this is the whole new one
+		_write(file_path, result.body)
+	elif len(lead) + len(result.body) == pdf.total:
+		_write(file_path, lead, result.body)
+	else:
+		return UNSUPPORTED
+	STATS["bytes_fetched"] += pdf.fetched
+	return WRITTEN
+
+
+# Stats
+def stats():
+	"""
+	Returns:
+			dict: The outcomes of the partial fetches of the process, the bytes fetched and saved.
+	"""
+	return dict(STATS)
@@ -0,0 +1,50 @@
+from fetch import DEFAULT_POLICY
+
+
+class ModePolicy:
+	"""
+	The configuration of a crawl mode (single lookups, excel files ...).
+
+	Params:
+			name (str): The name of the mode.
+			store (callable): The store stage, called with (query, file_path, status, provider, url)
+				for each pdf verified for a query. It owns the file and returns True if it was kept.
+			fetch_policy (fetch.RetryPolicy, optional): The retries and timeouts of the requests.
+			skip_urls (set, optional): The urls containing one of these words are never crawled.
+			temp_folder (str, optional): The folder of the downloaded pdfs, until they are verified. Defaults to ./temp.
+			download_limit (int, optional): The max number of pdfs stored per query. Defaults to 3.
+			max_domain_visits (int, optional): The max number of pages crawled per domain from a search result. Defaults to 5.
+			depth (int, optional): The depth of the crawl from a search result. Defaults to 2.
+			max_search_results (int, optional): The number of search results per query. Defaults to 10.
+			similar (bool, optional): Also store the pdfs containing a word of the name, for the queries without CAS. Defaults to False.
+	"""
+
+	def __init__(self,
+	             name,
+	             store,
+	             fetch_policy=None,
+	             skip_urls=(),
+	             temp_folder="./temp",
+	             download_limit=3,
+	             max_domain_visits=5,
+	             depth=2,
+	             max_search_results=10,
+	             similar=False):
+		self.name = name
+		self.store = store
+		self.fetch_policy = fetch_policy or DEFAULT_POLICY
+		self.skip_urls = {url.lower() for url in skip_urls}
+		self.temp_folder = temp_folder
+		self.download_limit = download_limit
+		self.max_domain_visits = max_domain_visits
+		self.depth = depth
+		self.max_search_results = max_search_results
+		self.similar = similar
+
+	def skips(self, url):
+		"""
+		Returns:
+				bool: Whether the url contains one of the skipped words.
+		"""
+		url = url.lower()
+		return any(skip in url for skip in self.skip_urls)
@@ -0,0 +1,182 @@
+import asyncio
+import os
+import uuid
+from urllib.parse import urljoin
+
+import discovery
+import negative_cache
+from crawler import partial_fetch
+from fetch import FetchError, fetch
+
+# The stages of the crawl, see engine.Crawl for how they are chained.
+# Each stage is run through the hooks of the process (see hooks.py).
+
+
+# Search the urls of a query
+async def search(term, max_search_results=10):
+	"""
+	Params:
+			term (str): The CAS number or name to search for.
+			max_search_results (int, optional): The number of search results. Defaults to 10.
+
+	Returns:
+			list: The urls of the search results, empty if the search failed.
+	"""
+	from googlesearch import search as google_search  # loaded on first use
+	query = f"download msds of {term}"
+	print(f"Searching Google for: {query}")
+	try:
+		return await asyncio.to_thread(
+		    lambda: list(google_search(query, num=max_search_results, stop=max_search_results)))
+	except Exception as e:
+		print(f"An error occurred while searching {query}: {e}")
+		return []
+
+
+# Urls of a domain listed by its sitemaps
+async def discover(session, url, terms):
+	"""
+	Params:
+			session (aiohttp.ClientSession): The session to use for making an async http request.
+			url (str): A url of the domain.
+			terms (list): The CAS numbers or names looked for.
+
+	Returns:
+			list: The urls of the sitemaps of the domain likely to be MSDS of the terms (see discovery.candidates).
+	"""
+	return await discovery.candidates(session, url, terms)
+
+
+# Check if a url points to a pdf
+async def probe(session, url, policy, scopes=()):
+	"""
+	Params:
+			session (aiohttp.ClientSession): The session to use for making an async http request.
+			url (str): The url to check.
+			policy (ModePolicy): The policy of the crawl.
+			scopes (tuple, optional): The keys of the outstanding queries (see negative_cache.query_scope).
+
+	Returns:
+			str: "pdf", "page", or None if the url should not be fetched.
+	"""
+	if url.lower().endswith(".pdf"):
+		return "pdf"
+	try:
+		result = await fetch(session, url, "HEAD", policy=policy.fetch_policy)
+		content_type = result.headers.get("content-type", "")
+		return "pdf" if content_type.startswith("application/pdf") else "page"
+	except Exception as e:
+		print(f"Error occurred while checking {url}: {e}")
+		return "page"
+
+
+# Download a pdf
+async def fetch_pdf(session, url, policy):
+	"""
+	Download a pdf into the temp folder of the policy. The pdfs whose first pages are
+	not the ones of a safety data sheet are rejected from their first bytes, when the
+	server supports Range requests (see partial_fetch.py).
+
+	Returns:
+			str: The file path of the downloaded pdf, or None if the download failed.
+	"""
+	# prefix the name, other workers may download a file with the same name
+	file_name = uuid.uuid4().hex[:8] + "_" + url.rstrip("/").split("/")[-1].split("?")[0]
+	if not file_name.endswith(".pdf"):
+		file_name += ".pdf"
+	file_path = os.path.join(policy.temp_folder, file_name)
+	try:
+		outcome = partial_fetch.UNSUPPORTED
+		if partial_fetch.ENABLED:
+			outcome = await partial_fetch.fetch_pdf(session, url, policy.fetch_policy, file_path)
+		if outcome == partial_fetch.UNSUPPORTED:
+			# the body is only read if the response is a pdf
+			result = await fetch(
+			    session,
+			    url,
+			    policy=policy.fetch_policy,
+			    accept=lambda headers: headers.get("content-type", "").startswith("application/pdf"))
+			outcome = partial_fetch.NOT_PDF
+			if result.body is not None:
+				with open(file_path, "wb") as pdf_file:
+					pdf_file.write(result.body)
+				outcome = partial_fetch.WRITTEN
+		if outcome == partial_fetch.NOT_PDF:
+			print(f"Skipping {url}, not a PDF file.")
+			negative_cache.record(url, negative_cache.NOT_PDF)
+			return None
+		if outcome == partial_fetch.NOT_SDS:
+			negative_cache.record(url, negative_cache.NOT_SDS)
+			return None
+		print(f"Downloaded: {file_name}")
+		return file_path
+	except Exception as e:
+		if isinstance(e, FetchError):
+			negative_cache.record_fetch_error(url, e)
+		print(f"An error occurred while downloading {url}: {e}")
+		if os.path.exists(file_path):
+			os.remove(file_path)
+		return None
+
+
+# Links of a web page
+async def fetch_links(session, url, policy):
+	"""
+	Returns:
+			list: The urls of the links of the page, resolved against the page url.
+	"""
+	try:
+		result = await fetch(session, url, policy=policy.fetch_policy)
+		from bs4 import BeautifulSoup  # loaded on first use
+		soup = BeautifulSoup(result.body, "html.parser")
+		return [urljoin(url, link["href"]) for link in soup.find_all("a", href=True)]
+	except Exception as e:
+		if isinstance(e, FetchError):
+			negative_cache.record_fetch_error(url, e)
+		print(f"An error occurred while scraping links from {url}: {e}")
+		return []
+
+
+# Text of a pdf
+def extract_text(pdf_path, max_pages=5):
+	"""
+	Params:
+			pdf_path (str): The file path of the pdf.
+			max_pages (int, optional): Only the first pages are read. Defaults to 5.
+
+	Returns:
+			str: The text of the pdf, or None if the extraction failed.
+	"""
+	try:
+		import fitz  # PyMuPDF, loaded on first use
+		with fitz.open(pdf_path) as doc:
+			return "".join(page.get_text() for page in doc.pages(0, min(max_pages, doc.page_count)))
+	except Exception as e:
+		print(f"An error occurred while extracting text from {pdf_path}: {e}")
+		return None
+
+
+# Match a pdf against the outstanding queries
+async def verify(matcher, file_path):
+	"""
+	Params:
+			matcher (verify.MultiMatcher): The matcher of the outstanding queries.
+			file_path (str): The file path of the pdf.
+
+	Returns:
+			tuple: The text of the pdf and the {query key: "same" or "similar"} matches.
+	"""
+	# PyMuPDF holds the thread for the whole extraction, run it off the event loop
+	text = await asyncio.to_thread(extract_text, file_path)
+	return text, matcher.scan(text)
+
+
+# Store a verified pdf
+async def store(policy, query, file_path, status, provider, url):
+	"""
+	Hand a verified pdf to the store of the policy (see ModePolicy).
+
+	Returns:
+			bool: Whether the pdf was kept for the query.
+	"""
+	return policy.store(query, file_path, status, provider, url)
@@ -0,0 +1,76 @@
+import re
+
+
+# Set regular expression pattern
+def set_pattern(sequence):
+	"""
+	Create a regular expression pattern matching a whole sequence, case insensitive.
+
+	Params:
+			sequence (str): The sequence to escape and compile into a pattern.
+
+	Returns:
+			re.Pattern: The compiled regular expression pattern.
+	"""
+	return re.compile(rf"\b{re.escape(sequence)}\b", re.IGNORECASE)
+
+
+# Every MSDS contains this phrase
+SDS_PATTERN = set_pattern("safety data sheet")
+
+
+class MultiMatcher:
+	"""
+	Match the text of a pdf against every outstanding query with a single scan.
+	A pdf is the "same" MSDS as a query if it contains its CAS number, or its name if
+	there is no CAS, along with the phrase "safety data sheet".
+
+	Params:
+			queries (list): The outstanding Query.
+			similar (bool, optional): Also report "similar" matches (a word of the name) for the queries without CAS.
+	"""
+
+	def __init__(self, queries, similar=False):
+		queries = [query for query in queries if query.key]
+		# {term in lower case: query key}
+		self.keys = {query.term.lower(): query.key for query in queries}
+		self.pattern = self._alternation(query.term for query in queries)
+		# terms containing other terms, the alternation only reports the longest one
+		self.contained = {
+		    term: [other for other in self.keys if other != term and
+		           re.search(rf"\b{re.escape(other)}\b", term)]
+		    for term in self.keys
+		}
+		self.words = {}
+		if similar:
+			for query in queries:
+				if query.cas is None and query.name:
+					for word in query.name.lower().split():
+						self.words.setdefault(word, set()).add(query.key)
+		self.word_pattern = self._alternation(self.words)
+
+	@staticmethod
+	def _alternation(terms):
+		terms = sorted(set(terms), key=len, reverse=True)
+		if not terms:
+			return None
+		return re.compile(r"\b(?:" + "|".join(map(re.escape, terms)) + r")\b", re.IGNORECASE)
+
+	def scan(self, text):
+		"""
+		Returns:
+				dict: {query key: "same" or "similar"} for every query matched by the text.
+		"""
+		if not text or self.pattern is None or not SDS_PATTERN.search(text):
+			return {}
+		matches = {}
+		for match in self.pattern.finditer(text):
+			term = match.group(0).lower()
+			for other in [term] + self.contained.get(term, []):
+				if other in self.keys:
+					matches[self.keys[other]] = "same"
+		if self.word_pattern is not None:
+			for match in self.word_pattern.finditer(text):
+				for key in self.words.get(match.group(0).lower(), ()):
+					matches.setdefault(key, "similar")
+		return matches
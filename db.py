@@ -0,0 +1,52 @@
+import os
+import sqlite3
+import threading
+
+# Database setup
+DB_FOLDER = "./logs"
+DB_PATH = os.path.join(DB_FOLDER, "scout.db")
+
+_local = threading.local()
+_schema_lock = threading.Lock()
+_applied_schemas = set()
+
+
+# Get a connection for the current thread
+def connect():
+	"""
+	Return the SQLite connection of the current thread, opening it on first use.
+	All the stores (reports, storage, queues ...) share the same database file.
+
+	Returns:
+			sqlite3.Connection: The connection, in WAL mode with autocommit disabled.
+	"""
+	conn = getattr(_local, "conn", None)
+	if conn is None:
+		os.makedirs(DB_FOLDER, exist_ok=True)
+		conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False)
+		conn.row_factory = sqlite3.Row
+		conn.execute("PRAGMA journal_mode=WAL")
+		conn.execute("PRAGMA synchronous=NORMAL")
+		conn.execute("PRAGMA busy_timeout=30000")
+		_local.conn = conn
+	return conn
+
+
+# Create the tables of a store
+def ensure_schema(name, schema):
+	"""
+	Apply a store schema once per process.
+
+	Params:
+			name (str): The name of the store owning the schema.
+			schema (str): The SQL script (CREATE ... IF NOT EXISTS statements).
+	"""
+	if name in _applied_schemas:
+		return
+	with _schema_lock:
+		if name in _applied_schemas:
+			return
+		conn = connect()
+		conn.executescript(schema)
+		conn.commit()
+		_applied_schemas.add(name)
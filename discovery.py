@@ -0,0 +1,396 @@
+import asyncio
+import os
+import time
+import zlib
+from urllib.parse import urljoin, urlparse
+from urllib.robotparser import RobotFileParser
+from xml.etree import ElementTree
+
+import aiohttp
+
+import db
+from fetch import FetchError, RetryPolicy, fetch
+from politeness import HOSTS
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS discovery_hosts (
+	host TEXT PRIMARY KEY,
+	robots TEXT,
+	robots_fetched_at REAL,
+	sitemaps_fetched_at REAL,
+	urls INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS url_index (
+	url TEXT PRIMARY KEY,
+	host TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_url_index_host ON url_index (host);
+"""
+
+FETCH_POLICY = RetryPolicy.from_env("SCOUT_DISCOVERY_FETCH",
+                                    max_attempts=2,
+                                    connect_timeout=5,
+                                    read_timeout=10,
+                                    total_timeout=60)
+
+# Seconds before robots.txt and the sitemaps of a host are fetched again
+ROBOTS_TTL = int(os.environ.get("SCOUT_ROBOTS_TTL", 24 * 3600))
+SITEMAPS_TTL = int(os.environ.get("SCOUT_SITEMAPS_TTL", 7 * 24 * 3600))
+# Max sitemaps fetched and urls indexed per host
+MAX_SITEMAPS = 20
+MAX_URLS = 50000
+# Max size of a sitemap (the limit of the sitemap protocol), compressed or not
+MAX_SITEMAP_BYTES = 50 * 1024 * 1024
+# Max Crawl-delay honored, seconds
+MAX_CRAWL_DELAY = 30
+# Max candidate urls returned per lookup
+MAX_CANDIDATES = 5
+USER_AGENT = "*"
+
+# Only the urls that may be a safety data sheet are indexed
+INDEXED_HINTS = (".pdf", "sds", "safety")
+
+CHUNK_SIZE = 64 * 1024
+INSERT_BATCH = 500
+
+# Parsed robots.txt of the hosts, {host: RobotFileParser}
+_robots = {}
+# Discovery in progress, {host: asyncio.Lock}
+_locks = {}
+# Sitemaps read in the background, {host: asyncio.Task}
+_sitemap_tasks = {}
+
+
+def _host_of(url):
+	parsed = urlparse(url)
+	return parsed.netloc.lower(), f"{parsed.scheme or 'https'}://{parsed.netloc}"
+
+
+def _get_host(host):
+	db.ensure_schema("discovery_hosts", SCHEMA)
+	row = db.connect().execute("SELECT * FROM discovery_hosts WHERE host = ?",
+	                           (host, )).fetchone()
+	return dict(row) if row else None
+
+
+# Crawl-delay of a robots.txt
+def _crawl_delay(text):
+	"""
+	RobotFileParser only reads integer delays, many sites use decimals (eg. 0.5).
+
+	Returns:
+			float: The Crawl-delay of the group of every user agent, or None.
+	"""
+	agents, in_rules = [], False
+	for line in text.splitlines():
+		field, _, value = line.split("#", 1)[0].partition(":")
+		field, value = field.strip().lower(), value.strip()
+		if field == "user-agent":
+			if in_rules:
+				agents, in_rules = [], False
+			agents.append(value)
+		elif field in ("allow", "disallow", "crawl-delay", "request-rate"):
+			in_rules = True
+			if field == "crawl-delay" and USER_AGENT in agents:
+				try:
+					return max(float(value), 0)
+				except ValueError:
+					return None
+	return None
+
+
+# Parse a robots.txt and apply its Crawl-delay to the host scheduler
+def _load_robots(host, text):
+	parser = RobotFileParser()
+	parser.parse((text or "").splitlines())
+	_robots[host] = parser
+	delay = _crawl_delay(text or "")
+	if delay:
+		HOSTS.state(host).min_interval = min(delay, MAX_CRAWL_DELAY)
+	return parser
+
+
+async def _fetch_robots(session, host, origin):
+	try:
+		result = await fetch(session, origin + "/robots.txt", policy=FETCH_POLICY)
+		text = (result.body or b"").decode("utf-8", errors="replace")
+	except FetchError as e:
+		# no robots.txt (or an unreachable one), everything is allowed
+		print(f"No robots.txt for {host}: {e}")
+		text = ""
+	conn = db.connect()
+	with conn:
+		conn.execute(
+		    "INSERT INTO discovery_hosts (host, robots, robots_fetched_at) VALUES (?, ?, ?) "
+		    "ON CONFLICT(host) DO UPDATE SET robots = excluded.robots, "
+		    "robots_fetched_at = excluded.robots_fetched_at", (host, text, time.time()))
+	return text
+
+
+class SitemapIndexer:
+	"""
+	Incremental parser of a sitemap (xml, gzipped xml or plain text), fed with the
+	chunks of the response as they are received. The candidate urls are written to
+	the url index in batches, so neither the body nor its urls are kept in memory.
+
+	Params:
+			host (str): The host of the sitemap.
+			budget (int): The max number of urls to index.
+	"""
+
+	def __init__(self, host, budget):
+		self.host = host
+		self.budget = budget
+		self.children = []  # the child sitemaps of a sitemap index
+		self.indexed = 0
+		self.size = 0  # decompressed bytes
+		self.full = False  # the budget or the size limit is reached, stop feeding
+		self._decompressor = None
+		self._parser = None  # XMLPullParser, or None for a plain text sitemap
+		self._text = None  # the partial last line of a plain text sitemap
+		self._kind = None
+		self._started = False
+		self._batch = []
+
+	def feed(self, chunk):
+		if not self._started:
+			if chunk[:2] == b"\x1f\x8b":
+				self._decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+			self._started = True
+		if self._decompressor:
+			# the protocol limit is on the uncompressed size, so a small gzip cannot inflate past it
+			chunk = self._decompressor.decompress(chunk, MAX_SITEMAP_BYTES - self.size + 1)
+		self.size += len(chunk)
+		if self.size > MAX_SITEMAP_BYTES:
+			print(f"A sitemap of {self.host} is over {MAX_SITEMAP_BYTES} bytes, truncated")
+			self.full = True
+			return
+		if self._parser is None and self._text is None:
+			head = chunk.lstrip()
+			if not head:
+				return
+			if head.startswith(b"<"):
+				self._parser = ElementTree.XMLPullParser(events=("start", "end"))
+			else:
+				self._text = b""
+		if self._parser is not None:
+			self._parser.feed(chunk)
+			for event, elem in self._parser.read_events():
+				tag = elem.tag.rsplit("}", 1)[-1]
+				if event == "start":
+					if self._kind is None:
+						self._kind = "sitemap" if tag == "sitemapindex" else "url"
+				elif tag == "loc" and elem.text:
+					self._add(self._kind, elem.text.strip())
+				elif tag in ("url", "sitemap"):
+					elem.clear()  # keep the memory flat on large sitemaps
+		else:
+			# plain text sitemap, one url per line
+			lines = (self._text + chunk).split(b"\n")
+			self._text = lines.pop()
+			for line in lines:
+				self._add("url", line.decode("utf-8", errors="replace").strip())
+
+	def _add(self, kind, loc):
+		if self.full or not loc:
+			return
+		if kind == "sitemap":
+			self.children.append(loc)
+			return
+		if not any(hint in loc.lower() for hint in INDEXED_HINTS):
+			return
+		self._batch.append((loc, self.host))
+		self.indexed += 1
+		if len(self._batch) >= INSERT_BATCH:
+			self._flush()
+		if self.indexed >= self.budget:
+			self.full = True
+
+	def _flush(self):
+		if self._batch:
+			conn = db.connect()
+			with conn:
+				conn.executemany("INSERT OR IGNORE INTO url_index (url, host) VALUES (?, ?)", self._batch)
+			self._batch = []
+
+	def close(self):
+		"""
+		Returns:
+				tuple: The child sitemaps (of a sitemap index) and the number of indexed urls.
+		"""
+		if self._text:
+			self._add("url", self._text.decode("utf-8", errors="replace").strip())
+		self._flush()
+		return self.children, self.indexed
+
+
+# Stream a sitemap response into the url index
+async def _index_sitemap(host, budget, response):
+	indexer = SitemapIndexer(host, budget)
+	received = 0
+	async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+		received += len(chunk)
+		if received > MAX_SITEMAP_BYTES:
+			print(f"A sitemap of {host} is over {MAX_SITEMAP_BYTES} bytes, truncated")
+			break
+		await asyncio.to_thread(indexer.feed, chunk)
+		if indexer.full:
+			break
+	return await asyncio.to_thread(indexer.close)
+
+
+async def _fetch_sitemaps(session, host, origin, robots):
+	sitemaps = list(robots.site_maps() or []) or [origin + "/sitemap.xml"]
+	seen, fetched, indexed = set(), 0, 0
+	conn = db.connect()
+	with conn:
+		conn.execute("DELETE FROM url_index WHERE host = ?", (host, ))
+
+	while sitemaps and fetched < MAX_SITEMAPS and indexed < MAX_URLS:
+		sitemap = urljoin(origin, sitemaps.pop(0))
+		if sitemap in seen:
+			continue
+		seen.add(sitemap)
+		fetched += 1
+		budget = MAX_URLS - indexed
+		try:
+			result = await fetch(
+			    session,
+			    sitemap,
+			    policy=FETCH_POLICY,
+			    accept=lambda headers: int(headers.get("Content-Length") or 0) <= MAX_SITEMAP_BYTES,
+			    consume=lambda response: _index_sitemap(host, budget, response))
+			if not result.body:
+				continue
+			children, count = result.body
+		except (FetchError, ElementTree.ParseError, OSError, EOFError, zlib.error) as e:
+			print(f"An error occurred while reading the sitemap {sitemap}: {e}")
+			continue
+		sitemaps.extend(children)
+		indexed += count
+
+	with conn:
+		conn.execute(
+		    "UPDATE discovery_hosts SET sitemaps_fetched_at = ?, urls = ? WHERE host = ?",
+		    (time.time(), indexed, host))
+	print(f"Indexed {indexed} urls of {fetched} sitemaps of {host}")
+
+
+# Fetch the sitemaps of a host in the background
+async def _discover_sitemaps(host, origin, robots):
+	try:
+		# the session of the lookup may be closed before the sitemaps are read
+		async with aiohttp.ClientSession() as session:
+			await _fetch_sitemaps(session, host, origin, robots)
+	except Exception as e:
+		print(f"An error occurred while reading the sitemaps of {host}: {e}")
+	finally:
+		del _sitemap_tasks[host]
+
+
+# Discover a host
+async def discover(session, url):
+	"""
+	Fetch (or load from the cache) the robots.txt of the host of a url, and start
+	reading its sitemaps in the background if they are not indexed yet (the lookup
+	does not wait for them, the next lookups of the host find their urls).
+	The Crawl-delay of the robots.txt is applied to the host scheduler, and the urls of
+	the sitemaps that may be a safety data sheet are written to the url index.
+
+	Params:
+			session (aiohttp.ClientSession): The session to use for making an async http request.
+			url (str): A url of the host.
+
+	Returns:
+			RobotFileParser: The robots.txt of the host.
+	"""
+	host, origin = _host_of(url)
+	if host not in _locks:
+		_locks[host] = asyncio.Lock()
+	async with _locks[host]:
+		row = _get_host(host)
+		now = time.time()
+		if row is None or not row["robots_fetched_at"] or now - row["robots_fetched_at"] > ROBOTS_TTL:
+			robots = _load_robots(host, await _fetch_robots(session, host, origin))
+		elif host not in _robots:
+			robots = _load_robots(host, row["robots"])
+		else:
+			robots = _robots[host]
+
+		if (row is None or not row["sitemaps_fetched_at"] or now - row["sitemaps_fetched_at"] > SITEMAPS_TTL) \
+		   and host not in _sitemap_tasks:
+			_sitemap_tasks[host] = asyncio.create_task(_discover_sitemaps(host, origin, robots))
+		return robots
+
+
+# Check the robots.txt of a url
+def allowed(url):
+	"""
+	Returns:
+			bool: False if the robots.txt of the host (once discovered) disallows the url.
+	"""
+	robots = _robots.get(urlparse(url).netloc.lower())
+	return robots is None or robots.can_fetch(USER_AGENT, url)
+
+
+# Spellings of a term in urls
+def _variants(term):
+	term = term.strip().lower()
+	words = term.split()
+	variants = {term}
+	for separator in ("-", "_", "%20", "+", ""):
+		variants.add(separator.join(words))
+	return [variant for variant in variants if variant]
+
+
+# Candidate pdfs of a host
+async def candidates(session, url, terms):
+	"""
+	Look up the url index of the host of a url for the pdfs of a query, before any html crawl.
+
+	Params:
+			session (aiohttp.ClientSession): The session to use for making an async http request.
+			url (str): A url of the host (eg. a search result).
+			terms (list): The CAS numbers or names of the query.
+
+	Returns:
+			list: The candidate urls, pdfs first.
+	"""
+	try:
+		await discover(session, url)
+	except Exception as e:
+		print(f"An error occurred while discovering {url}: {e}")
+		return []
+
+	host, _ = _host_of(url)
+	patterns = []
+	for term in terms:
+		if term:
+			for variant in _variants(term):
+				escaped = variant.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+				patterns.append(f"%{escaped}%")
+	if not patterns:
+		return []
+
+	where = " OR ".join("url LIKE ? ESCAPE '\\'" for _ in patterns)
+	rows = db.connect().execute(f"SELECT url FROM url_index WHERE host = ? AND ({where})",
+	                            [host] + patterns).fetchall()
+	urls = [row["url"] for row in rows if allowed(row["url"])]
+	urls.sort(key=lambda candidate: ".pdf" not in candidate.lower())
+	return urls[:MAX_CANDIDATES]
+
+
+# Discovery stats
+def stats():
+	db.ensure_schema("discovery_hosts", SCHEMA)
+	conn = db.connect()
+	hosts = conn.execute("SELECT COUNT(*) AS hosts, COALESCE(SUM(urls), 0) AS urls FROM discovery_hosts").fetchone()
+	return {
+	    "hosts": hosts["hosts"],
+	    "indexed_urls": hosts["urls"],
+	    "sitemaps_in_progress": len(_sitemap_tasks),
+	    "crawl_delays": {
+	        host: HOSTS.state(host).min_interval
+	        for host in _robots if HOSTS.state(host).min_interval
+	    },
+	}
@@ -0,0 +1,214 @@
+import csv
+import io
+import os
+import threading
+import time
+from collections import defaultdict
+from urllib.parse import urlparse
+
+import db
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS domain_stats (
+	domain TEXT PRIMARY KEY,
+	crawls INTEGER NOT NULL DEFAULT 0,
+	fetches INTEGER NOT NULL DEFAULT 0,
+	errors INTEGER NOT NULL DEFAULT 0,
+	bytes INTEGER NOT NULL DEFAULT 0,
+	total_latency REAL NOT NULL DEFAULT 0,
+	pdfs INTEGER NOT NULL DEFAULT 0,
+	same_hits INTEGER NOT NULL DEFAULT 0,
+	similar_hits INTEGER NOT NULL DEFAULT 0,
+	last_seen REAL
+);
+"""
+
+COLUMNS = ["crawls", "fetches", "errors", "bytes", "total_latency", "pdfs",
+           "same_hits", "similar_hits"]
+
+# Prior of the yield of an unknown domain: PRIOR_HITS hits per PRIOR_CRAWLS crawls
+PRIOR_HITS = 1
+PRIOR_CRAWLS = 4
+# A similar hit is worth half a same hit
+SIMILAR_WEIGHT = 0.5
+# Latency of a domain without samples, seconds
+DEFAULT_LATENCY = 1.0
+# Domains without any hit get a third of the visits (the pages and pdfs fetched from
+# the domain by the crawl of a root) after LIMIT_AFTER crawls, and are skipped after
+# SKIP_AFTER crawls
+LIMIT_AFTER = 5
+SKIP_AFTER = 20
+LIMITED_SHARE = 1 / 3
+# The fewest visits of a limited crawl: the root page and one of its links
+MIN_VISITS = 2
+# A skipped domain gets a limited exploration crawl once it was not seen for this
+# long, so that a bad stretch (eg. an outage) does not drop a supplier for good
+EXPLORE_AFTER = int(os.environ.get("SCOUT_DOMAIN_EXPLORE_SECONDS", 7 * 24 * 3600))
+
+# Updates not written yet, {domain: {column: increment}}
+_pending = defaultdict(lambda: defaultdict(float))
+_pending_lock = threading.Lock()
+_last_flush = time.monotonic()
+FLUSH_INTERVAL = 5
+
+# Stats read from the database, refreshed after each flush
+_cache = {}
+
+
+# Domain of a url
+def domain_of(url):
+	"""
+	Returns:
+			str: The domain of the url, lower case and without www.
+	"""
+	netloc = urlparse(url).netloc.lower()
+	return netloc[4:] if netloc.startswith("www.") else netloc
+
+
+def _add(domain, **increments):
+	global _last_flush
+	with _pending_lock:
+		for column, value in increments.items():
+			_pending[domain][column] += value
+	if time.monotonic() - _last_flush >= FLUSH_INTERVAL:
+		flush()
+
+
+# Record a fetch (called by fetch.py)
+def record_fetch(url, nbytes=0, latency=0, error=False):
+	if error:
+		_add(domain_of(url), errors=1)
+	else:
+		_add(domain_of(url), fetches=1, bytes=nbytes, total_latency=latency)
+
+
+# Record the crawl of a root url
+def record_crawl(url):
+	_add(domain_of(url), crawls=1)
+
+
+# Record a downloaded pdf and its verification status
+def record_pdf(root_url, verification_status):
+	"""
+	Params:
+			root_url (str): The crawl root the pdf was found from (the yield is credited to its domain).
+			verification_status (str): "same", "similar" or False.
+	"""
+	increments = {"pdfs": 1}
+	if verification_status == "same":
+		increments["same_hits"] = 1
+	elif verification_status == "similar":
+		increments["similar_hits"] = 1
+	_add(domain_of(root_url), **increments)
+
+
+# Write the pending updates
+def flush():
+	global _last_flush
+	with _pending_lock:
+		pending = dict(_pending)
+		_pending.clear()
+		_last_flush = time.monotonic()
+	if not pending:
+		return
+	db.ensure_schema("domain_stats", SCHEMA)
+	conn = db.connect()
+	now = time.time()
+	with conn:
+		for domain, increments in pending.items():
+			values = [increments.get(column, 0) for column in COLUMNS]
+			conn.execute(
+			    f"INSERT INTO domain_stats (domain, {', '.join(COLUMNS)}, last_seen) "
+			    f"VALUES (?, {', '.join('?' for _ in COLUMNS)}, ?) "
+			    f"ON CONFLICT(domain) DO UPDATE SET "
+			    f"{', '.join(f'{c} = {c} + excluded.{c}' for c in COLUMNS)}, last_seen = excluded.last_seen",
+			    [domain] + values + [now])
+	_cache.clear()
+
+
+# Stats of a domain
+def get(domain):
+	"""
+	Returns:
+			dict: The stats of the domain (zeros for an unknown domain).
+	"""
+	if domain not in _cache:
+		db.ensure_schema("domain_stats", SCHEMA)
+		row = db.connect().execute("SELECT * FROM domain_stats WHERE domain = ?",
+		                           (domain, )).fetchone()
+		_cache[domain] = dict(row) if row else dict.fromkeys(COLUMNS, 0)
+	return _cache[domain]
+
+
+# Expected yield per second of a domain
+def expected_yield(domain):
+	"""
+	The expected hits per crawl (smoothed with a prior, so unknown domains are
+	still explored) divided by the mean latency of the domain.
+	"""
+	stats = get(domain)
+	hits = stats["same_hits"] + SIMILAR_WEIGHT * stats["similar_hits"]
+	per_crawl = (hits + PRIOR_HITS) / (stats["crawls"] + PRIOR_CRAWLS)
+	latency = stats["total_latency"] / stats["fetches"] if stats["fetches"] else DEFAULT_LATENCY
+	return per_crawl / max(latency, 0.05)
+
+
+# Order the crawl roots
+def rank(urls):
+	"""
+	Order urls (eg. the search results) by the expected yield per second of their
+	domain, the search order breaks the ties.
+	"""
+	urls = list(urls)
+	return sorted(urls, key=lambda url: -expected_yield(domain_of(url)))
+
+
+# Visits of a crawl root
+def crawl_visits(url, visits):
+	"""
+	Params:
+			url (str): The crawl root.
+			visits (int): The default max visits of the domain of the root per crawl.
+
+	Returns:
+			int: The max pages and pdfs fetched from the domain of the root by its crawl, 0 to skip it.
+	"""
+	stats = get(domain_of(url))
+	if stats["same_hits"] or stats["similar_hits"]:
+		return visits
+	limited = min(visits, max(MIN_VISITS, int(visits * LIMITED_SHARE)))
+	if stats["crawls"] >= SKIP_AFTER:
+		last_seen = stats.get("last_seen")
+		if last_seen and time.time() - last_seen < EXPLORE_AFTER:
+			return 0
+		return limited  # exploration crawl
+	if stats["crawls"] >= LIMIT_AFTER:
+		return limited
+	return visits
+
+
+# Export the stats
+def export(fmt="json"):
+	"""
+	Params:
+			fmt (str, optional): "json" or "csv". Defaults to json.
+
+	Returns:
+			list or str: The stats of every domain, the best expected yield first.
+	"""
+	flush()
+	db.ensure_schema("domain_stats", SCHEMA)
+	rows = [dict(row) for row in db.connect().execute("SELECT * FROM domain_stats")]
+	for row in rows:
+		row["mean_latency"] = round(row["total_latency"] / row["fetches"], 3) if row["fetches"] else None
+		row["expected_yield"] = round(expected_yield(row["domain"]), 4)
+	rows.sort(key=lambda row: -row["expected_yield"])
+	if fmt != "csv":
+		return rows
+
+	output = io.StringIO()
+	if rows:
+		writer = csv.DictWriter(output, fieldnames=list(rows[0]))
+		writer.writeheader()
+		writer.writerows(rows)
+	return output.getvalue()
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import time
+
+import db
+from report_store import new_run_id
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS excel_sheets (
+	sheet_hash TEXT PRIMARY KEY,
+	batch_id TEXT NOT NULL,
+	filename TEXT,
+	rows INTEGER NOT NULL,
+	created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS excel_rows (
+	batch_id TEXT NOT NULL,
+	row INTEGER NOT NULL,
+	id TEXT,
+	cas TEXT,
+	name TEXT,
+	status TEXT NOT NULL,
+	downloads INTEGER NOT NULL DEFAULT 0,
+	files TEXT,
+	updated_at REAL NOT NULL,
+	PRIMARY KEY (batch_id, row)
+);
+"""
+
+# Row statuses
+PENDING = "pending"
+PARTIAL = "partial"  # crawled in part, the files found so far are kept
+DONE = "done"
+
+
+# Content hash of a sheet
+def sheet_hash(file_path):
+	"""
+	Returns:
+			str: The sha256 of the content of the file, the same sheet uploaded again has the same hash.
+	"""
+	digest = hashlib.sha256()
+	with open(file_path, "rb") as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b""):
+			digest.update(chunk)
+	return digest.hexdigest()
+
+
+# Register the rows of a sheet
+def register_sheet(digest, rows, filename=None):
+	"""
+	Params:
+			digest (str): The content hash of the sheet.
+			rows (list): The {"id", "cas", "name"} rows of the sheet.
+			filename (str, optional): The uploaded file name.
+
+	Returns:
+			tuple: The batch id of the sheet (the id of its first upload) and whether it is a new sheet.
+	"""
+	db.ensure_schema("excel_checkpoints", SCHEMA)
+	conn = db.connect()
+	batch_id = new_run_id()
+	now = time.time()
+	with conn:
+		# the insert takes the write lock, a concurrent upload of the same sheet gets its batch id
+		cursor = conn.execute(
+		    "INSERT OR IGNORE INTO excel_sheets (sheet_hash, batch_id, filename, rows, created_at) "
+		    "VALUES (?, ?, ?, ?, ?)", (digest, batch_id, filename, len(rows), now))
+		if cursor.rowcount == 0:
+			row = conn.execute("SELECT batch_id FROM excel_sheets WHERE sheet_hash = ?",
+			                   (digest, )).fetchone()
+			return row["batch_id"], False
+		conn.executemany(
+		    "INSERT INTO excel_rows (batch_id, row, id, cas, name, status, updated_at) VALUES (?, ?, ?, ?, ?, ?, ?)",
+		    [(batch_id, index, row["id"], row["cas"], row["name"], PENDING, now)
+		     for index, row in enumerate(rows)])
+	return batch_id, True
+
+
+# Rows not done yet
+def pending_rows(batch_id):
+	"""
+	Returns:
+			list: The {"row", "id", "cas", "name"} rows of the batch that are not done.
+	"""
+	db.ensure_schema("excel_checkpoints", SCHEMA)
+	rows = db.connect().execute(
+	    "SELECT row, id, cas, name FROM excel_rows WHERE batch_id = ? AND status != ? ORDER BY row",
+	    (batch_id, DONE)).fetchall()
+	return [dict(row) for row in rows]
+
+
+# Checkpoints of some rows
+def load(batch_id, rows):
+	"""
+	Params:
+			batch_id (str): The id of the batch.
+			rows (list): The row indexes.
+
+	Returns:
+			dict: {row: {"status", "downloads", "files"}} for the rows with a checkpoint.
+	"""
+	db.ensure_schema("excel_checkpoints", SCHEMA)
+	rows = list(rows)
+	if not rows:
+		return {}
+	found = db.connect().execute(
+	    f"SELECT row, status, downloads, files FROM excel_rows WHERE batch_id = ? AND row IN ({', '.join('?' for _ in rows)})",
+	    [batch_id] + rows).fetchall()
+	return {
+	    row["row"]: {
+	        "status": row["status"],
+	        "downloads": row["downloads"],
+	        "files": json.loads(row["files"]) if row["files"] else [],
+	    }
+	    for row in found
+	}
+
+
+# Checkpoint a row
+def save(batch_id, row, status, downloads, files):
+	"""
+	Params:
+			batch_id (str): The id of the batch.
+			row (int): The index of the row in the sheet.
+			status (str): PARTIAL or DONE.
+			downloads (int): The number of MSDS downloaded for the row.
+			files (list): The downloaded files.
+	"""
+	db.ensure_schema("excel_checkpoints", SCHEMA)
+	conn = db.connect()
+	with conn:
+		conn.execute(
+		    "UPDATE excel_rows SET status = ?, downloads = ?, files = ?, updated_at = ? WHERE batch_id = ? AND row = ?",
+		    (status, downloads, json.dumps(files), time.time(), batch_id, row))
+
+
+# Progress of a batch
+def progress(batch_id):
+	"""
+	Returns:
+			dict: The number of rows of the batch by status, empty for an unknown batch.
+	"""
+	db.ensure_schema("excel_checkpoints", SCHEMA)
+	rows = db.connect().execute(
+	    "SELECT status, COUNT(*) AS count FROM excel_rows WHERE batch_id = ? GROUP BY status",
+	    (batch_id, )).fetchall()
+	return {row["status"]: row["count"] for row in rows}
+
+
+# Files of a batch
+def files(batch_id):
+	"""
+	Returns:
+			list: The {"row", "id", "cas", "name", "files"} rows of the batch with downloaded files, in sheet order.
+	"""
+	db.ensure_schema("excel_checkpoints", SCHEMA)
+	rows = db.connect().execute(
+	    "SELECT row, id, cas, name, files FROM excel_rows WHERE batch_id = ? AND downloads > 0 ORDER BY row",
+	    (batch_id, )).fetchall()
+	return [dict(row, files=json.loads(row["files"]) if row["files"] else []) for row in rows]
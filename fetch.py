@@ -0,0 +1,329 @@
+import asyncio
+import contextvars
+import os
+import random
+import time
+from collections import Counter, deque
+from urllib.parse import urlparse
+
+import aiohttp
+
+import domain_stats
+from politeness import HOSTS, parse_retry_after
+
+# Error classes of a failed attempt
+CONNECT = "connect"  # the request was not sent
+TIMEOUT = "timeout"
+THROTTLED = "throttled"  # 429, 503
+SERVER = "server"  # other 5xx
+CLIENT = "client"  # 4xx, never retried
+NETWORK = "network"  # connection reset, payload errors ...
+
+IDEMPOTENT_METHODS = ("GET", "HEAD")
+RETRYABLE_ERRORS = (CONNECT, TIMEOUT, THROTTLED, SERVER, NETWORK)
+
+# Attempt counters of the process, see stats()
+COUNTERS = Counter()
+
+# Bytes counter of the current job, see track_bytes()
+_bytes_counter = contextvars.ContextVar("bytes_counter", default=None)
+
+
+class FetchError(Exception):
+	"""
+	Raised when a fetch fails after its last attempt.
+
+	Params:
+			error_class (str): The class of the error (CONNECT, TIMEOUT, THROTTLED ...).
+			status (int, optional): The status of the response, if any.
+			retry_after (float, optional): The Retry-After of the response, in seconds.
+	"""
+
+	def __init__(self, error_class, status=None, retry_after=None, message=""):
+		super().__init__(message or f"{error_class} error" +
+		                 (f", status {status}" if status else ""))
+		self.error_class = error_class
+		self.status = status
+		self.retry_after = retry_after
+
+
+class FetchResult:
+	"""
+	The response of a fetch.
+	body is None for HEAD requests and for responses refused by the accept predicate,
+	and the result of the consumer for the consumed responses (see fetch).
+	"""
+
+	__slots__ = ("url", "status", "headers", "body", "attempts", "elapsed")
+
+	def __init__(self, url, status, headers, body, attempts=1, elapsed=0):
+		self.url = url
+		self.status = status
+		self.headers = headers
+		self.body = body
+		self.attempts = attempts
+		self.elapsed = elapsed
+
+
+class RetryPolicy:
+	"""
+	Retries, timeouts and hedging of the fetches of a crawl mode.
+
+	Params:
+			max_attempts (int, optional): The max attempts of a fetch. Defaults to 3.
+			base_delay (float, optional): The base of the exponential backoff in seconds. Defaults to 0.5.
+			max_delay (float, optional): The max backoff in seconds. Defaults to 8.
+			connect_timeout (float, optional): The connect timeout in seconds. Defaults to 5.
+			read_timeout (float, optional): The read timeout used until the latency of a host is known. Defaults to 10.
+			min_read_timeout (float, optional): The lower bound of the adaptive read timeout. Defaults to 2.
+			max_read_timeout (float, optional): The upper bound of the adaptive read timeout. Defaults to 30.
+			total_timeout (float, optional): The max seconds of an attempt. Defaults to 60.
+			hedge (bool, optional): Send a second request once a fetch passes the p95 latency of its host. Defaults to False.
+	"""
+
+	def __init__(self,
+	             max_attempts=3,
+	             base_delay=0.5,
+	             max_delay=8,
+	             connect_timeout=5,
+	             read_timeout=10,
+	             min_read_timeout=2,
+	             max_read_timeout=30,
+	             total_timeout=60,
+	             hedge=False):
+		self.max_attempts = max_attempts
+		self.base_delay = base_delay
+		self.max_delay = max_delay
+		self.connect_timeout = connect_timeout
+		self.read_timeout = read_timeout
+		self.min_read_timeout = min_read_timeout
+		self.max_read_timeout = max_read_timeout
+		self.total_timeout = total_timeout
+		self.hedge = hedge
+
+	@classmethod
+	def from_env(cls, prefix, **defaults):
+		"""
+		Build a policy from the defaults, overridden by the <prefix>_<PARAM>
+		environment variables (eg. SCOUT_FETCH_MAX_ATTEMPTS=5, SCOUT_FETCH_HEDGE=1).
+		"""
+		params = dict(defaults)
+		for param in ("max_attempts", "base_delay", "max_delay", "connect_timeout",
+		              "read_timeout", "min_read_timeout", "max_read_timeout",
+		              "total_timeout", "hedge"):
+			value = os.environ.get(f"{prefix}_{param.upper()}")
+			if value is None:
+				continue
+			if param == "hedge":
+				params[param] = value.lower() in ("1", "true", "yes")
+			elif param == "max_attempts":
+				params[param] = int(value)
+			else:
+				params[param] = float(value)
+		return cls(**params)
+
+	def should_retry(self, method, error, attempt):
+		if attempt >= self.max_attempts or error.error_class not in RETRYABLE_ERRORS:
+			return False
+		# a non idempotent request is only retried if it was never sent
+		return method in IDEMPOTENT_METHODS or error.error_class == CONNECT
+
+	def backoff(self, attempt, retry_after=None):
+		"""
+		Returns:
+				float: The seconds to wait before the next attempt (exponential backoff with full jitter).
+		"""
+		delay = random.uniform(0, min(self.max_delay, self.base_delay * 2**attempt))
+		if retry_after:
+			delay = max(delay, min(retry_after, self.max_delay))
+		return delay
+
+
+class LatencyTracker:
+	"""
+	The recent fetch latencies of every host, used to adapt the read timeouts
+	and to decide when to hedge.
+	"""
+
+	def __init__(self, window=50, min_samples=10):
+		self.window = window
+		self.min_samples = min_samples
+		self.samples = {}
+
+	def record(self, host, latency):
+		if host not in self.samples:
+			self.samples[host] = deque(maxlen=self.window)
+		self.samples[host].append(latency)
+
+	def percentile(self, host, q):
+		samples = self.samples.get(host)
+		if not samples or len(samples) < self.min_samples:
+			return None
+		ordered = sorted(samples)
+		return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+	def read_timeout(self, host, policy):
+		p95 = self.percentile(host, 0.95)
+		if p95 is None:
+			return policy.read_timeout
+		return min(policy.max_read_timeout, max(policy.min_read_timeout, 3 * p95))
+
+	def snapshot(self):
+		return {
+		    host: {
+		        "samples": len(samples),
+		        "p50": self.percentile(host, 0.5),
+		        "p95": self.percentile(host, 0.95),
+		    }
+		    for host, samples in self.samples.items()
+		}
+
+
+LATENCY = LatencyTracker()
+
+
+# Classify a status
+def _status_error(status, headers):
+	if status in (429, 503):
+		return FetchError(THROTTLED, status, parse_retry_after(headers.get("Retry-After")))
+	if status >= 500:
+		return FetchError(SERVER, status)
+	return FetchError(CLIENT, status)
+
+
+# One attempt
+async def _attempt(session, url, method, policy, accept, host, headers=None, consume=None):
+	timeout = aiohttp.ClientTimeout(total=policy.total_timeout,
+	                                sock_connect=policy.connect_timeout,
+	                                sock_read=LATENCY.read_timeout(host, policy))
+	try:
+		async with HOSTS.slot(url) as slot:
+			# the latency is measured once the slot is acquired, without the politeness wait
+			started = time.monotonic()
+			async with session.request(method, url, timeout=timeout, headers=headers,
+			                           allow_redirects=True) as response:
+				slot.record(response.status, response.headers)
+				if response.status >= 400:
+					raise _status_error(response.status, response.headers)
+				body = None
+				if method != "HEAD" and (accept is None or accept(response.headers)):
+					body = await (consume(response) if consume else response.read())
+				result = FetchResult(str(response.url), response.status, response.headers, body)
+				nbytes = response.content.total_bytes if consume else len(body or b"")
+	except asyncio.TimeoutError:
+		raise FetchError(TIMEOUT, message=f"timeout fetching {url}")
+	except aiohttp.ClientConnectorError as e:
+		raise FetchError(CONNECT, message=str(e))
+	except aiohttp.ClientError as e:
+		raise FetchError(NETWORK, message=str(e))
+
+	latency = time.monotonic() - started
+	LATENCY.record(host, latency)
+	domain_stats.record_fetch(url, nbytes, latency)
+	counter = _bytes_counter.get()
+	if counter is not None:
+		counter[0] += nbytes
+	return result
+
+
+# One attempt, hedged with a second request once it passes the host p95
+async def _hedged_attempt(session, url, method, policy, accept, host, headers=None, consume=None):
+	delay = LATENCY.percentile(host, 0.95) if policy.hedge and method in IDEMPOTENT_METHODS else None
+	if delay is None:
+		return await _attempt(session, url, method, policy, accept, host, headers, consume)
+
+	tasks = [asyncio.ensure_future(_attempt(session, url, method, policy, accept, host, headers, consume))]
+	try:
+		done, _ = await asyncio.wait(tasks, timeout=delay)
+		if not done:
+			COUNTERS["hedges"] += 1
+			tasks.append(asyncio.ensure_future(_attempt(session, url, method, policy, accept, host, headers, consume)))
+
+		pending, error = set(tasks), None
+		while pending:
+			done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+			for task in done:
+				if task.exception() is None:
+					if len(tasks) > 1 and task is tasks[1]:
+						COUNTERS["hedge_wins"] += 1
+					return task.result()
+				error = task.exception()
+		raise error
+	finally:
+		for task in tasks:
+			if not task.done():
+				task.cancel()
+
+
+# Fetch a url
+async def fetch(session, url, method="GET", policy=None, accept=None, headers=None, consume=None):
+	"""
+	Fetch a url through the host scheduler, retrying the transient failures
+	with a jittered exponential backoff.
+
+	Params:
+			session (aiohttp.ClientSession): The session to use for the request.
+			url (str): The url to fetch.
+			method (str, optional): The http method. Defaults to GET.
+			policy (RetryPolicy, optional): The retry policy. Defaults to DEFAULT_POLICY.
+			accept (callable, optional): Called with the response headers, the body is only read if it returns True.
+			headers (dict, optional): The headers of the request (eg. Range).
+			consume (callable, optional): An async function called with the response instead of reading the
+			body (eg. to stream parse it), its result is the body of the result. Called again on a retry.
+
+	Returns:
+			FetchResult: The response.
+
+	Raises:
+			FetchError: If the last attempt failed.
+	"""
+	policy = policy or DEFAULT_POLICY
+	host = urlparse(url).netloc.lower()
+	started = time.monotonic()
+	attempt = 0
+	while True:
+		attempt += 1
+		COUNTERS["attempts"] += 1
+		try:
+			result = await _hedged_attempt(session, url, method, policy, accept, host, headers, consume)
+			COUNTERS["successes"] += 1
+			result.attempts = attempt
+			result.elapsed = time.monotonic() - started
+			return result
+		except FetchError as e:
+			COUNTERS[f"error:{e.error_class}"] += 1
+			domain_stats.record_fetch(url, error=True)
+			if not policy.should_retry(method, e, attempt):
+				COUNTERS["failures"] += 1
+				raise
+			COUNTERS["retries"] += 1
+			await asyncio.sleep(policy.backoff(attempt, e.retry_after))
+
+
+# Count the bytes fetched by the current task
+def track_bytes():
+	"""
+	Count the bytes fetched from now on by the current task and the tasks it creates.
+
+	Returns:
+			tuple: The counter (a list, counter[0] is the byte count) and the token
+			to pass to untrack_bytes.
+	"""
+	counter = [0]
+	return counter, _bytes_counter.set(counter)
+
+
+def untrack_bytes(token):
+	_bytes_counter.reset(token)
+
+
+# Fetch stats
+def stats():
+	"""
+	Returns:
+			dict: The attempt counters and the latency of every host.
+	"""
+	return {"counters": dict(COUNTERS), "latency": LATENCY.snapshot()}
+
+
+DEFAULT_POLICY = RetryPolicy()
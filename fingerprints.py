@@ -0,0 +1,151 @@
+import hashlib
+import math
+from array import array
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+# Canonical form of a url
+def canonical_url(url):
+	"""
+	Lower case scheme and host, no default port, no user info, no fragment, sorted
+	query parameters and "/" for an empty path, so that the variants of a url share
+	the same fingerprint.
+
+	Params:
+			url (str): The url.
+
+	Returns:
+			str: The canonical url.
+	"""
+	try:
+		parts = urlsplit(url.strip())
+		scheme = parts.scheme.lower()
+		host = (parts.hostname or "").lower()
+		port = parts.port
+	except ValueError:
+		return url.split("#", 1)[0]
+	netloc = host if port is None or DEFAULT_PORTS.get(scheme) == port else f"{host}:{port}"
+	query = urlencode(sorted(parse_qsl(parts.query, keep_blank_values=True)))
+	return urlunsplit((scheme, netloc, parts.path or "/", query, ""))
+
+
+# 64-bit fingerprint of a url
+def fingerprint(url):
+	"""
+	Returns:
+			int: The blake2b hash of the canonical url, an unsigned 64-bit integer.
+	"""
+	digest = hashlib.blake2b(canonical_url(url).encode("utf-8", "surrogatepass"), digest_size=8).digest()
+	return int.from_bytes(digest, "little")
+
+
+class FingerprintSet:
+	"""
+	A set of urls stored as their 64-bit fingerprints in an open addressing table
+	(array of unsigned 64-bit integers, linear probing), about 8 to 16 bytes per url
+	instead of the url string and its set entry. Two urls with the same fingerprint
+	are the same url for the set (about one chance in 10^8 per million urls).
+
+	Params:
+			capacity (int, optional): The number of urls expected, the table grows as needed. Defaults to 1024.
+	"""
+
+	__slots__ = ("table", "mask", "count")
+
+	# the table grows once it is this full
+	MAX_LOAD = 2 / 3
+
+	def __init__(self, capacity=1024):
+		size = 8
+		while size * self.MAX_LOAD < capacity:
+			size *= 2
+		self.table = array("Q", bytes(8 * size))
+		self.mask = size - 1
+		self.count = 0
+
+	@staticmethod
+	def _key(url):
+		# 0 marks the empty slots
+		return fingerprint(url) or 1
+
+	def _slot(self, key):
+		index = key & self.mask
+		table = self.table
+		while table[index] and table[index] != key:
+			index = (index + 1) & self.mask
+		return index
+
+	def _grow(self):
+		keys = [key for key in self.table if key]
+		self.table = array("Q", bytes(16 * len(self.table)))
+		self.mask = len(self.table) - 1
+		for key in keys:
+			self.table[self._slot(key)] = key
+
+	def add(self, url):
+		"""
+		Returns:
+				bool: True if the url was not in the set.
+		"""
+		key = self._key(url)
+		index = self._slot(key)
+		if self.table[index]:
+			return False
+		self.table[index] = key
+		self.count += 1
+		if self.count > len(self.table) * self.MAX_LOAD:
+			self._grow()
+		return True
+
+	def __contains__(self, url):
+		return bool(self.table[self._slot(self._key(url))])
+
+	def __len__(self):
+		return self.count
+
+	@property
+	def nbytes(self):
+		return self.table.itemsize * len(self.table)
+
+
+class BloomFilter:
+	"""
+	A Bloom filter of urls: no false negatives, false positives at about `error_rate`
+	until `capacity` urls are added. The bit positions are derived from the 64-bit
+	fingerprint of the url (double hashing).
+
+	Params:
+			capacity (int): The number of urls expected.
+			error_rate (float, optional): The false positive rate at capacity. Defaults to 0.01.
+	"""
+
+	__slots__ = ("bits", "size", "hashes", "count")
+
+	def __init__(self, capacity, error_rate=0.01):
+		capacity = max(capacity, 1)
+		self.size = max(64, math.ceil(-capacity * math.log(error_rate) / math.log(2)**2))
+		self.hashes = max(1, round(self.size / capacity * math.log(2)))
+		self.bits = bytearray((self.size + 7) // 8)
+		self.count = 0
+
+	def _positions(self, url):
+		key = fingerprint(url)
+		low, high = key & 0xFFFFFFFF, (key >> 32) | 1
+		return [(low + i * high) % self.size for i in range(self.hashes)]
+
+	def add(self, url):
+		for position in self._positions(url):
+			self.bits[position >> 3] |= 1 << (position & 7)
+		self.count += 1
+
+	def __contains__(self, url):
+		return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self._positions(url))
+
+	def __len__(self):
+		return self.count
+
+	@property
+	def nbytes(self):
+		return len(self.bits)
@@ -0,0 +1,370 @@
+import json
+import os
+import time
+import uuid
+from urllib.parse import urlparse
+
+import db
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+	id TEXT PRIMARY KEY,
+	kind TEXT NOT NULL,
+	payload TEXT NOT NULL,
+	status TEXT NOT NULL,
+	priority INTEGER NOT NULL DEFAULT 0,
+	batch_id TEXT,
+	attempts INTEGER NOT NULL DEFAULT 0,
+	worker TEXT,
+	lease_until REAL,
+	result TEXT,
+	error TEXT,
+	created_at REAL NOT NULL,
+	updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_claim ON jobs (status, priority DESC, created_at);
+CREATE INDEX IF NOT EXISTS idx_jobs_batch_id ON jobs (batch_id);
+"""
+
+# Job status
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+# A claimed job is given back to the queue if its worker does not renew the lease in time
+DEFAULT_LEASE = 15 * 60
+MAX_ATTEMPTS = 3
+
+# Priorities: the live lookups (a client is waiting) are claimed before the excel
+# jobs (priority 0), the refreshes of the popular queries come last (see popularity.py)
+LIVE_PRIORITY = 10
+# Kinds of job a client is waiting for
+LIVE_KINDS = ("scout", "scout_batch")
+
+# Hosts a remote queue may be on. The workers write the pdfs, the reports, the excel
+# checkpoints and the caches to the folders and the database of their host, which the
+# API serves, so they must run on the host of the API.
+LOCAL_HOSTS = ("localhost", "127.0.0.1", "::1")
+
+
+class JobQueue:
+	"""
+	Interface of the work queues.
+	The API processes enqueue the jobs, the crawler workers (see worker.py)
+	claim them, run them and report the result.
+	"""
+
+	def enqueue(self, kind, payload, priority=0, batch_id=None):
+		"""
+		Params:
+				kind (str): The kind of job (eg. "scout", "excel_batch").
+				payload (dict): The JSON serializable arguments of the job.
+				priority (int, optional): Jobs with a higher priority are claimed first. Defaults to 0.
+				batch_id (str, optional): The id grouping the jobs of a batch (eg. an excel file).
+
+		Returns:
+				str: The job id.
+		"""
+		return self.enqueue_many(kind, [payload], priority, batch_id)[0]
+
+	def enqueue_many(self, kind, payloads, priority=0, batch_id=None):
+		raise NotImplementedError
+
+	def claim(self, worker, kinds=None, lease=DEFAULT_LEASE):
+		"""
+		Claim the next pending job.
+
+		Params:
+				worker (str): The id of the claiming worker.
+				kinds (list, optional): Only claim these kinds of job.
+				lease (int, optional): The seconds the job stays claimed without a renewal.
+
+		Returns:
+				dict: The job, or None if the queue is empty.
+		"""
+		raise NotImplementedError
+
+	def extend(self, job_id, worker, lease=DEFAULT_LEASE):
+		raise NotImplementedError
+
+	def complete(self, job_id, worker, result=None):
+		raise NotImplementedError
+
+	def fail(self, job_id, worker, error, retry=True):
+		raise NotImplementedError
+
+	def get(self, job_id):
+		raise NotImplementedError
+
+	def batch_status(self, batch_id):
+		"""
+		Returns:
+				dict: The number of jobs of the batch by status.
+		"""
+		raise NotImplementedError
+
+	def pending_count(self, min_priority=None):
+		raise NotImplementedError
+
+
+class SQLiteJobQueue(JobQueue):
+	"""
+	Queue stored in the SQLite database of the host.
+	Claims run in an immediate transaction, which takes the database write lock,
+	so any number of processes of the same host can share the queue.
+	"""
+
+	def _conn(self):
+		db.ensure_schema("jobs", SCHEMA)
+		return db.connect()
+
+	def enqueue_many(self, kind, payloads, priority=0, batch_id=None):
+		now = time.time()
+		rows = [(uuid.uuid4().hex, kind, json.dumps(payload), PENDING, priority,
+		         batch_id, now, now) for payload in payloads]
+		conn = self._conn()
+		with conn:
+			conn.executemany(
+			    "INSERT INTO jobs (id, kind, payload, status, priority, batch_id, created_at, updated_at) "
+			    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)", rows)
+		return [row[0] for row in rows]
+
+	def claim(self, worker, kinds=None, lease=DEFAULT_LEASE):
+		conn = self._conn()
+		now = time.time()
+		kind_clause, args = "", []
+		if kinds:
+			kind_clause = f"AND kind IN ({', '.join('?' for _ in kinds)})"
+			args = list(kinds)
+		conn.execute("BEGIN IMMEDIATE")
+		try:
+			# a job that lost its worker MAX_ATTEMPTS times (killed or hung by the job) is not run again
+			conn.execute(
+			    "UPDATE jobs SET status = ?, error = ?, worker = NULL, lease_until = NULL, updated_at = ? "
+			    "WHERE status = ? AND lease_until < ? AND attempts >= ?",
+			    (FAILED, f"Lease expired after {MAX_ATTEMPTS} attempts", now, RUNNING, now, MAX_ATTEMPTS))
+			# pending jobs, or running jobs whose worker stopped renewing the lease
+			row = conn.execute(
+			    f"SELECT * FROM jobs WHERE (status = ? OR (status = ? AND lease_until < ?)) {kind_clause} "
+			    "ORDER BY priority DESC, created_at LIMIT 1",
+			    [PENDING, RUNNING, now] + args).fetchone()
+			if row is None:
+				conn.commit()
+				return None
+			conn.execute(
+			    "UPDATE jobs SET status = ?, worker = ?, lease_until = ?, attempts = attempts + 1, "
+			    "updated_at = ? WHERE id = ?",
+			    (RUNNING, worker, now + lease, now, row["id"]))
+			conn.commit()
+		except Exception:
+			conn.rollback()
+			raise
+		job = self._to_dict(row)
+		job.update(status=RUNNING, worker=worker, attempts=row["attempts"] + 1)
+		return job
+
+	def extend(self, job_id, worker, lease=DEFAULT_LEASE):
+		conn = self._conn()
+		with conn:
+			cursor = conn.execute(
+			    "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND worker = ? AND status = ?",
+			    (time.time() + lease, time.time(), job_id, worker, RUNNING))
+		return cursor.rowcount == 1
+
+	def complete(self, job_id, worker, result=None):
+		conn = self._conn()
+		with conn:
+			conn.execute(
+			    "UPDATE jobs SET status = ?, result = ?, lease_until = NULL, updated_at = ? "
+			    "WHERE id = ? AND worker = ?",
+			    (DONE, json.dumps(result), time.time(), job_id, worker))
+
+	def fail(self, job_id, worker, error, retry=True):
+		conn = self._conn()
+		with conn:
+			row = conn.execute("SELECT attempts FROM jobs WHERE id = ?", (job_id, )).fetchone()
+			status = PENDING if retry and row and row["attempts"] < MAX_ATTEMPTS else FAILED
+			conn.execute(
+			    "UPDATE jobs SET status = ?, error = ?, worker = NULL, lease_until = NULL, updated_at = ? "
+			    "WHERE id = ? AND worker = ?",
+			    (status, str(error), time.time(), job_id, worker))
+
+	def get(self, job_id):
+		row = self._conn().execute("SELECT * FROM jobs WHERE id = ?", (job_id, )).fetchone()
+		return self._to_dict(row) if row else None
+
+	def batch_status(self, batch_id):
+		rows = self._conn().execute(
+		    "SELECT status, COUNT(*) AS count FROM jobs WHERE batch_id = ? GROUP BY status",
+		    (batch_id, )).fetchall()
+		return {row["status"]: row["count"] for row in rows}
+
+	def pending_count(self, min_priority=None):
+		query = "SELECT COUNT(*) FROM jobs WHERE status = ?"
+		args = [PENDING]
+		if min_priority is not None:
+			query += " AND priority >= ?"
+			args.append(min_priority)
+		return self._conn().execute(query, args).fetchone()[0]
+
+	@staticmethod
+	def _to_dict(row):
+		job = dict(row)
+		job["payload"] = json.loads(job["payload"])
+		job["result"] = json.loads(job["result"]) if job["result"] else None
+		return job
+
+
+class RemoteJobQueue(JobQueue):
+	"""
+	Queue hosted by another process (the API). Every operation is sent through a transport,
+	a callable `transport(op, args) -> result`, so the network backend is pluggable.
+	Only the jobs go through the queue, the workers share the folders and the database
+	of the API, see LOCAL_HOSTS.
+
+	Params:
+			transport (callable): The transport of the operations (eg. HttpTransport).
+	"""
+
+	OPERATIONS = ("enqueue_many", "claim", "extend", "complete", "fail", "get",
+	              "batch_status", "pending_count")
+
+	def __init__(self, transport):
+		self.transport = transport
+
+	def enqueue_many(self, kind, payloads, priority=0, batch_id=None):
+		return self.transport("enqueue_many", {
+		    "kind": kind,
+		    "payloads": payloads,
+		    "priority": priority,
+		    "batch_id": batch_id
+		})
+
+	def claim(self, worker, kinds=None, lease=DEFAULT_LEASE):
+		return self.transport("claim", {"worker": worker, "kinds": kinds, "lease": lease})
+
+	def extend(self, job_id, worker, lease=DEFAULT_LEASE):
+		return self.transport("extend", {"job_id": job_id, "worker": worker, "lease": lease})
+
+	def complete(self, job_id, worker, result=None):
+		return self.transport("complete", {"job_id": job_id, "worker": worker, "result": result})
+
+	def fail(self, job_id, worker, error, retry=True):
+		return self.transport("fail", {
+		    "job_id": job_id,
+		    "worker": worker,
+		    "error": str(error),
+		    "retry": retry
+		})
+
+	def get(self, job_id):
+		return self.transport("get", {"job_id": job_id})
+
+	def batch_status(self, batch_id):
+		return self.transport("batch_status", {"batch_id": batch_id})
+
+	def pending_count(self, min_priority=None):
+		return self.transport("pending_count", {"min_priority": min_priority})
+
+
+class LocalTransport:
+	"""
+	Transport calling a queue of the same process. It stands in for the network
+	when running or testing the remote backend locally, and is used by the
+	/queue/{op} endpoint to serve the remote workers.
+
+	Params:
+			queue (JobQueue): The queue serving the operations.
+	"""
+
+	def __init__(self, queue):
+		self.queue = queue
+
+	def __call__(self, op, args):
+		if op not in RemoteJobQueue.OPERATIONS:
+			raise ValueError(f"Unknown queue operation {op}")
+		# round trip through JSON, as over the network
+		args = json.loads(json.dumps(args))
+		return json.loads(json.dumps(getattr(self.queue, op)(**args)))
+
+
+class HttpTransport:
+	"""
+	Transport posting the operations to the /queue/{op} endpoint of the API
+	hosting the queue.
+
+	Params:
+			base_url (str): The url of the API hosting the queue.
+			token (str, optional): The shared secret of the queue endpoint.
+			timeout (int, optional): The timeout of a request in seconds. Defaults to 30.
+	"""
+
+	def __init__(self, base_url, token=None, timeout=30):
+		self.base_url = base_url.rstrip("/")
+		self.token = token
+		self.timeout = timeout
+
+	def __call__(self, op, args):
+		import requests
+
+		response = requests.post(f"{self.base_url}/queue/{op}",
+		                         json=args,
+		                         headers={"X-Queue-Token": self.token or ""},
+		                         timeout=self.timeout)
+		response.raise_for_status()
+		return response.json()
+
+
+_queue = None
+
+
+# Get the configured queue
+def get_queue():
+	"""
+	Return the queue of the process: a RemoteJobQueue when SCOUT_QUEUE_URL is set
+	(an API of the same host), the SQLite queue of the host otherwise.
+
+	Raises:
+			ValueError: If SCOUT_QUEUE_URL is not on this host.
+	"""
+	global _queue
+	if _queue is None:
+		queue_url = os.environ.get("SCOUT_QUEUE_URL")
+		if queue_url:
+			if urlparse(queue_url).hostname not in LOCAL_HOSTS:
+				raise ValueError(f"SCOUT_QUEUE_URL {queue_url} is not on this host, the workers "
+				                 "store their pdfs, reports and checkpoints on the host of the API")
+			_queue = RemoteJobQueue(HttpTransport(queue_url, os.environ.get("SCOUT_QUEUE_TOKEN")))
+		else:
+			_queue = SQLiteJobQueue()
+	return _queue
+
+
+# Wait for a job
+async def wait_for(queue, job_id, timeout=None, poll_interval=0.5):
+	"""
+	Wait until a job is done or failed.
+
+	Params:
+			queue (JobQueue): The queue of the job.
+			job_id (str): The id of the job.
+			timeout (int, optional): The max seconds to wait. Waits forever if not provided.
+			poll_interval (float, optional): The seconds between two polls. Defaults to 0.5.
+
+	Returns:
+			dict: The job, or None if the job does not exist.
+
+	Raises:
+			TimeoutError: If the job is not finished in time.
+	"""
+	import asyncio
+
+	deadline = time.monotonic() + timeout if timeout else None
+	while True:
+		job = await asyncio.to_thread(queue.get, job_id)
+		if job is None or job["status"] in (DONE, FAILED):
+			return job
+		if deadline and time.monotonic() > deadline:
+			raise TimeoutError(f"Job {job_id} not finished after {timeout} seconds")
+		await asyncio.sleep(poll_interval)
@@ -1,15 +1,83 @@
+import asyncio
+import hmac
 import os
+from contextlib import asynccontextmanager
+
 import uvicorn
-from fastapi import FastAPI, UploadFile, HTTPException
-from fastapi.responses import HTMLResponse, JSONResponse
+from fastapi import FastAPI, UploadFile, HTTPException, Request, Query
+from fastapi.responses import HTMLResponse, JSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
-from starlette.status import HTTP_200_OK, HTTP_400_BAD_REQUEST, HTTP_500_INTERNAL_SERVER_ERROR
-import re
-from scout import scout
-from scout_excel import process_excel
+from starlette.status import HTTP_200_OK, HTTP_202_ACCEPTED, HTTP_400_BAD_REQUEST, HTTP_403_FORBIDDEN, HTTP_404_NOT_FOUND, HTTP_500_INTERNAL_SERVER_ERROR, HTTP_504_GATEWAY_TIMEOUT
+import uuid
+import scout
+import scout_excel
+import excel_checkpoints
+import report_store
+import storage_manager
+import pdf_server
+import job_queue
+import worker
+from politeness import HOSTS
+import fetch
+import negative_cache
+import discovery
+import domain_stats
+import scout_batch
+import crawler
+from crawler import partial_fetch
+import normalize
+import result_cache
+import popularity
+import profiler
+import zip_export
+
+# Number of crawler workers running in the API process (more can run with worker.py)
+INLINE_WORKERS = int(os.environ.get("SCOUT_INLINE_WORKERS", 4))
+# Workers of the API process reserved to the live lookups, on top of the inline workers
+LIVE_WORKERS = int(os.environ.get("SCOUT_LIVE_WORKERS", 1))
+# Max seconds a single lookup waits for its job
+SCOUT_TIMEOUT = int(os.environ.get("SCOUT_TIMEOUT_SECONDS", 900))
+# Import the heavy dependencies of the crawl in the background at startup
+PREWARM = os.environ.get("SCOUT_PREWARM", "").lower() in ("1", "true", "yes")
+# Lookups waiting for their job, {canonical key: job id}
+_running_lookups = {}
+# Shared secret of the /queue endpoint used by the remote workers (disabled if not set)
+QUEUE_TOKEN = os.environ.get("SCOUT_QUEUE_TOKEN")
+# Shared secret of the admin features, eg. profiled lookups (disabled if not set)
+ADMIN_TOKEN = os.environ.get("SCOUT_ADMIN_TOKEN")
+
+
+# App startup and shutdown
+@asynccontextmanager
+async def lifespan(app):
+	# create the directories
+	scout.setup_folders()
+	scout_excel.setup_folders()
+	os.makedirs(UPLOAD_DIR, exist_ok=True)
+	if PREWARM:
+		asyncio.create_task(asyncio.to_thread(worker.prewarm))
+
+	# start the background tasks
+	lag_monitor = profiler.watch_loop()
+	storage_task = asyncio.create_task(storage_manager.run_periodically())
+	refresh_task = asyncio.create_task(popularity.run_periodically())
+	worker_tasks = worker.start_workers(INLINE_WORKERS)
+	# a lookup never waits for the long excel jobs to free a worker
+	worker_tasks += worker.start_workers(LIVE_WORKERS, kinds=job_queue.LIVE_KINDS)
+	yield
+	lag_monitor.stop()
+	storage_task.cancel()
+	refresh_task.cancel()
+	for task in worker_tasks:
+		task.cancel()
+	await asyncio.gather(*worker_tasks, return_exceptions=True)
+	domain_stats.flush()
+	popularity.flush()
+	storage_manager.flush_access()
 
-app = FastAPI()
+
+app = FastAPI(lifespan=lifespan)
 
 #cors
 app.add_middleware(
@@ -20,9 +88,8 @@ app.add_middleware(
     allow_headers=["*"],  # Allow all headers
 )
 
-# Excel file upload directory
+# Excel file upload directory (created at startup)
 UPLOAD_DIR = "./uploads"
-os.makedirs(UPLOAD_DIR, exist_ok=True)
 
 #static routes
 app.mount("/public", StaticFiles(directory="public"), name="public")
@@ -44,22 +111,129 @@ def home():
 
 # Scout route
 @app.get("/scout/{cas_or_name}")
-async def run_scout(cas_or_name: str):
+async def run_scout(cas_or_name: str, request: Request, profile: bool = False):
 	if cas_or_name is None:
 		raise HTTPException(status_code=HTTP_400_BAD_REQUEST,
 		                    detail="No input provided.")
 
-	# identify cas or name
-	cas_pattern = r'^\d{2,7}-\d{2}-\d$'
-	match = re.match(cas_pattern, cas_or_name)
-
+	# identify cas or name, reject the invalid CAS numbers up front
 	try:
-		if match:
-			response = await scout(cas=cas_or_name, name=None)
+		if normalize.is_cas(cas_or_name):
+			cas, name = normalize.normalize_query(cas=cas_or_name)
 		else:
-			response = await scout(cas=None, name=cas_or_name)
+			cas, name = normalize.normalize_query(name=cas_or_name)
+	except normalize.InvalidQuery as e:
+		return JSONResponse(status_code=HTTP_400_BAD_REQUEST,
+		                    content={"error": str(e)})
+
+	# equivalent queries share the cached result and the running job
+	key = normalize.canonical_key(cas, name)
+	# the profile flag of a client without the admin token is ignored
+	if (profile or request.headers.get("x-scout-profile")) and \
+	   _has_token(request, "x-admin-token", ADMIN_TOKEN):
+		return await _run_profiled_scout(key, cas, name)
+	cached = await asyncio.to_thread(result_cache.get, key)
+	popularity.record_request(key, cas, name, hit=cached is not None)
+	if cached is not None:
+		return JSONResponse(status_code=HTTP_200_OK, content=cached)
 
-		return JSONResponse(status_code=HTTP_200_OK, content=response)
+	try:
+		# enqueue the lookup and wait for a crawler worker to run it
+		queue = job_queue.get_queue()
+		job_id = _running_lookups.get(key)
+		if job_id is None:
+			payload = {"cas": cas, "name": name}
+			job_id = await asyncio.to_thread(queue.enqueue, "scout", payload,
+			                                 job_queue.LIVE_PRIORITY)
+			_running_lookups[key] = job_id
+		try:
+			job = await job_queue.wait_for(queue, job_id, timeout=SCOUT_TIMEOUT)
+		finally:
+			if _running_lookups.get(key) == job_id:
+				del _running_lookups[key]
+		if job is None:
+			raise Exception(f"Job {job_id} not found")
+		if job["status"] == job_queue.FAILED:
+			raise Exception(job["error"])
+
+		await asyncio.to_thread(result_cache.put, key, job["result"])
+		return JSONResponse(status_code=HTTP_200_OK, content=job["result"])
+	except TimeoutError as e:
+		return JSONResponse(status_code=HTTP_504_GATEWAY_TIMEOUT,
+		                    content={"error": str(e)})
+	except Exception as e:
+		return JSONResponse(status_code=HTTP_500_INTERNAL_SERVER_ERROR,
+		                    content={"error": str(e)})
+
+
+# Run a lookup in the API process and save its sampling profile to ./logs (admin only)
+async def _run_profiled_scout(key, cas, name):
+	# the lookup skips the cache and the queue, so that the crawl is the one profiled
+	task = asyncio.create_task(scout.scout(cas, name))
+	try:
+		path = await profiler.profile_task(task, f"scout_{key}")
+	except Exception as e:
+		return JSONResponse(status_code=HTTP_500_INTERNAL_SERVER_ERROR,
+		                    content={"error": str(e)})
+	await asyncio.to_thread(result_cache.put, key, task.result())
+	return JSONResponse(status_code=HTTP_200_OK,
+	                    content=task.result(),
+	                    headers={"X-Scout-Profile-File": path})
+
+
+# Learned synonyms of a chemical
+@app.get("/synonyms/{cas_or_name}")
+def get_synonyms(cas_or_name: str):
+	if normalize.is_cas(cas_or_name):
+		return JSONResponse(status_code=HTTP_200_OK,
+		                    content=normalize.synonyms(cas=cas_or_name.strip()))
+	return JSONResponse(status_code=HTTP_200_OK,
+	                    content=normalize.synonyms(name=cas_or_name))
+
+
+# Scout a batch of chemicals with a single crawl
+@app.post("/scout/batch")
+async def run_scout_batch(body: dict):
+	queries = body.get("queries")
+	if not isinstance(queries, list) or not queries:
+		return JSONResponse(status_code=HTTP_400_BAD_REQUEST,
+		                    content={"error": "A non empty list of queries is expected."})
+	if len(queries) > scout_batch.MAX_BATCH_SIZE:
+		return JSONResponse(
+		    status_code=HTTP_400_BAD_REQUEST,
+		    content={"error": f"At most {scout_batch.MAX_BATCH_SIZE} queries are accepted."})
+	if not all(isinstance(q, dict) for q in queries):
+		return JSONResponse(status_code=HTTP_400_BAD_REQUEST,
+		                    content={"error": "Every query needs a cas or a name."})
+	for q in queries:
+		try:
+			normalize.normalize_query(q.get("cas"), q.get("name"))
+		except normalize.InvalidQuery as e:
+			return JSONResponse(status_code=HTTP_400_BAD_REQUEST,
+			                    content={"error": f"Query {q.get('id')}: {e}"})
+
+	try:
+		# enqueue the batch and wait for a crawler worker to run it
+		queue = job_queue.get_queue()
+		payload = {
+		    "queries": [{
+		        "id": q.get("id"),
+		        "cas": q.get("cas"),
+		        "name": q.get("name")
+		    } for q in queries]
+		}
+		job_id = await asyncio.to_thread(queue.enqueue, "scout_batch", payload,
+		                                 job_queue.LIVE_PRIORITY)
+		job = await job_queue.wait_for(queue, job_id, timeout=SCOUT_TIMEOUT)
+		if job is None:
+			raise Exception(f"Job {job_id} not found")
+		if job["status"] == job_queue.FAILED:
+			raise Exception(job["error"])
+
+		return JSONResponse(status_code=HTTP_200_OK, content=job["result"])
+	except TimeoutError as e:
+		return JSONResponse(status_code=HTTP_504_GATEWAY_TIMEOUT,
+		                    content={"error": str(e)})
 	except Exception as e:
 		return JSONResponse(status_code=HTTP_500_INTERNAL_SERVER_ERROR,
 		                    content={"error": str(e)})
@@ -84,17 +258,20 @@ async def run_scout_excel(file: UploadFile):
 			    })
 
 		# save file to the uploads directory
-		file_location = os.path.join(UPLOAD_DIR, file.filename)
+		file_location = os.path.join(UPLOAD_DIR,
+		                             uuid.uuid4().hex[:8] + "_" + file.filename)
 		with open(file_location, "wb") as f:
 			contents = await file.read()
 			f.write(contents)
 
-		# process excel file (scout the excel file)
-		await process_excel(file_location)
+		# enqueue the rows of the excel file, the crawler workers process them
+		batch_id = await asyncio.to_thread(scout_excel.process_excel, file_location)
 
-		return JSONResponse(
-		    status_code=HTTP_200_OK,
-		    content={"message": "The excel file is processed."})
+		return JSONResponse(status_code=HTTP_202_ACCEPTED,
+		                    content={
+		                        "message": "The excel file is queued.",
+		                        "job_id": batch_id
+		                    })
 
 	except Exception as e:
 		# report to the user
@@ -104,15 +281,219 @@ async def run_scout_excel(file: UploadFile):
 
 	finally:
 		# Delete the created file
-		os.remove(file_location)
+		if file_location:
+			os.remove(file_location)
+
+
+# Status of an excel job
+@app.get("/jobs/{job_id}")
+def get_job_status(job_id: str):
+	status = job_queue.get_queue().batch_status(job_id)
+	if not status:
+		raise HTTPException(status_code=HTTP_404_NOT_FOUND,
+		                    detail="Job not found.")
+	finished = sum(status.get(s, 0) for s in (job_queue.DONE, job_queue.FAILED))
+	return JSONResponse(status_code=HTTP_200_OK,
+	                    content={
+	                        "job_id": job_id,
+	                        "jobs": status,
+	                        "rows": excel_checkpoints.progress(job_id),
+	                        "finished": finished == sum(status.values()),
+	                        "report": f"/reports?run_id={job_id}&source=excel",
+	                    })
+
+
+# Zip of the pdfs of an excel job
+@app.api_route("/jobs/{job_id}/pdfs.zip", methods=["GET", "HEAD"])
+def export_job_pdfs(job_id: str, request: Request):
+	if not excel_checkpoints.progress(job_id):
+		raise HTTPException(status_code=HTTP_404_NOT_FOUND,
+		                    detail="Job not found.")
+	archive = zip_export.ZipArchive(zip_export.job_entries(job_id))
+	return zip_export.ZipResponse(archive, f"scout_{job_id}.zip", request.headers,
+	                              method=request.method)
+
+
+# Zip of the pdfs found by the lookups of some queries
+@app.api_route("/pdfs.zip", methods=["GET", "HEAD"])
+def export_lookup_pdfs(request: Request, q: list[str] = Query(None)):
+	if not q:
+		return JSONResponse(status_code=HTTP_400_BAD_REQUEST,
+		                    content={"error": "At least one query (q) is expected."})
+	if len(q) > zip_export.MAX_QUERIES:
+		return JSONResponse(
+		    status_code=HTTP_400_BAD_REQUEST,
+		    content={"error": f"At most {zip_export.MAX_QUERIES} queries are accepted."})
+	try:
+		entries = zip_export.lookup_entries(q)
+	except normalize.InvalidQuery as e:
+		return JSONResponse(status_code=HTTP_400_BAD_REQUEST,
+		                    content={"error": str(e)})
+	archive = zip_export.ZipArchive(entries)
+	for filepath in archive.filepaths:
+		storage_manager.record_access(filepath)
+	return zip_export.ZipResponse(archive, "scout_pdfs.zip", request.headers,
+	                              method=request.method)
+
+
+# Check the shared secret sent in a header, always refused while the secret is not set
+def _has_token(request, header, secret):
+	if not secret:
+		return False
+	return hmac.compare_digest(request.headers.get(header, "").encode(), secret.encode())
+
+
+# Queue operations of the remote workers (see job_queue.RemoteJobQueue)
+@app.post("/queue/{op}")
+def queue_operation(op: str, args: dict, request: Request):
+	if not _has_token(request, "x-queue-token", QUEUE_TOKEN):
+		raise HTTPException(status_code=HTTP_403_FORBIDDEN, detail="Forbidden.")
+	if op not in job_queue.RemoteJobQueue.OPERATIONS:
+		raise HTTPException(status_code=HTTP_404_NOT_FOUND,
+		                    detail=f"Unknown queue operation {op}.")
+	return JSONResponse(status_code=HTTP_200_OK,
+	                    content=job_queue.LocalTransport(
+	                        job_queue.get_queue())(op, args))
+
+
+# Query the past reports
+@app.get("/reports")
+def get_reports(cas: str = None,
+                name: str = None,
+                provider: str = None,
+                source: str = None,
+                run_id: str = None,
+                since: str = None,
+                until: str = None,
+                limit: int = 100,
+                offset: int = 0):
+	reports = report_store.query_reports(cas=cas,
+	                                     name=name,
+	                                     provider=provider,
+	                                     source=source,
+	                                     run_id=run_id,
+	                                     since=since,
+	                                     until=until,
+	                                     limit=min(limit, 1000),
+	                                     offset=offset)
+	return JSONResponse(status_code=HTTP_200_OK, content=reports)
+
+
+# Export the past reports
+@app.get("/reports/export")
+def export_reports(format: str = "csv",
+                   cas: str = None,
+                   name: str = None,
+                   provider: str = None,
+                   source: str = None,
+                   run_id: str = None,
+                   since: str = None,
+                   until: str = None):
+	if format not in report_store.EXPORT_FORMATS:
+		return JSONResponse(
+		    status_code=HTTP_400_BAD_REQUEST,
+		    content={
+		        "error":
+		        f"Unknown format {format}, expected one of {', '.join(report_store.EXPORT_FORMATS)}."
+		    })
+
+	content = report_store.export_reports(format,
+	                                      cas=cas,
+	                                      name=name,
+	                                      provider=provider,
+	                                      source=source,
+	                                      run_id=run_id,
+	                                      since=since,
+	                                      until=until)
+	filename = f"scout_reports.{format}"
+	return StreamingResponse(
+	    content,
+	    media_type=report_store.EXPORT_FORMATS[format],
+	    headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
+# Politeness state of the crawled hosts
+@app.get("/hosts")
+def get_hosts():
+	return JSONResponse(status_code=HTTP_200_OK, content=HOSTS.snapshot())
+
+
+# Attempt counters and latency of the fetches
+@app.get("/fetch/stats")
+def get_fetch_stats():
+	stats = fetch.stats()
+	stats["negative_cache"] = negative_cache.stats()
+	stats["discovery"] = discovery.stats()
+	stats["stages"] = crawler.stats()  # crawls of the inline workers
+	stats["partial_fetch"] = partial_fetch.stats()
+	return JSONResponse(status_code=HTTP_200_OK, content=stats)
+
+
+# Blocking spans of the event loop
+@app.get("/loop/stats")
+def get_loop_stats():
+	return JSONResponse(status_code=HTTP_200_OK, content=profiler.stats())
+
+
+# Yield stats of the crawled domains
+@app.get("/domains/stats")
+def get_domain_stats(format: str = "json"):
+	if format == "csv":
+		return StreamingResponse(
+		    iter([domain_stats.export("csv")]),
+		    media_type="text/csv",
+		    headers={"Content-Disposition": 'attachment; filename="domain_stats.csv"'})
+	return JSONResponse(status_code=HTTP_200_OK, content=domain_stats.export())
+
+
+# Warm set, hit rate and refresh cost of the popular queries
+@app.get("/popularity/stats")
+def get_popularity_stats():
+	return JSONResponse(status_code=HTTP_200_OK, content=popularity.stats())
+
+
+# Storage usage stats
+@app.get("/storage/stats")
+def get_storage_stats():
+	return JSONResponse(status_code=HTTP_200_OK,
+	                    content=storage_manager.usage_stats())
+
+
+# pdf file serving
+def serve_pdf(request, filepath, cache_control):
+	if filepath is None:
+		raise HTTPException(status_code=HTTP_404_NOT_FOUND,
+		                    detail="File not found.")
+	digest = pdf_server.file_digest(filepath)
+	if digest is None:
+		raise HTTPException(status_code=HTTP_404_NOT_FOUND,
+		                    detail="File not found.")
+	storage_manager.record_access(filepath)
+	return pdf_server.PdfResponse(filepath,
+	                              digest,
+	                              request.headers,
+	                              cache_control,
+	                              method=request.method)
+
+
+@app.api_route("/verified/{filename}", methods=["GET", "HEAD"])
+def get_verified_pdf(filename: str, request: Request):
+	return serve_pdf(request, pdf_server.resolve("verified", filename),
+	                 pdf_server.NAMED_CACHE_CONTROL)
+
+
+@app.api_route("/unverified/{filename}", methods=["GET", "HEAD"])
+def get_unverified_pdf(filename: str, request: Request):
+	return serve_pdf(request, pdf_server.resolve("unverified", filename),
+	                 pdf_server.NAMED_CACHE_CONTROL)
+
 
+# content addressed pdf (the sha256 is returned in the scout response)
+@app.api_route("/pdf/{sha256}", methods=["GET", "HEAD"])
+def get_pdf_by_digest(sha256: str, request: Request):
+	return serve_pdf(request, pdf_server.find_by_digest(sha256),
+	                 pdf_server.IMMUTABLE_CACHE_CONTROL)
 
-# static file serving
-# Mount the static files directory
-app.mount("/verified", StaticFiles(directory="verified"), name="verified")
-app.mount("/unverified",
-          StaticFiles(directory="unverified"),
-          name="unverified")
 
 # Run the app
 if __name__ == "__main__":
@@ -0,0 +1,174 @@
+import os
+import time
+from collections import Counter
+
+import db
+import normalize
+from fingerprints import BloomFilter
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS negative_cache (
+	url TEXT NOT NULL,
+	scope TEXT NOT NULL,
+	outcome TEXT NOT NULL,
+	expires_at REAL NOT NULL,
+	PRIMARY KEY (url, scope)
+);
+CREATE INDEX IF NOT EXISTS idx_negative_cache_expires_at ON negative_cache (expires_at);
+"""
+
+# Outcome classes
+DEAD = "dead"  # 404, 410 and other client errors
+UNREACHABLE = "unreachable"  # connect errors and timeouts, after the retries
+NOT_PDF = "not_pdf"  # html served where a pdf was expected
+NOT_SDS = "not_sds"  # a pdf that is not a safety data sheet at all
+NOT_MATCHING = "not_matching"  # a safety data sheet of another chemical (scoped to the query)
+UNREADABLE = "unreadable"  # a pdf without text (truncated, corrupt or scanned), may be transient
+
+# Time to live of each outcome in seconds (overridable with SCOUT_NEGATIVE_TTL_<OUTCOME>)
+TTLS = {
+    DEAD: 7 * 24 * 3600,
+    UNREACHABLE: 3600,
+    NOT_PDF: 3 * 24 * 3600,
+    NOT_SDS: 30 * 24 * 3600,
+    NOT_MATCHING: 30 * 24 * 3600,
+    UNREADABLE: 3600,
+}
+for _outcome in TTLS:
+	TTLS[_outcome] = int(os.environ.get(f"SCOUT_NEGATIVE_TTL_{_outcome.upper()}", TTLS[_outcome]))
+
+# Global outcomes do not depend on the query
+GLOBAL_SCOPE = ""
+# Expired entries are pruned every PRUNE_EVERY writes
+PRUNE_EVERY = 1000
+
+# The urls of the cache are also kept in a Bloom filter, the lookups of the other urls
+# (most of them) skip the database. The filter is rebuilt every BLOOM_REBUILD seconds
+# to pick up the urls recorded by the other processes (0 disables it).
+BLOOM_REBUILD = int(os.environ.get("SCOUT_NEGATIVE_BLOOM_REBUILD", 300))
+BLOOM_ERROR_RATE = 0.01
+
+# Hits and writes of the process by outcome
+STATS = Counter()
+_writes = 0
+_bloom = None
+_bloom_built_at = 0
+
+
+# Scope of a query
+def query_scope(cas=None, name=None):
+	"""
+	Returns:
+			str: The scope of the query specific outcomes, the canonical key of the query.
+	"""
+	return normalize.canonical_key(cas, name)
+
+
+# Whether a url may be in the cache
+def _maybe_known(url):
+	global _bloom, _bloom_built_at
+	if not BLOOM_REBUILD:
+		return True
+	now = time.time()
+	if _bloom is None or now - _bloom_built_at > BLOOM_REBUILD:
+		rows = db.connect().execute("SELECT DISTINCT url FROM negative_cache WHERE expires_at > ?",
+		                            (now, )).fetchall()
+		bloom = BloomFilter(max(2 * len(rows), 10000), BLOOM_ERROR_RATE)
+		for row in rows:
+			bloom.add(row["url"])
+		_bloom, _bloom_built_at = bloom, now
+	return url in _bloom
+
+
+# Check a url
+def lookup(url, scope=GLOBAL_SCOPE):
+	"""
+	Look for a live negative outcome of a url, global or specific to the query scope.
+
+	Params:
+			url (str): The url.
+			scope (str, optional): The scope of the query (see query_scope).
+
+	Returns:
+			str: The outcome, or None if the url is not known as junk.
+	"""
+	db.ensure_schema("negative_cache", SCHEMA)
+	if not _maybe_known(url):
+		STATS["bloom_skip"] += 1
+		return None
+	row = db.connect().execute(
+	    "SELECT outcome FROM negative_cache WHERE url = ? AND scope IN (?, ?) AND expires_at > ? LIMIT 1",
+	    (url, GLOBAL_SCOPE, scope, time.time())).fetchone()
+	if row is None:
+		return None
+	STATS[f"hit:{row['outcome']}"] += 1
+	return row["outcome"]
+
+
+# Record an outcome
+def record(url, outcome, scope=GLOBAL_SCOPE):
+	"""
+	Params:
+			url (str): The url.
+			outcome (str): The outcome class (DEAD, UNREACHABLE, NOT_PDF ...).
+			scope (str, optional): The scope of the query, for the query specific outcomes.
+	"""
+	global _writes
+	db.ensure_schema("negative_cache", SCHEMA)
+	conn = db.connect()
+	now = time.time()
+	with conn:
+		conn.execute(
+		    "INSERT OR REPLACE INTO negative_cache (url, scope, outcome, expires_at) VALUES (?, ?, ?, ?)",
+		    (url, scope, outcome, now + TTLS[outcome]))
+		_writes += 1
+		if _writes % PRUNE_EVERY == 0:
+			conn.execute("DELETE FROM negative_cache WHERE expires_at <= ?", (now, ))
+	STATS[f"write:{outcome}"] += 1
+	if _bloom is not None:
+		_bloom.add(url)
+
+
+# Record a failed fetch
+def record_fetch_error(url, error):
+	"""
+	Record the outcome of a fetch that failed after its retries.
+
+	Params:
+			url (str): The url.
+			error (fetch.FetchError): The error of the last attempt.
+	"""
+	if error.error_class == "client" and error.status in (404, 410):
+		record(url, DEAD)
+	elif error.error_class in ("connect", "timeout"):
+		record(url, UNREACHABLE)
+
+
+# Record a pdf rejected by the verification
+def record_rejection(url, scope, is_sds):
+	"""
+	Params:
+			url (str): The url of the pdf.
+			scope (str): The scope of the query (see query_scope).
+			is_sds (bool): Whether the pdf is a safety data sheet (of another chemical), None
+			if its text could not be extracted.
+	"""
+	if is_sds is None:
+		record(url, UNREADABLE)
+	elif is_sds:
+		record(url, NOT_MATCHING, scope)
+	else:
+		record(url, NOT_SDS)
+
+
+# Stats
+def stats():
+	db.ensure_schema("negative_cache", SCHEMA)
+	rows = db.connect().execute(
+	    "SELECT outcome, COUNT(*) AS count FROM negative_cache WHERE expires_at > ? GROUP BY outcome",
+	    (time.time(), )).fetchall()
+	return {
+	    "entries": {row["outcome"]: row["count"] for row in rows},
+	    "process": dict(STATS),
+	    "bloom": {"urls": len(_bloom), "bytes": _bloom.nbytes} if _bloom is not None else None,
+	}
@@ -0,0 +1,234 @@
+import hashlib
+import re
+import threading
+import time
+import unicodedata
+
+import db
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS synonyms (
+	name_key TEXT PRIMARY KEY,
+	name TEXT NOT NULL,
+	cas TEXT NOT NULL,
+	hits INTEGER NOT NULL DEFAULT 1,
+	updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_synonyms_cas ON synonyms (cas);
+CREATE TABLE IF NOT EXISTS synonym_sources (
+	name_key TEXT NOT NULL,
+	cas TEXT NOT NULL,
+	source TEXT NOT NULL,
+	PRIMARY KEY (name_key, cas, source)
+);
+"""
+
+CAS_SHAPE = re.compile(r"^\d{2,7}-\d{2}-\d$")
+# CAS numbers in a text
+CAS_IN_TEXT = re.compile(r"(?<![\d-])(\d{2,7}-\d{2}-\d)(?![\d-])")
+# The product name of the first section of a safety data sheet
+PRODUCT_NAME = re.compile(r"(?:product|substance|trade)\s+name\s*[:\-]?\s*([^\n\r]{2,80})",
+                          re.IGNORECASE)
+# A synonym is used (and changes the cache keys) once it is seen in this many distinct verified pdfs
+MIN_HITS = 2
+
+# The synonyms, {name key: cas}, loaded on first use
+_synonyms = None
+_synonyms_lock = threading.Lock()
+
+
+class InvalidQuery(ValueError):
+	"""
+	Raised for a query that can not match anything (eg. a CAS number with a wrong check digit).
+	"""
+
+
+# Check a CAS number
+def is_cas(value):
+	"""
+	Returns:
+			bool: Whether the value has the shape of a CAS number (eg. 67-56-1).
+	"""
+	return bool(value) and bool(CAS_SHAPE.match(value.strip()))
+
+
+# Validate the check digit of a CAS number
+def valid_cas(cas):
+	"""
+	The check digit is the sum of the other digits, each multiplied by its
+	position from the right, modulo 10.
+
+	Returns:
+			bool: Whether the CAS number is well formed with a valid check digit.
+	"""
+	if not is_cas(cas):
+		return False
+	digits = cas.strip().replace("-", "")
+	total = sum(int(digit) * position for position, digit in enumerate(reversed(digits[:-1]), 1))
+	return total % 10 == int(digits[-1])
+
+
+# Clean a name for searching
+def clean_name(name):
+	"""
+	Returns:
+			str: The name with its whitespace collapsed, or None if empty.
+	"""
+	if not name:
+		return None
+	return " ".join(unicodedata.normalize("NFKC", name).split()) or None
+
+
+# Canonical form of a name
+def canonical_name(name):
+	"""
+	Case, whitespace and punctuation insensitive form of a name
+	("Benzene, 1-bromo-4-methyl- " and "benzene 1 bromo 4 methyl" are the same).
+	"""
+	if not name:
+		return ""
+	name = unicodedata.normalize("NFKC", name).lower()
+	return " ".join(re.sub(r"[\W_]+", " ", name).split())
+
+
+def _load_synonyms():
+	global _synonyms
+	if _synonyms is None:
+		with _synonyms_lock:
+			if _synonyms is None:
+				db.ensure_schema("synonyms", SCHEMA)
+				rows = db.connect().execute("SELECT name_key, cas FROM synonyms WHERE hits >= ?",
+				                            (MIN_HITS, )).fetchall()
+				_synonyms = {row["name_key"]: row["cas"] for row in rows}
+	return _synonyms
+
+
+# CAS number of a name
+def cas_of(name):
+	"""
+	Returns:
+			str: The CAS number learned for the name, or None.
+	"""
+	return _load_synonyms().get(canonical_name(name))
+
+
+# Canonical key of a query
+def canonical_key(cas=None, name=None):
+	"""
+	The key shared by the equivalent queries: the CAS number, the CAS number
+	learned for the name, or the canonical name. Used by every cache.
+
+	Returns:
+			str: The key, empty for an empty query.
+	"""
+	if cas and cas.strip():
+		return cas.strip()
+	if not name:
+		return ""
+	return cas_of(name) or canonical_name(name)
+
+
+# Normalize a query
+def normalize_query(cas=None, name=None):
+	"""
+	Params:
+			cas (str, optional): The CAS number.
+			name (str, optional): The Element name.
+
+	Returns:
+			tuple: The cleaned (cas, name).
+
+	Raises:
+			InvalidQuery: If the query is empty or the CAS number is invalid.
+	"""
+	cas = cas.strip() if cas and cas.strip() else None
+	name = clean_name(name)
+	if cas is None and name is None:
+		raise InvalidQuery("No CAS number or name provided.")
+	if cas is not None and not valid_cas(cas):
+		raise InvalidQuery(f"Invalid CAS number {cas}, its check digit does not match.")
+	return cas, name
+
+
+# Record a synonym
+def record_synonym(name, cas, source):
+	"""
+	Record a synonym seen in a pdf. Its hits are the number of distinct pdfs it was
+	seen in, the CAS number seen in the most pdfs wins.
+
+	Params:
+			name (str): A name of the chemical.
+			cas (str): Its CAS number.
+			source (str): The id of the pdf (eg. the digest of its text).
+	"""
+	name_key = canonical_name(name)
+	if not name_key or not valid_cas(cas):
+		return
+	db.ensure_schema("synonyms", SCHEMA)
+	conn = db.connect()
+	with conn:
+		cursor = conn.execute("INSERT OR IGNORE INTO synonym_sources (name_key, cas, source) VALUES (?, ?, ?)",
+		                      (name_key, cas, source))
+		if cursor.rowcount == 0:  # the same pdf again
+			return
+		hits = conn.execute("SELECT COUNT(*) FROM synonym_sources WHERE name_key = ? AND cas = ?",
+		                    (name_key, cas)).fetchone()[0]
+		conn.execute(
+		    "INSERT INTO synonyms (name_key, name, cas, hits, updated_at) VALUES (?, ?, ?, ?, ?) "
+		    "ON CONFLICT(name_key) DO UPDATE SET "
+		    "cas = excluded.cas, name = excluded.name, hits = excluded.hits, updated_at = excluded.updated_at "
+		    "WHERE synonyms.cas = excluded.cas OR excluded.hits > synonyms.hits",
+		    (name_key, clean_name(name), cas, hits, time.time()))
+		row = conn.execute("SELECT cas, hits FROM synonyms WHERE name_key = ?", (name_key, )).fetchone()
+	if _synonyms is not None and row["hits"] >= MIN_HITS:
+		_synonyms[name_key] = row["cas"]
+
+
+# Learn synonyms from a verified pdf
+def learn(text, cas=None, name=None):
+	"""
+	Learn the name <-> CAS synonyms of a pdf verified for a query. Only the pdfs
+	with a single valid CAS number are learned from (not the mixtures).
+	- A CAS query learns the product name of the pdf (and the name of the query, if it is in the pdf).
+	- A name query learns the CAS number of the pdf.
+
+	Params:
+			text (str): The text of the verified pdf.
+			cas (str, optional): The CAS number of the query.
+			name (str, optional): The name of the query.
+	"""
+	if not text:
+		return
+	try:
+		numbers = {number for number in CAS_IN_TEXT.findall(text) if valid_cas(number)}
+		if len(numbers) != 1:
+			return
+		source = hashlib.sha256(text.encode("utf-8", "replace")).hexdigest()
+		if cas:
+			if numbers != {cas}:
+				return
+			# the name as whole words of the text ("ethanol" is not in "methanol")
+			if name and f" {canonical_name(name)} " in f" {canonical_name(text)} ":
+				record_synonym(name, cas, source)
+			match = PRODUCT_NAME.search(text)
+			if match:
+				record_synonym(match.group(1), cas, source)
+		elif name:
+			record_synonym(name, numbers.pop(), source)
+	except Exception as e:
+		print(f"An error occurred while learning synonyms: {e}")
+
+
+# Synonyms of a CAS number
+def synonyms(cas=None, name=None):
+	"""
+	Returns:
+			list: The learned {name, cas, hits} synonyms of the CAS number (or of the CAS number learned for the name).
+	"""
+	cas = cas or cas_of(name)
+	if not cas:
+		return []
+	db.ensure_schema("synonyms", SCHEMA)
+	rows = db.connect().execute("SELECT name, cas, hits FROM synonyms WHERE cas = ? ORDER BY hits DESC",
+	                            (cas, )).fetchall()
+	return [dict(row) for row in rows]
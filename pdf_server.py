@@ -0,0 +1,283 @@
+import hashlib
+import os
+import re
+import zlib
+from email.utils import formatdate, parsedate_to_datetime
+
+import anyio
+from starlette.responses import Response
+
+import db
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pdf_index (
+	filepath TEXT PRIMARY KEY,
+	size INTEGER NOT NULL,
+	mtime REAL NOT NULL,
+	sha256 TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_pdf_index_sha256 ON pdf_index (sha256);
+CREATE TABLE IF NOT EXISTS pdf_crc (
+	filepath TEXT PRIMARY KEY,
+	size INTEGER NOT NULL,
+	mtime REAL NOT NULL,
+	crc32 INTEGER NOT NULL
+);
+"""
+
+# Folders served by the pdf routes
+SERVED_FOLDERS = ("verified", "unverified")
+
+# Named files may be replaced (eg. after an eviction), so they are always revalidated.
+# Content addressed files (/pdf/{sha256}) never change.
+NAMED_CACHE_CONTROL = "public, no-cache"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+CHUNK_SIZE = 64 * 1024
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+# Resolve a served filepath
+def resolve(folder, filename):
+	"""
+	Params:
+			folder (str): One of the served folders.
+			filename (str): The name of the file in the folder.
+
+	Returns:
+			str: The filepath (eg. verified/methanol_x.pdf), or None if the file does not exist or is outside the folder.
+	"""
+	if folder not in SERVED_FOLDERS or not filename or \
+	   "/" in filename or "\\" in filename or filename.startswith("."):
+		return None
+	filepath = f"{folder}/{filename}"
+	return filepath if os.path.isfile(filepath) else None
+
+
+# Content hash of a file
+def file_digest(filepath):
+	"""
+	Return the sha256 of a file. Digests are stored with the size and mtime of
+	the file, so a file is hashed again only when it changes.
+
+	Params:
+			filepath (str): The filepath (eg. verified/methanol_x.pdf).
+
+	Returns:
+			str: The hex digest, or None if the file does not exist.
+	"""
+	info = file_info(filepath)
+	return info["sha256"] if info else None
+
+
+# Size, mtime and checksums of a file
+def file_info(filepath):
+	"""
+	Return the sha256 and the crc32 (the checksum of the zip entries, see
+	zip_export.py) of a file, both computed in a single read and cached with
+	the size and mtime of the file.
+
+	Params:
+			filepath (str): The filepath (eg. verified/methanol_x.pdf).
+
+	Returns:
+			dict: {"size", "mtime", "sha256", "crc32"}, or None if the file does not exist.
+	"""
+	try:
+		stat = os.stat(filepath)
+	except FileNotFoundError:
+		return None
+	db.ensure_schema("pdf_index", SCHEMA)
+	conn = db.connect()
+	row = conn.execute(
+	    "SELECT i.size, i.mtime, i.sha256, c.crc32 FROM pdf_index i "
+	    "JOIN pdf_crc c ON c.filepath = i.filepath AND c.size = i.size AND c.mtime = i.mtime "
+	    "WHERE i.filepath = ?", (filepath, )).fetchone()
+	if row and row["size"] == stat.st_size and row["mtime"] == stat.st_mtime:
+		return dict(row)
+
+	sha256 = hashlib.sha256()
+	crc32 = 0
+	with open(filepath, "rb") as f:
+		for chunk in iter(lambda: f.read(1024 * 1024), b""):
+			sha256.update(chunk)
+			crc32 = zlib.crc32(chunk, crc32)
+	info = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256.hexdigest(), "crc32": crc32}
+	with conn:
+		conn.execute(
+		    "INSERT OR REPLACE INTO pdf_index (filepath, size, mtime, sha256) VALUES (?, ?, ?, ?)",
+		    (filepath, stat.st_size, stat.st_mtime, info["sha256"]))
+		conn.execute("INSERT OR REPLACE INTO pdf_crc (filepath, size, mtime, crc32) VALUES (?, ?, ?, ?)",
+		             (filepath, stat.st_size, stat.st_mtime, crc32))
+	return info
+
+
+# Find a file by its content hash
+def find_by_digest(digest):
+	"""
+	Returns:
+			str: The filepath of a file with the given sha256, or None.
+	"""
+	db.ensure_schema("pdf_index", SCHEMA)
+	rows = db.connect().execute("SELECT filepath FROM pdf_index WHERE sha256 = ?",
+	                            (digest.lower(), )).fetchall()
+	for row in rows:
+		if file_digest(row["filepath"]) == digest.lower():
+			return row["filepath"]
+	return None
+
+
+# Forget removed files (eviction hook)
+def forget_files(filepaths):
+	db.ensure_schema("pdf_index", SCHEMA)
+	conn = db.connect()
+	with conn:
+		conn.executemany("DELETE FROM pdf_index WHERE filepath = ?",
+		                 [(filepath, ) for filepath in filepaths])
+		conn.executemany("DELETE FROM pdf_crc WHERE filepath = ?",
+		                 [(filepath, ) for filepath in filepaths])
+
+
+# Parse the Range header
+def parse_range(header, size):
+	"""
+	Parse a single byte range.
+
+	Params:
+			header (str): The value of the Range header.
+			size (int): The size of the file.
+
+	Returns:
+			tuple: (start, end) inclusive, None if the header is absent or not a
+			single byte range (the full file is served) and False if the range is
+			not satisfiable.
+	"""
+	if not header:
+		return None
+	match = RANGE_PATTERN.match(header.strip())
+	if not match:
+		return None
+	start, end = match.groups()
+	if not start and not end:
+		return None
+	if not start:  # suffix range, the last N bytes
+		length = int(end)
+		if length == 0:
+			return False
+		return max(size - length, 0), size - 1
+	start = int(start)
+	end = min(int(end), size - 1) if end else size - 1
+	if start >= size or start > end:
+		return False
+	return start, end
+
+
+class PdfResponse(Response):
+	"""
+	Serve a pdf file with a strong (content hash) ETag, conditional requests
+	(304) and single byte ranges (206).
+	The file is sent with the server zero-copy extension when available,
+	otherwise it is streamed by chunks.
+
+	Params:
+			filepath (str): The file to serve.
+			digest (str): The sha256 of the file.
+			request_headers (Headers): The headers of the request.
+			cache_control (str): The Cache-Control header of the response.
+			method (str): The method of the request (no body is sent for HEAD).
+	"""
+
+	media_type = "application/pdf"
+
+	def __init__(self, filepath, digest, request_headers, cache_control, method="GET"):
+		super().__init__(status_code=200, media_type=self.media_type)
+		self.filepath = filepath
+		self.send_body = method != "HEAD"
+		self.range = None
+
+		stat = os.stat(filepath)
+		self.size = stat.st_size
+		etag = f'"{digest}"'
+		self.headers["etag"] = etag
+		self.headers["cache-control"] = cache_control
+		self.headers["accept-ranges"] = "bytes"
+		self.headers["last-modified"] = formatdate(stat.st_mtime, usegmt=True)
+		self.headers["content-disposition"] = \
+		    f'inline; filename="{os.path.basename(filepath)}"'
+
+		if self._not_modified(request_headers, etag, stat.st_mtime):
+			self.status_code = 304
+			self.send_body = False
+			del self.headers["content-length"]
+			return
+
+		byte_range = None
+		if_range = request_headers.get("if-range")
+		if not if_range or if_range == etag:
+			byte_range = parse_range(request_headers.get("range"), self.size)
+
+		if byte_range is False:
+			self.status_code = 416
+			self.send_body = False
+			self.headers["content-range"] = f"bytes */{self.size}"
+			self.headers["content-length"] = "0"
+		elif byte_range:
+			start, end = byte_range
+			self.status_code = 206
+			self.range = byte_range
+			self.headers["content-range"] = f"bytes {start}-{end}/{self.size}"
+			self.headers["content-length"] = str(end - start + 1)
+		else:
+			self.headers["content-length"] = str(self.size)
+
+	@staticmethod
+	def _not_modified(request_headers, etag, mtime):
+		if_none_match = request_headers.get("if-none-match")
+		if if_none_match is not None:
+			tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+			return etag in tags or "*" in tags
+		if_modified_since = request_headers.get("if-modified-since")
+		if if_modified_since:
+			try:
+				return int(mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+			except (TypeError, ValueError):
+				return False
+		return False
+
+	async def __call__(self, scope, receive, send):
+		await send({
+		    "type": "http.response.start",
+		    "status": self.status_code,
+		    "headers": self.raw_headers,
+		})
+		start, end = self.range or (0, self.size - 1)
+		count = end - start + 1
+		if not self.send_body or count <= 0:  # an empty file has no chunk to send
+			await send({"type": "http.response.body", "body": b""})
+			return
+
+		extensions = scope.get("extensions") or {}
+		if "http.response.zerocopysend" in extensions:
+			with open(self.filepath, "rb") as f:
+				await send({
+				    "type": "http.response.zerocopysend",
+				    "file": f.fileno(),
+				    "offset": start,
+				    "count": count,
+				})
+			return
+
+		async with await anyio.open_file(self.filepath, mode="rb") as f:
+			await f.seek(start)
+			while count > 0:
+				chunk = await f.read(min(CHUNK_SIZE, count))
+				if not chunk:
+					break
+				count -= len(chunk)
+				await send({
+				    "type": "http.response.body",
+				    "body": chunk,
+				    "more_body": count > 0,
+				})
+		if count > 0:  # the file was truncated while sending
+			await send({"type": "http.response.body", "body": b""})
@@ -0,0 +1,227 @@
+import asyncio
+import os
+import time
+from contextlib import asynccontextmanager
+from email.utils import parsedate_to_datetime
+from urllib.parse import urlparse
+
+# Statuses telling that the host is overloaded or throttling us (a 403 is often
+# the answer of a bot protection to a crawler going too fast)
+THROTTLE_STATUSES = (403, 429, 503)
+
+# Token bucket (requests per second) and concurrency limits of a host
+INITIAL_RATE = float(os.environ.get("SCOUT_HOST_INITIAL_RATE", 2))
+MIN_RATE = 0.1
+MAX_RATE = float(os.environ.get("SCOUT_HOST_MAX_RATE", 10))
+BURST = 2
+INITIAL_CONCURRENCY = 2
+MAX_CONCURRENCY = int(os.environ.get("SCOUT_HOST_MAX_CONCURRENCY", 8))
+# A response faster than this is a "fast success" and ramps the host up
+FAST_RESPONSE = 1.0
+# Max seconds a Retry-After can block a host
+MAX_RETRY_AFTER = 600
+
+
+class HostState:
+	"""
+	The politeness state of a host: a token bucket for the request rate and an
+	AIMD window for the number of concurrent requests.
+	"""
+
+	def __init__(self, host):
+		self.host = host
+		self.rate = INITIAL_RATE
+		self.tokens = BURST
+		self.last_refill = time.monotonic()
+		self.concurrency = float(INITIAL_CONCURRENCY)
+		self.in_flight = 0
+		self.blocked_until = 0
+		self.min_interval = 0  # eg. the robots.txt crawl-delay
+		self.last_request = 0
+		self.released = asyncio.Event()
+
+		# stats
+		self.requests = 0
+		self.successes = 0
+		self.throttled = 0
+		self.errors = 0
+		self.client_errors = 0
+		self.latency = None  # moving average, seconds
+
+	def _refill(self, now):
+		self.tokens = min(BURST, self.tokens + (now - self.last_refill) * self.rate)
+		self.last_refill = now
+
+	def wait_time(self, now):
+		"""
+		Returns:
+				float: The seconds to wait before a request can start, 0 if it can start now.
+				None if the concurrency window is full (wait for a release).
+		"""
+		if self.in_flight >= max(1, int(self.concurrency)):
+			return None
+		self._refill(now)
+		wait = max(self.blocked_until - now, self.last_request + self.min_interval - now, 0)
+		if self.tokens < 1:
+			wait = max(wait, (1 - self.tokens) / self.rate)
+		return wait
+
+	def on_success(self, latency):
+		self.successes += 1
+		self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+		if latency < FAST_RESPONSE:
+			# additive increase, about +1 per window of requests
+			self.concurrency = min(MAX_CONCURRENCY, self.concurrency + 1 / self.concurrency)
+			self.rate = min(MAX_RATE, self.rate + 0.1)
+
+	def on_throttle(self, retry_after=None):
+		self.throttled += 1
+		self._decrease()
+		if retry_after:
+			self.blocked_until = max(self.blocked_until,
+			                         time.monotonic() + min(retry_after, MAX_RETRY_AFTER))
+
+	def on_client_error(self):
+		# a 404 and the like says nothing about the load of the host, it does not ramp it up
+		self.client_errors += 1
+
+	def on_error(self, timeout=False):
+		self.errors += 1
+		if timeout:
+			self._decrease()
+
+	def _decrease(self):
+		# multiplicative decrease
+		self.concurrency = max(1.0, self.concurrency / 2)
+		self.rate = max(MIN_RATE, self.rate / 2)
+
+	def snapshot(self):
+		now = time.monotonic()
+		return {
+		    "host": self.host,
+		    "rate": round(self.rate, 3),
+		    "concurrency": round(self.concurrency, 2),
+		    "in_flight": self.in_flight,
+		    "blocked_for": round(max(self.blocked_until - now, 0), 1),
+		    "min_interval": self.min_interval,
+		    "requests": self.requests,
+		    "successes": self.successes,
+		    "throttled": self.throttled,
+		    "errors": self.errors,
+		    "client_errors": self.client_errors,
+		    "latency": round(self.latency, 3) if self.latency is not None else None,
+		}
+
+
+class Slot:
+	"""
+	A request slot of a host, returned by HostScheduler.slot.
+	Call record with the response status (and headers) once they are known.
+	"""
+
+	def __init__(self, state):
+		self.state = state
+		self.started = time.monotonic()
+		self.recorded = False
+
+	def record(self, status, headers=None):
+		"""
+		Params:
+				status (int): The status of the response.
+				headers (dict, optional): The headers of the response (for Retry-After).
+		"""
+		self.recorded = True
+		if status in THROTTLE_STATUSES:
+			self.state.on_throttle(parse_retry_after((headers or {}).get("Retry-After")))
+		elif status >= 500:
+			self.state.on_error()
+		elif status >= 400:
+			self.state.on_client_error()
+		else:
+			self.state.on_success(time.monotonic() - self.started)
+
+
+# Parse the Retry-After header
+def parse_retry_after(value):
+	"""
+	Returns:
+			float: The seconds to wait, or None if the header is absent or invalid.
+	"""
+	if not value:
+		return None
+	try:
+		return max(float(value), 0)
+	except ValueError:
+		pass
+	try:
+		return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+	except (TypeError, ValueError):
+		return None
+
+
+class HostScheduler:
+	"""
+	Process-wide scheduler of the requests to every host.
+	Rate and concurrency back off on 403/429/503 and timeouts (honoring Retry-After)
+	and ramp up on fast successes.
+	"""
+
+	def __init__(self):
+		self.hosts = {}
+
+	def state(self, host):
+		if host not in self.hosts:
+			self.hosts[host] = HostState(host)
+		return self.hosts[host]
+
+	@asynccontextmanager
+	async def slot(self, url):
+		"""
+		Wait for a request slot of the host of the url.
+
+		Usage:
+				async with HOSTS.slot(url) as slot:
+					async with session.get(url) as response:
+						slot.record(response.status, response.headers)
+		"""
+		state = self.state(urlparse(url).netloc.lower())
+		while True:
+			wait = state.wait_time(time.monotonic())
+			if wait == 0:
+				break
+			if wait is None:
+				state.released.clear()
+				await state.released.wait()
+			else:
+				await asyncio.sleep(wait)
+
+		state.tokens -= 1
+		state.in_flight += 1
+		state.requests += 1
+		state.last_request = time.monotonic()
+		slot = Slot(state)
+		try:
+			yield slot
+		except asyncio.TimeoutError:
+			state.on_error(timeout=True)
+			raise
+		except Exception:
+			if not slot.recorded:
+				state.on_error()
+			raise
+		finally:
+			state.in_flight -= 1
+			state.released.set()
+
+	def snapshot(self):
+		"""
+		Returns:
+				list: The state of every host, the busiest first.
+		"""
+		return sorted((state.snapshot() for state in self.hosts.values()),
+		              key=lambda s: s["requests"],
+		              reverse=True)
+
+
+# The scheduler of the process
+HOSTS = HostScheduler()
@@ -0,0 +1,247 @@
+import asyncio
+import os
+import threading
+import time
+from collections import Counter
+
+import db
+import job_queue
+import result_cache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS query_popularity (
+	key TEXT PRIMARY KEY,
+	cas TEXT,
+	name TEXT,
+	requests INTEGER NOT NULL DEFAULT 0,
+	score REAL NOT NULL DEFAULT 0,
+	last_request REAL,
+	refresh_job TEXT,
+	refreshes INTEGER NOT NULL DEFAULT 0,
+	last_refresh REAL
+);
+CREATE TABLE IF NOT EXISTS refresh_log (
+	key TEXT NOT NULL,
+	finished_at REAL NOT NULL,
+	bytes INTEGER NOT NULL,
+	seconds REAL NOT NULL,
+	pdfs INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_query_popularity_score ON query_popularity (score DESC);
+CREATE INDEX IF NOT EXISTS idx_refresh_log_finished_at ON refresh_log (finished_at);
+"""
+
+# Number of most requested queries kept warm
+TOP_N = int(os.environ.get("SCOUT_REFRESH_TOP_N", 20))
+# Queries requested less than this are never refreshed
+MIN_REQUESTS = 3
+# The request score halves every HALF_LIFE seconds, so that the warm set follows the traffic
+HALF_LIFE = 24 * 3600
+# A warm query is refreshed once its cached result expires in less than this
+REFRESH_AHEAD = int(os.environ.get("SCOUT_REFRESH_AHEAD_SECONDS", result_cache.TTL // 4))
+# Global budget of the refreshes, bytes per hour (shared by every node of the database)
+BUDGET_BYTES_PER_HOUR = int(os.environ.get("SCOUT_REFRESH_BUDGET_BYTES", 200 * 1024**2))
+# Max refreshes queued or running at a time
+MAX_RUNNING = 1
+# Priority of the refresh jobs, below the live lookups and the excel jobs (see job_queue.LIVE_PRIORITY)
+REFRESH_PRIORITY = -10
+# Interval between two runs of the scheduler
+RUN_INTERVAL = int(os.environ.get("SCOUT_REFRESH_INTERVAL_SECONDS", 300))
+
+# Cache hits and misses of the process, for all the queries and for the warm set
+STATS = Counter()
+# Keys of the warm set, updated by the scheduler
+_warm = set()
+
+# Requests not written yet, {key: [cas, name, requests, last request]}. The lookups
+# only count in memory, the scheduler writes the counts (see flush()).
+_pending = {}
+_pending_lock = threading.Lock()
+
+
+# Decayed score of a query
+def _decay(score, last, now):
+	if not last:
+		return 0
+	return score * 0.5**((now - last) / HALF_LIFE)
+
+
+# Record a lookup
+def record_request(key, cas=None, name=None, hit=False):
+	"""
+	Params:
+			key (str): The canonical key of the query (see normalize.canonical_key).
+			cas (str, optional): The CAS number of the query.
+			name (str, optional): The name of the query.
+			hit (bool, optional): Whether the result was served from the cache.
+	"""
+	if not key:
+		return
+	STATS["hits" if hit else "misses"] += 1
+	if key in _warm:
+		STATS["warm_hits" if hit else "warm_misses"] += 1
+	with _pending_lock:
+		pending = _pending.setdefault(key, [cas, name, 0, None])
+		pending[2] += 1
+		pending[3] = time.time()
+
+
+# Write the pending requests
+def flush():
+	with _pending_lock:
+		pending = dict(_pending)
+		_pending.clear()
+	if not pending:
+		return
+	db.ensure_schema("popularity", SCHEMA)
+	conn = db.connect()
+	with conn:
+		for key, (cas, name, requests, last_request) in pending.items():
+			row = conn.execute("SELECT score, last_request FROM query_popularity WHERE key = ?",
+			                   (key, )).fetchone()
+			score = _decay(row["score"], row["last_request"], last_request) + requests if row else requests
+			conn.execute(
+			    "INSERT INTO query_popularity (key, cas, name, requests, score, last_request) "
+			    "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT(key) DO UPDATE SET "
+			    "requests = requests + excluded.requests, score = excluded.score, "
+			    "last_request = excluded.last_request",
+			    (key, cas, name, requests, score, last_request))
+
+
+# Most requested queries
+def top(n=TOP_N):
+	"""
+	Returns:
+			list: The n queries with the highest decayed request score.
+	"""
+	db.ensure_schema("popularity", SCHEMA)
+	now = time.time()
+	rows = [dict(row) for row in db.connect().execute(
+	    "SELECT * FROM query_popularity WHERE requests >= ?", (MIN_REQUESTS, ))]
+	for row in rows:
+		row["score"] = _decay(row["score"], row["last_request"], now)
+	rows.sort(key=lambda row: -row["score"])
+	return rows[:n]
+
+
+# Record the cost of a refresh (called by the refresh jobs, see worker.py)
+def record_refresh(key, nbytes, seconds, pdfs):
+	db.ensure_schema("popularity", SCHEMA)
+	conn = db.connect()
+	now = time.time()
+	with conn:
+		conn.execute("INSERT INTO refresh_log (key, finished_at, bytes, seconds, pdfs) VALUES (?, ?, ?, ?, ?)",
+		             (key, now, nbytes, seconds, pdfs))
+		conn.execute("UPDATE query_popularity SET refreshes = refreshes + 1, last_refresh = ? WHERE key = ?",
+		             (now, key))
+		# the log is only needed for the budget and the stats
+		conn.execute("DELETE FROM refresh_log WHERE finished_at < ?", (now - 7 * 24 * 3600, ))
+
+
+def _spent(since):
+	row = db.connect().execute(
+	    "SELECT COUNT(*) AS refreshes, COALESCE(SUM(bytes), 0) AS bytes, COALESCE(SUM(seconds), 0) AS seconds, "
+	    "COALESCE(SUM(pdfs), 0) AS pdfs FROM refresh_log WHERE finished_at >= ?", (since, )).fetchone()
+	return dict(row)
+
+
+# One run of the scheduler
+def run_once(queue=None):
+	"""
+	Queue a low priority refresh of the warm queries whose cached result is missing
+	or about to expire, unless live lookups are waiting, a refresh is already
+	running or the bandwidth budget of the last hour is spent.
+
+	Returns:
+			list: The keys of the queued refreshes.
+	"""
+	queue = queue or job_queue.get_queue()
+	flush()
+	warm = top()
+	_warm.clear()
+	_warm.update(row["key"] for row in warm)
+
+	conn = db.connect()
+	running = 0
+	for row in warm:
+		if row["refresh_job"]:
+			job = queue.get(row["refresh_job"])
+			if job and job["status"] in (job_queue.PENDING, job_queue.RUNNING):
+				running += 1
+			else:
+				with conn:
+					conn.execute("UPDATE query_popularity SET refresh_job = NULL WHERE key = ?",
+					             (row["key"], ))
+				row["refresh_job"] = None
+
+	queued = []
+	for row in warm:
+		if running >= MAX_RUNNING:
+			break
+		if row["refresh_job"]:
+			continue
+		expires_in = result_cache.expires_in(row["key"])
+		if expires_in is not None and expires_in > REFRESH_AHEAD:
+			continue
+		# live lookups first
+		if queue.pending_count(min_priority=job_queue.LIVE_PRIORITY):
+			break
+		if _spent(time.time() - 3600)["bytes"] >= BUDGET_BYTES_PER_HOUR:
+			print("Refresh budget of the last hour spent")
+			break
+
+		payload = {"key": row["key"], "cas": row["cas"], "name": row["name"]}
+		job_id = queue.enqueue("refresh", payload, priority=REFRESH_PRIORITY)
+		with conn:
+			conn.execute("UPDATE query_popularity SET refresh_job = ? WHERE key = ?",
+			             (job_id, row["key"]))
+		queued.append(row["key"])
+		running += 1
+	return queued
+
+
+async def run_periodically(interval=RUN_INTERVAL):
+	"""
+	Run the refresh scheduler every `interval` seconds, until cancelled.
+	"""
+	while True:
+		try:
+			await asyncio.to_thread(run_once)
+		except Exception as e:
+			print(f"An error occurred while scheduling the refreshes: {e}")
+		await asyncio.sleep(interval)
+
+
+def _rate(hits, misses):
+	return round(hits / (hits + misses), 3) if hits + misses else None
+
+
+# Stats
+def stats():
+	"""
+	Returns:
+			dict: The warm set, the cache hit rates and the cost of the refreshes.
+	"""
+	flush()
+	db.ensure_schema("popularity", SCHEMA)
+	warm = top()
+	for row in warm:
+		expires_in = result_cache.expires_in(row["key"])
+		row["score"] = round(row["score"], 3)
+		row["cached_for"] = round(expires_in) if expires_in is not None else None
+	now = time.time()
+	last_hour, last_week = _spent(now - 3600), _spent(now - 7 * 24 * 3600)
+	return {
+	    "warm_set": warm,
+	    "hit_rate": {
+	        "all": _rate(STATS["hits"], STATS["misses"]),
+	        "warm": _rate(STATS["warm_hits"], STATS["warm_misses"]),
+	        "counts": dict(STATS),
+	    },
+	    "refresh": {
+	        "budget_bytes_per_hour": BUDGET_BYTES_PER_HOUR,
+	        "last_hour": last_hour,
+	        "last_week": last_week,
+	        "bytes_per_pdf": round(last_week["bytes"] / last_week["pdfs"]) if last_week["pdfs"] else None,
+	    },
+	}
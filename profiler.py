@@ -0,0 +1,230 @@
+import asyncio
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter, deque
+
+LOGS_FOLDER = "./logs"
+# Interval between two samples of a profiled lookup
+SAMPLE_INTERVAL = int(os.environ.get("SCOUT_PROFILE_INTERVAL_MS", 5)) / 1000
+# The event loop blocked longer than this is recorded, with the blocking stack
+LAG_THRESHOLD = int(os.environ.get("SCOUT_LOOP_LAG_MS", 100)) / 1000
+# Interval of the heartbeat of the event loop
+LAG_INTERVAL = 0.05
+# The blocking spans are appended to this file
+LAG_FILE = os.path.join(LOGS_FOLDER, "loop_lag.jsonl")
+
+# The lag monitor of the process, see watch_loop()
+MONITOR = None
+
+
+def _label(frame):
+	code = frame.f_code
+	return f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+
+
+# Stack of a frame, from the outermost call
+def _stack(frame):
+	stack = []
+	while frame is not None:
+		stack.append(_label(frame))
+		frame = frame.f_back
+	return stack[::-1]
+
+
+# Chain of awaits of a suspended coroutine, down to the future it waits for
+def _await_chain(coro):
+	stack = []
+	while coro is not None:
+		frame = getattr(coro, "cr_frame", None) or getattr(coro, "gi_frame", None)
+		if frame is None:
+			# a future (a socket, a thread of asyncio.to_thread ...)
+			stack.append(f"<{type(coro).__name__}>")
+			break
+		stack.append(_label(frame))
+		coro = getattr(coro, "cr_await", None) or getattr(coro, "gi_yieldfrom", None)
+	return stack
+
+
+# Whether a coroutine is executing (a task runs while its coroutine is being stepped)
+def _is_running(coro):
+	return bool(getattr(coro, "cr_running", False) or getattr(coro, "gi_running", False))
+
+
+class TaskProfiler:
+	"""
+	Sampling profiler of an asyncio task. While the task runs, the stack of the event
+	loop thread is sampled ("[running]", cpu), otherwise the chain of awaits the task is
+	suspended on ("[waiting]", network or a blocking call run in a thread).
+
+	Params:
+			task (asyncio.Task): The profiled task, of the running loop.
+			interval (float, optional): The seconds between two samples. Defaults to SAMPLE_INTERVAL.
+	"""
+
+	def __init__(self, task, interval=SAMPLE_INTERVAL):
+		self.task = task
+		self.interval = interval
+		self.thread_id = threading.get_ident()
+		self.samples = Counter()
+		self.started = None
+		self._stopped = threading.Event()
+		self._thread = threading.Thread(target=self._run, name="scout-profiler", daemon=True)
+
+	def start(self):
+		self.started = time.monotonic()
+		self._thread.start()
+
+	def _sample(self):
+		if _is_running(self.task.get_coro()):
+			frame = sys._current_frames().get(self.thread_id)
+			return ["[running]"] + (_stack(frame) if frame is not None else [])
+		return ["[waiting]"] + _await_chain(self.task.get_coro())
+
+	def _run(self):
+		while not self._stopped.wait(self.interval) and not self.task.done():
+			try:
+				self.samples[";".join(self._sample())] += 1
+			except Exception:
+				# the stacks change under the sampler, skip the sample
+				self.samples["[unknown]"] += 1
+
+	def stop(self, name):
+		"""
+		Stop sampling and write the samples as folded stacks ("frame;frame;frame count"
+		per line, the input of flamegraph.pl and speedscope).
+
+		Returns:
+				str: The path of the .folded file.
+		"""
+		self._stopped.set()
+		self._thread.join()
+		os.makedirs(LOGS_FOLDER, exist_ok=True)
+		name = re.sub(r"[^\w.-]+", "_", name)
+		path = os.path.join(LOGS_FOLDER, f"profile_{time.strftime('%Y-%m-%d_%H-%M-%S')}_{name}.folded")
+		with open(path, "w") as f:
+			for stack, count in self.samples.most_common():
+				f.write(f"{stack} {count}\n")
+		seconds = time.monotonic() - self.started
+		print(f"Profile of {name} saved to {path}, {sum(self.samples.values())} samples in {seconds:.1f}s")
+		return path
+
+
+# Profile a task until it is done
+async def profile_task(task, name):
+	"""
+	Params:
+			task (asyncio.Task): The task to profile.
+			name (str): The name of the profile file.
+
+	Returns:
+			str: The path of the .folded file, the result of the task is task.result().
+	"""
+	profiler = TaskProfiler(task)
+	profiler.start()
+	try:
+		await task
+	finally:
+		path = profiler.stop(name)
+	return path
+
+
+class LoopLagMonitor:
+	"""
+	Record the spans the event loop is blocked longer than `threshold` seconds. A
+	heartbeat runs on the loop, a watchdog thread captures the stack of the loop
+	thread while a heartbeat is late (the code blocking the loop).
+
+	Params:
+			loop (asyncio.AbstractEventLoop): The loop, running in the current thread.
+			threshold (float, optional): Defaults to LAG_THRESHOLD.
+	"""
+
+	def __init__(self, loop, threshold=LAG_THRESHOLD):
+		self.loop = loop
+		self.threshold = threshold
+		self.thread_id = threading.get_ident()
+		self.expected = None
+		self.spans = deque(maxlen=100)
+		self.count = 0
+		self.max_seconds = 0
+		self._stack = None
+		self._handle = None
+		self._stopped = threading.Event()
+		self._thread = threading.Thread(target=self._watch, name="scout-loop-lag", daemon=True)
+
+	def start(self):
+		self.expected = time.monotonic()
+		self._handle = self.loop.call_soon(self._beat)
+		self._thread.start()
+
+	def stop(self):
+		self._stopped.set()
+		if self._handle is not None:
+			self._handle.cancel()
+
+	def _beat(self):
+		now = time.monotonic()
+		lag = now - self.expected
+		if lag > self.threshold:
+			self._record(lag, self._stack)
+		self._stack = None
+		self.expected = now + LAG_INTERVAL
+		self._handle = self.loop.call_later(LAG_INTERVAL, self._beat)
+
+	def _watch(self):
+		while not self._stopped.wait(min(self.threshold / 2, LAG_INTERVAL)):
+			expected = self.expected
+			if self._stack is None and time.monotonic() - expected > self.threshold:
+				frame = sys._current_frames().get(self.thread_id)
+				if expected == self.expected:
+					self._stack = _stack(frame) if frame is not None else []
+
+	def _record(self, seconds, stack):
+		span = {
+		    "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+		    "ms": round(seconds * 1000),
+		    "stack": stack or [],
+		}
+		self.spans.append(span)
+		self.count += 1
+		self.max_seconds = max(self.max_seconds, seconds)
+		print(f"Event loop blocked for {span['ms']}ms" + (f" in {stack[-1]}" if stack else ""))
+		try:
+			os.makedirs(LOGS_FOLDER, exist_ok=True)
+			with open(LAG_FILE, "a") as f:
+				f.write(json.dumps(span) + "\n")
+		except OSError as e:
+			print(f"An error occurred while saving the loop lag: {e}")
+
+	def snapshot(self):
+		return {
+		    "threshold_ms": round(self.threshold * 1000),
+		    "spans": self.count,
+		    "max_ms": round(self.max_seconds * 1000),
+		    "recent": list(self.spans)[-20:],
+		}
+
+
+# Watch the running loop (called at startup, see main.lifespan and worker.py)
+def watch_loop(threshold=LAG_THRESHOLD):
+	"""
+	Returns:
+			LoopLagMonitor: The started monitor of the running loop, stop it at shutdown.
+	"""
+	global MONITOR
+	MONITOR = LoopLagMonitor(asyncio.get_running_loop(), threshold)
+	MONITOR.start()
+	return MONITOR
+
+
+# Stats
+def stats():
+	"""
+	Returns:
+			dict: The blocking spans of the event loop of the process.
+	"""
+	return MONITOR.snapshot() if MONITOR is not None else {}
@@ -24,7 +24,9 @@ const displayResults = (results) => {
 	results.forEach((result) => {
 		// Extract filename and create a href link
 		const filename = result.filepath.split("/").pop();
-		const pdfUrl = BASE_API_URL + result.filepath; // construct a pdf url
+		// construct a pdf url, content addressed urls are cached by the browser
+		const pdfUrl =
+			BASE_API_URL + (result.sha256 ? `pdf/${result.sha256}` : result.filepath);
 
 		// Create a link
 		const a = document.createElement("a");
@@ -173,6 +175,7 @@ const scrollToBottom = () => {
 		"provider": "beta-static.fishersci.com",
 		"verified": true,
 		"filepath": "verified/methanol_beta-static.fishersci.com_3.pdf",
+		"sha256": "9f2c...e41a",
 		"url": "https://beta-static.fishersci.com/content/dam/fishersci/en_US/documents/programs/education/regulatory-documents/sds/chemicals/chemicals-m/S25426A.pdf"
 	},
 ]
@@ -0,0 +1,251 @@
+import csv
+import io
+import json
+import time
+import uuid
+from datetime import datetime
+
+import db
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS reports (
+	id INTEGER PRIMARY KEY AUTOINCREMENT,
+	run_id TEXT NOT NULL,
+	source TEXT NOT NULL,
+	row_id TEXT,
+	cas TEXT,
+	name TEXT,
+	provider TEXT,
+	verified INTEGER,
+	filepath TEXT,
+	url TEXT,
+	downloads INTEGER,
+	found_by TEXT,
+	created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_reports_cas ON reports (cas);
+CREATE INDEX IF NOT EXISTS idx_reports_name ON reports (name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_reports_provider ON reports (provider);
+CREATE INDEX IF NOT EXISTS idx_reports_created_at ON reports (created_at);
+CREATE INDEX IF NOT EXISTS idx_reports_run_id ON reports (run_id);
+CREATE INDEX IF NOT EXISTS idx_reports_filepath ON reports (filepath);
+"""
+
+# Columns written by the writer and returned by the queries
+COLUMNS = [
+    "run_id", "source", "row_id", "cas", "name", "provider", "verified",
+    "filepath", "url", "downloads", "found_by", "created_at"
+]
+
+EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+    "xlsx":
+    "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+}
+
+
+class ReportWriter:
+	"""
+	Buffered writer for the report store.
+	Entries are kept in memory and inserted in a single transaction once the
+	buffer is full, the flush interval is over or the writer is closed.
+
+	Params:
+			source (str): The origin of the entries ("scout" or "excel").
+			run_id (str, optional): The id grouping the entries of one run. Generated if not provided.
+			batch_size (int, optional): The number of buffered entries that triggers a flush. Defaults to 100.
+			flush_interval (int, optional): The max seconds an entry stays in the buffer. Defaults to 5.
+	"""
+
+	def __init__(self, source, run_id=None, batch_size=100, flush_interval=5):
+		self.source = source
+		self.run_id = run_id or new_run_id()
+		self.batch_size = batch_size
+		self.flush_interval = flush_interval
+		self._buffer = []
+		self._last_flush = time.monotonic()
+
+	def add(self, **entry):
+		"""
+		Buffer an entry. Unknown keys are ignored, missing columns are stored as NULL.
+		"""
+		created_at = datetime.now().isoformat(timespec="seconds")
+		row = dict(entry, run_id=self.run_id, source=self.source, created_at=created_at)
+		self._buffer.append(tuple(row.get(column) for column in COLUMNS))
+
+		if len(self._buffer) >= self.batch_size or \
+		   time.monotonic() - self._last_flush >= self.flush_interval:
+			self.flush()
+
+	def flush(self):
+		"""
+		Write the buffered entries to the store.
+		"""
+		self._last_flush = time.monotonic()
+		if not self._buffer:
+			return
+		db.ensure_schema("reports", SCHEMA)
+		conn = db.connect()
+		placeholders = ", ".join("?" for _ in COLUMNS)
+		with conn:
+			conn.executemany(
+			    f"INSERT INTO reports ({', '.join(COLUMNS)}) VALUES ({placeholders})",
+			    self._buffer)
+		self._buffer = []
+
+	def close(self):
+		self.flush()
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self, *exc):
+		self.close()
+
+
+# Generate a run id
+def new_run_id():
+	"""
+	Returns:
+			str: A new unique run id, prefixed with the current timestamp so that run ids sort by time.
+	"""
+	return datetime.now().strftime("%Y-%m-%d_%H-%M-%S") + "_" + uuid.uuid4().hex[:8]
+
+
+# Build the WHERE clause of a query
+def _where(cas=None, name=None, provider=None, source=None, run_id=None,
+           since=None, until=None):
+	clauses, args = [], []
+	if cas:
+		clauses.append("cas = ?")
+		args.append(cas)
+	if name:
+		clauses.append("name = ? COLLATE NOCASE")
+		args.append(name)
+	if provider:
+		clauses.append("provider = ?")
+		args.append(provider)
+	if source:
+		clauses.append("source = ?")
+		args.append(source)
+	if run_id:
+		clauses.append("run_id = ?")
+		args.append(run_id)
+	if since:
+		clauses.append("created_at >= ?")
+		args.append(since)
+	if until:
+		clauses.append("created_at <= ?")
+		args.append(until)
+	where = ("WHERE " + " AND ".join(clauses)) if clauses else ""
+	return where, args
+
+
+def _to_dict(row):
+	entry = dict(row)
+	entry.pop("id", None)
+	if entry["verified"] is not None:
+		entry["verified"] = bool(entry["verified"])
+	return entry
+
+
+# Query the stored reports
+def query_reports(limit=100, offset=0, **filters):
+	"""
+	Query the stored report entries, newest first.
+
+	Params:
+			limit (int, optional): The max number of entries returned. Defaults to 100.
+			offset (int, optional): The number of entries to skip. Defaults to 0.
+			**filters: cas, name, provider, source, run_id, since and until (ISO timestamps).
+
+	Returns:
+			list: A list of report entries (dict).
+	"""
+	db.ensure_schema("reports", SCHEMA)
+	where, args = _where(**filters)
+	rows = db.connect().execute(
+	    f"SELECT * FROM reports {where} ORDER BY created_at DESC, id DESC LIMIT ? OFFSET ?",
+	    args + [limit, offset]).fetchall()
+	return [_to_dict(row) for row in rows]
+
+
+# Iterate over the stored reports
+def iter_reports(batch_size=500, **filters):
+	"""
+	Iterate over every report entry matching the filters, oldest first, without
+	loading them all in memory.
+	"""
+	db.ensure_schema("reports", SCHEMA)
+	where, args = _where(**filters)
+	last_id = 0
+	id_clause = ("AND" if where else "WHERE") + " id > ?"
+	while True:
+		rows = db.connect().execute(
+		    f"SELECT * FROM reports {where} {id_clause} ORDER BY id LIMIT ?",
+		    args + [last_id, batch_size]).fetchall()
+		if not rows:
+			return
+		last_id = rows[-1]["id"]
+		for row in rows:
+			yield _to_dict(row)
+
+
+# Export the stored reports
+def export_reports(fmt, **filters):
+	"""
+	Export the report entries matching the filters.
+
+	Params:
+			fmt (str): The export format, one of "csv", "jsonl" or "xlsx".
+			**filters: The same filters as query_reports.
+
+	Returns:
+			iterator: The exported content, chunk by chunk (str for csv/jsonl, bytes for xlsx).
+	"""
+	if fmt == "csv":
+		return _export_csv(filters)
+	if fmt == "jsonl":
+		return (json.dumps(entry) + "\n" for entry in iter_reports(**filters))
+	if fmt == "xlsx":
+		return iter([_export_xlsx(filters)])
+	raise ValueError(f"Unknown export format {fmt}, expected one of {', '.join(EXPORT_FORMATS)}")
+
+
+def _export_csv(filters):
+	buffer = io.StringIO()
+	writer = csv.writer(buffer)
+	writer.writerow(COLUMNS)
+	for entry in iter_reports(**filters):
+		writer.writerow([entry[column] for column in COLUMNS])
+		if buffer.tell() > 64 * 1024:
+			yield buffer.getvalue()
+			buffer.seek(0)
+			buffer.truncate()
+	yield buffer.getvalue()
+
+
+def _export_xlsx(filters):
+	import pandas as pd
+
+	output = io.BytesIO()
+	df = pd.DataFrame(list(iter_reports(**filters)), columns=COLUMNS)
+	df.to_excel(output, index=False)
+	return output.getvalue()
+
+
+# Forget removed files
+def forget_files(filepaths):
+	"""
+	Clear the filepath of the entries pointing at removed files, so that no
+	report points at a deleted file.
+
+	Params:
+			filepaths (list): The removed filepaths (eg. verified/methanol_x.pdf).
+	"""
+	db.ensure_schema("reports", SCHEMA)
+	conn = db.connect()
+	with conn:
+		conn.executemany("UPDATE reports SET filepath = NULL WHERE filepath = ?",
+		                 [(filepath, ) for filepath in filepaths])
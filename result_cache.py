@@ -0,0 +1,80 @@
+import json
+import os
+import time
+
+import db
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS result_cache (
+	key TEXT PRIMARY KEY,
+	result TEXT NOT NULL,
+	created_at REAL NOT NULL,
+	expires_at REAL NOT NULL
+);
+"""
+
+# Seconds a lookup result is served from the cache
+TTL = int(os.environ.get("SCOUT_RESULT_TTL_SECONDS", 24 * 3600))
+
+
+# Get a cached result
+def get(key):
+	"""
+	Params:
+			key (str): The canonical key of the query (see normalize.canonical_key).
+
+	Returns:
+			The cached result, or None.
+	"""
+	if not key:
+		return None
+	db.ensure_schema("result_cache", SCHEMA)
+	row = db.connect().execute("SELECT result FROM result_cache WHERE key = ? AND expires_at > ?",
+	                           (key, time.time())).fetchone()
+	return json.loads(row["result"]) if row else None
+
+
+# Time to live of a cached result
+def expires_in(key):
+	"""
+	Returns:
+			float: The seconds before the cached result of the key expires, or None if it is not cached.
+	"""
+	if not key:
+		return None
+	db.ensure_schema("result_cache", SCHEMA)
+	row = db.connect().execute("SELECT expires_at FROM result_cache WHERE key = ? AND expires_at > ?",
+	                           (key, time.time())).fetchone()
+	return row["expires_at"] - time.time() if row else None
+
+
+# Cache a result
+def put(key, result):
+	"""
+	Params:
+			key (str): The canonical key of the query.
+			result: The JSON serializable result, empty results are not cached.
+	"""
+	if not key or not result:
+		return
+	db.ensure_schema("result_cache", SCHEMA)
+	now = time.time()
+	conn = db.connect()
+	with conn:
+		conn.execute("INSERT OR REPLACE INTO result_cache (key, result, created_at, expires_at) "
+		             "VALUES (?, ?, ?, ?)", (key, json.dumps(result), now, now + TTL))
+
+
+# Forget the results pointing at removed files (storage_manager eviction hook)
+def forget_files(filepaths):
+	"""
+	Params:
+			filepaths (list): The removed filepaths (eg. verified/methanol_x.pdf).
+	"""
+	db.ensure_schema("result_cache", SCHEMA)
+	conn = db.connect()
+	with conn:
+		for filepath in filepaths:
+			pattern = json.dumps(filepath).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+			conn.execute("DELETE FROM result_cache WHERE result LIKE ? ESCAPE '\\'",
+			             (f"%{pattern}%", ))
@@ -1,21 +1,25 @@
 import os
-import re
-from urllib.parse import urljoin, urlparse
-import json
-from datetime import datetime
-import fitz  # PyMuPDF
-import requests
-from bs4 import BeautifulSoup
-from googlesearch import search
 import aiohttp
+import crawler
+from fetch import RetryPolicy
+from report_store import ReportWriter
+from pdf_server import file_digest
+
+# Retries and timeouts of the requests (overridable with the SCOUT_FETCH_* environment variables)
+FETCH_POLICY = RetryPolicy.from_env("SCOUT_FETCH",
+                                    connect_timeout=5,
+                                    read_timeout=10)
 
 # Directories setup
 PDFS_FOLDER = "./verified"
 TEMP_FOLDER = "./unverified"
 LOGS_FOLDER = "./logs"
-os.makedirs(PDFS_FOLDER, exist_ok=True)
-os.makedirs(TEMP_FOLDER, exist_ok=True)
-os.makedirs(LOGS_FOLDER, exist_ok=True)
+
+
+# Create the directories (called at startup, see main.lifespan and worker.py)
+def setup_folders():
+    for folder in (PDFS_FOLDER, TEMP_FOLDER, LOGS_FOLDER):
+        os.makedirs(folder, exist_ok=True)
 
 # List of URLs to skip
 SKIP_URLS = set([
@@ -158,10 +162,10 @@ SKIP_URLS = set([
 ])
 
 
-# Save report to JSON file
+# Save report to the report store
 def save_report(report_list):
     """
-    Save the global report list to a JSON file in the logs directory.
+    Save the report list to the report store (see report_store.py).
     The report includes details of each processed file such as the CAS number or name,
     filename, download status, and provider.
 
@@ -169,24 +173,17 @@ def save_report(report_list):
         report_list(list) : A list of dictionary containing the necessary info
 
     Return: 
-        The json report.
+        The report list.
     """
     if report_list:
         try:
-            json_string = json.dumps(
-                report_list, indent=4)  # convert the list to json string
-            report_filename = datetime.now(
-            ).strftime(  # create a report file name
-                "%Y-%m-%d_%H-%M-%S") + ".json"
-            report_filename = os.path.join(LOGS_FOLDER, report_filename)
-            # write the json string in the report file
-            with open(report_filename, "w") as report_file:
-                report_file.write(json_string)
-            print(f"Scout report generated, check {report_filename}")
-            # return the json string
-            return json.loads(json_string)
+            with ReportWriter("scout") as writer:
+                for report in report_list:
+                    writer.add(**report)
+            print(f"Scout report saved, run id {writer.run_id}")
         except Exception as e:
-            print(f"An error occurred while generating the report: {e}")
+            print(f"An error occurred while saving the report: {e}")
+        return report_list
     else:
         print("NO REPORT GENERATED")
 
@@ -216,144 +213,12 @@ def add_report(report_list, cas, name, filepath, verified, provider, url):
         "provider": provider,
         "verified": verified,
         "filepath": filepath,
+        "sha256": file_digest(filepath),  # content address, see /pdf/{sha256}
         "url": url
     }
     report_list.append(report)
 
 
-# Check if URL is a PDF
-def is_pdf(url):
-    """
-    Check if a URL points to a PDF file.
-
-    Params:
-        url (str): The URL to check.
-
-    Returns:
-        bool: True if the URL points to a PDF file, False otherwise.
-    """
-    try:
-        if url.endswith(".pdf"):
-            return True
-
-        response = requests.head(url, timeout=10)
-        content_type = response.headers.get("content-type")
-        return content_type == "application/pdf"
-    except requests.Timeout:
-        print(f"Timeout occurred while checking {url}")
-        return False
-    except Exception as e:
-        print(f"Error occurred while checking {url}: {e}")
-        return False
-
-
-# Download PDF from URL
-async def download_pdf(session, url):
-    """
-    Download a PDF file from a URL and save it to the specified folder.
-
-    Params:
-        session (aiohttp.ClientSession): The session to use for the download.
-        url (str): The URL of the PDF file.
-
-    Returns:
-        str: The file path of the downloaded PDF, or None if the download failed.
-    """
-
-    try:
-        async with session.get(url, timeout=10) as response:
-            response.raise_for_status()
-            if response.headers.get('content-type') == 'application/pdf':
-                file_name = url.split("/")[-1]
-                if not file_name.endswith(".pdf"):
-                    file_name += ".pdf"
-                file_path = os.path.join(TEMP_FOLDER, file_name)
-
-                with open(file_path, 'wb') as pdf_file:
-                    pdf_file.write(await response.read())
-                print(f"Downloaded: {file_name}")
-
-                return file_path
-            else:
-                print(f"Skipping {url}, not a PDF file.")
-                return None
-    except Exception as e:
-        print(f"An error occurred while downloading {url}: {e}")
-    return None
-
-
-# Extract text from PDF
-def extract_text_from_pdf(pdf_path):
-    """
-    Extract text content from a PDF file.
-
-    Params:
-        pdf_path (str): The file path of the PDF.
-
-    Returns:
-        str: The extracted text content, or None if extraction failed.
-    """
-    try:
-        doc = fitz.open(pdf_path)
-        text = ""
-        for pageno, page in enumerate(doc, start=1):
-            if pageno > 5:  # read only first 5 pages
-                break
-            text += page.get_text()
-        doc.close()
-        return text
-    except Exception as e:
-        print(f"An error occurred while extracting text from {pdf_path}: {e}")
-        return None
-
-
-# Set regular expression pattern
-def set_pattern(sequence):
-    """
-    Create a regular expression pattern for a given sequence.
-
-    Params:
-        sequence (str): The sequence to escape and compile into a pattern.
-
-    Returns:
-        re.Pattern: The compiled regular expression pattern.
-    """
-    escaped_sequence = re.escape(sequence)
-    return re.compile(rf'\b{escaped_sequence}\b', re.IGNORECASE)
-
-
-# Verify PDF content
-def verify_pdf(file_path, cas=None, name=None):
-    """
-    Verify if a PDF file contains the specified CAS number or element name and the phrase "safety data sheet".
-
-    Params:
-        file_path (str): The file path of the PDF.
-        cas (str) : The CAS number.
-        name (str): The Element name to verify against.
-
-    Returns:
-        "same" : if the PDF contains the specified CAS number and the phrase "safety data sheet".
-        "similar" : if the PDF contains a part of the element name and the phrase "safety data sheet". 
-         False otherwise.
-    """
-    text = extract_text_from_pdf(file_path)
-    if text is None:
-        return False
-    pattern1 = set_pattern(cas or name)
-    pattern2 = set_pattern("safety data sheet")
-    if name is not None:
-        pattern3 = re.compile('|'.join(map(re.escape, name.split())),
-                              re.IGNORECASE)
-    # exact match
-    if pattern1.search(text) and pattern2.search(text):
-        return "same"
-    elif name is not None and pattern2.search(text) and pattern3.search(text):
-        return "similar"
-
-    return False
-
-
 # Rename and move file
 def rename_and_move_file(file_path, destination, cas, name, provider):
     """
@@ -371,15 +236,21 @@ def rename_and_move_file(file_path, destination, cas, name, provider):
     """
     try:
         # Generate a unique file name
+        # (the name is reserved with an exclusive create, so that concurrent
+        # workers never pick the same name)
         file_name = f"{cas or name}_{provider}.pdf"
         counter = 1
-        while os.path.exists(os.path.join(destination, file_name)):
-            file_name = f"{cas or name}_{provider}_{counter}.pdf"
-            counter += 1
+        while True:
+            try:
+                open(os.path.join(destination, file_name), "x").close()
+                break
+            except FileExistsError:
+                file_name = f"{cas or name}_{provider}_{counter}.pdf"
+                counter += 1
 
         # Move the file
         new_location = os.path.join(destination, file_name)
-        os.rename(file_path, new_location)
+        os.replace(file_path, new_location)
         return new_location
     except Exception as e:
         print(
@@ -388,141 +259,41 @@ def rename_and_move_file(file_path, destination, cas, name, provider):
     return None
 
 
-# Scrape URLs from webpage
-async def scrape_urls(session, url, base_url, timeout=10):
+# Store a verified pdf (the store stage of the crawl, see crawler.ModePolicy)
+def store_pdf(query, file_path, status, provider, url):
     """
-    Scrape URLs from a webpage.
+    Move a "same" pdf to the verified folder, a "similar" one stays in the
+    unverified folder. Both get an entry in the report of the query.
 
     Params:
-        session (aiohttp.ClientSession): The session to use for making an async http request.
-        url (str): The URL of the webpage to scrape.
-        base_url (str): The base URL for resolving relative links.
-        timeout (int, optional): The timeout for the request in seconds. Defaults to 10.
+        query (crawler.Query): The query the pdf was verified for.
+        file_path (str): The path of the downloaded pdf.
+        status (str): "same" or "similar".
+        provider (str): The provider or source of the file.
+        url (str) : The url from which the pdf is downloaded.
 
     Returns:
-        list: A list of scraped URLs.
+        bool: Whether the pdf was stored.
     """
-    try:
-        async with session.get(url, timeout=timeout) as response:
-            response.raise_for_status()
-            soup = BeautifulSoup(await response.text(),
-                                 "html.parser")  # Parse the html from the url
-            # find hrefs from the html
-            links = [
-                urljoin(base_url, link['href'])
-                for link in soup.find_all("a", href=True)
-            ]
-            return links
-    except Exception as e:
-        print(f"An error occurred while scraping links from {url}: {e}")
-    return []
-
-
-# Find PDFs recursively
-async def find_pdfs(session,
-                    url,
-                    depth=3,
-                    base_url=None,
-                    cas=None,
-                    name=None,
-                    config_params={}):
-    """
-    Recursively find PDFs from a URL, download and verify them.
-
-    Params:
-        session (aiohttp.ClientSession): The session to use for making an async http request.
-        url (str): The URL to start searching from.
-        depth (int, optional): The depth of recursion. Defaults to 3.
-        base_url (str, optional): The base URL for resolving relative links. Defaults to None.
-        cas (str) : The CAS number. Defaults to None.
-        name (str): The Element name for verification. Defaults to None.
-        config_params (dict) : Contains required config params. 
-    """
-
-    # extract config params
-    DOWNLOADED_FILES_COUNT = config_params.get("DOWNLODED_FILES_COUNT", 0)
-    DOWNLOAD_LIMIT = config_params.get("download_limit", 0)
-    URL_VISIT_COUNT = config_params.get("url_visit_count", {})
-    DOMAIN_VISIT_COUNT = config_params.get("domain_visit_count", {})
-    MAX_URL_VISITS = config_params.get("max_url_visits", 0)
-    MAX_DOMAIN_VISITS = config_params.get("max_domain_visits", 0)
-    REPORT_LIST = config_params.get("report_list", [])
-
-    # Depth check and stop when limit exceeded
-    if depth <= 0 or DOWNLOADED_FILES_COUNT >= DOWNLOAD_LIMIT:
-        return
-
-    # check whether to skip the current url
-    if any(skip_url in url.lower() for skip_url in SKIP_URLS):
-        print(f"Skipped: {url}")
-        return
-
-    # Parse the domain from the URL
-    domain = urlparse(url).netloc
-
-    # Check if the domain visit count exceeds the limit
-    if DOMAIN_VISIT_COUNT.get(domain, 0) >= MAX_DOMAIN_VISITS:
-        print(
-            f"Skipped: {url}, domain {domain} visited more than {MAX_DOMAIN_VISITS} times"
-        )
-        return
-
-    # Check if the specific URL visit count exceeds the limit
-    if URL_VISIT_COUNT.get(url, 0) >= MAX_URL_VISITS:
-        print(f"Skipped: {url}, URL visited more than {MAX_URL_VISITS} times")
-        return
-
-    # Update visit counts
-    URL_VISIT_COUNT[url] = URL_VISIT_COUNT.get(url, 0) + 1
-    DOMAIN_VISIT_COUNT[domain] = DOMAIN_VISIT_COUNT.get(domain, 0) + 1
-
-    # Use base_url if provided, otherwise infer from the URL itself
-    if not base_url:
-        base_url = f"{urlparse(url).scheme}://{urlparse(url).netloc}"
-
-    if is_pdf(url):
-        file_path = await download_pdf(session, url)
-        if file_path:
-            verification_status = verify_pdf(
-                file_path, cas, name)  # check the verification status
-            provider_name = base_url.split("/")[2]  # get the provider name
-            DOWNLOADED_FILES_COUNT += 1  # increment the download count
-            if verification_status == "same":  # strict validation
-                print(
-                    f"Verification status: {file_path} is probably the required MSDS"
-                )
-                new_file_path = rename_and_move_file(
-                    file_path, PDFS_FOLDER, cas, name,
-                    provider_name)  # move file to the verified folder
-                if new_file_path:
-                    add_report(REPORT_LIST, cas, name, new_file_path, True,
-                               provider_name, url)
-
-            elif verification_status == "similar":  # flexible validation
-                print(
-                    f"Verification status: {file_path} may be the required MSDS"
-                )
-                add_report(REPORT_LIST, cas, name, file_path, False,
-                           provider_name, url)
-
-            else:
-                print(f"Verification status: {file_path} is not a MSDS")
-                os.remove(file_path)  # Delete the unnecessary files
-                DOWNLOADED_FILES_COUNT -= 1  # decrement the download count
-    else:
-        links = await scrape_urls(session, url, base_url)
-        for link in links:
-            params = {
-                "downloaded_files_count": DOWNLOADED_FILES_COUNT,
-                "download_limit": DOWNLOAD_LIMIT,
-                "url_visit_count": URL_VISIT_COUNT,
-                "domain_visit_count": DOMAIN_VISIT_COUNT,
-                "max_url_visits": MAX_URL_VISITS,
-                "max_domain_visits": MAX_DOMAIN_VISITS,
-                "report_list": REPORT_LIST
-            }
-            await find_pdfs(session, link, depth - 1, base_url, cas, name,
-                            params)  # recursive call to find_pdfs
+    if status == "same":
+        file_path = rename_and_move_file(file_path, PDFS_FOLDER, query.cas,
+                                         query.name, provider)
+        if file_path is None:
+            return False
+    add_report(query.results, query.cas, query.name, file_path,
+               status == "same", provider, url)
+    return True
+
+
+# Crawl policy of the single lookups
+POLICY = crawler.ModePolicy("scout",
+                            store_pdf,
+                            fetch_policy=FETCH_POLICY,
+                            skip_urls=SKIP_URLS,
+                            temp_folder=TEMP_FOLDER,
+                            download_limit=5,
+                            max_domain_visits=10,
+                            similar=True)
 
 
 # Search Google for MSDS
@@ -543,43 +314,13 @@ async def scout(cas, name, max_search_results=10):
         print("No input provided. Exiting.")
         return
 
-    # Report list :
-    report_list = []
-
-    # create query and do a google search
-    query = f"download msds of {cas or name}"
-    print(f"Searching Google for: {query}")
-    search_results = search(query,
-                            num=max_search_results,
-                            stop=max_search_results)
-    # Create async session
+    # a single lookup is a crawl of one query (see crawler/engine.py)
+    query = crawler.Query(cas=cas, name=name)
     async with aiohttp.ClientSession() as session:
-        for result in search_results:
-            print(f"Google search result: {result}")
-            try:
-                # create params
-                config_params = {
-                    "report_list": report_list,
-                    "url_visit_count": {},
-                    "domain_visit_count": {},
-                    "max_url_visits": 5,
-                    "max_domain_visits": 10,
-                    "download_limit": 5,
-                    "downloaded_files_count": 0,
-                }
-
-                await find_pdfs(session,
-                                result,
-                                depth=2,
-                                base_url=None,
-                                cas=cas,
-                                name=name,
-                                config_params=config_params)
-            except Exception as e:
-                print(f"An error occurred while searching {result}: {e}")
+        await crawler.run(session, [query], POLICY, max_search_results)
 
     # save report
-    report_in_json = save_report(report_list)
+    report_in_json = save_report(query.results)
     return report_in_json
 
 
@@ -0,0 +1,74 @@
+import crawler
+import excel_checkpoints
+import scout
+import scout_excel
+
+# Max number of queries of a batch
+MAX_BATCH_SIZE = 100
+
+# Crawl policies of the batch modes
+POLICIES = {"excel": scout_excel.POLICY, "scout": scout.POLICY}
+
+
+# Scout a batch of queries
+async def scout_batch(session, queries, mode="excel", max_search_results=10):
+	"""
+	Scout a batch of queries with a single crawl.
+
+	Params:
+			session (aiohttp.ClientSession): The session to use for making an async http request.
+			queries (list): The queries, dicts with id, cas and name.
+			mode (str, optional): "excel" or "scout". Defaults to excel.
+			max_search_results (int, optional): The maximum number of search results per query. Defaults to 10.
+
+	Returns:
+			list: The crawler.Query of the batch, in the order of the queries.
+	"""
+	batch = [crawler.Query(q.get("id"), q.get("cas"), q.get("name")) for q in queries]
+	return await crawler.run(session, batch, POLICIES[mode], max_search_results)
+
+
+# Process a batch of rows of an excel file
+async def process_excel_batch(session, batch_id, rows):
+	'''
+	Scout a batch of rows of an excel file with a single crawl and save the status
+	of each row in the report of the excel file.
+
+	Params : 
+		session (aiohttp.ClientSession) : The session to use for making an async http request.
+		batch_id (str) : The id of the excel file (the run id of the report).
+		rows (list) : The {"id", "cas", "name"} rows of the batch.
+
+	Returns : 
+		msds_counts (dict) : The number of MSDS downloaded for each row, {id: count}.
+	'''
+	# resume the rows of a restarted job from their checkpoints (see excel_checkpoints.py)
+	saved = excel_checkpoints.load(batch_id, [row["row"] for row in rows if row.get("row") is not None])
+	queries = []
+	for row in rows:
+		checkpoint = saved.get(row.get("row"))
+		if checkpoint and checkpoint["status"] == excel_checkpoints.DONE:
+			print(f"Skipping row {row.get('id')}, done before")
+			continue
+		query = crawler.Query(row.get("id"), row.get("cas"), row.get("name"), row=row.get("row"))
+		if checkpoint:
+			query.downloads = checkpoint["downloads"]
+			query.results = checkpoint["files"]
+		queries.append(query)
+
+	def save_partial(query):
+		if query.row is not None:
+			excel_checkpoints.save(batch_id, query.row, excel_checkpoints.PARTIAL, query.downloads,
+			                       query.results)
+
+	await crawler.run(session, queries, scout_excel.POLICY, checkpoint=save_partial)
+	with scout_excel.initialise_report_file(batch_id) as report_writer:
+		for query in queries:
+			scout_excel.save_report(report_writer, id=query.id, cas=query.cas or "",
+			                        name=query.name or "", no_of_downloads=query.downloads)
+	# the rows are done once they are in the report
+	for query in queries:
+		if query.row is not None:
+			excel_checkpoints.save(batch_id, query.row, excel_checkpoints.DONE, query.downloads,
+			                       query.results)
+	return {query.id: query.downloads for query in queries}
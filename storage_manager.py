@@ -0,0 +1,219 @@
+import asyncio
+import os
+import threading
+import time
+
+import db
+import pdf_server
+import report_store
+import result_cache
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS file_access (
+	filepath TEXT PRIMARY KEY,
+	last_access REAL NOT NULL,
+	hits INTEGER NOT NULL DEFAULT 0
+);
+"""
+
+# Byte quota of each managed folder (configurable through the environment)
+FOLDER_QUOTAS = {
+    "verified": int(os.environ.get("SCOUT_VERIFIED_QUOTA_BYTES", 2 * 1024**3)),
+    "unverified": int(os.environ.get("SCOUT_UNVERIFIED_QUOTA_BYTES", 1024**3)),
+}
+# Unverified ("similar") files are removed once they are not accessed for this long
+UNVERIFIED_TTL = int(os.environ.get("SCOUT_UNVERIFIED_TTL_SECONDS", 7 * 24 * 3600))
+# Interval between two runs of the storage manager
+RUN_INTERVAL = int(os.environ.get("SCOUT_STORAGE_INTERVAL_SECONDS", 600))
+# Eviction brings the folder down to this fraction of its quota
+LOW_WATERMARK = 0.9
+# Files younger than this are never removed (they may still be in use by a crawl)
+MIN_AGE = 600
+
+# Functions called with the list of removed filepaths, used to keep the
+# report and cache records consistent with the disk.
+EVICTION_HOOKS = [report_store.forget_files, pdf_server.forget_files, result_cache.forget_files]
+
+# Accesses recorded since the last flush, {filepath: timestamp}
+_pending_access = {}
+_pending_lock = threading.Lock()
+
+# Stats of the last run
+LAST_RUN = {}
+
+
+# Record an access
+def record_access(filepath):
+	"""
+	Record an access to a managed file. Accesses are kept in memory and written
+	to the database on the next run (or flush).
+
+	Params:
+			filepath (str): The filepath as returned in the reports (eg. verified/methanol_x.pdf).
+	"""
+	with _pending_lock:
+		_pending_access[filepath] = time.time()
+
+
+# Flush the recorded accesses
+def flush_access():
+	with _pending_lock:
+		pending = list(_pending_access.items())
+		_pending_access.clear()
+	if not pending:
+		return
+	db.ensure_schema("storage", SCHEMA)
+	conn = db.connect()
+	with conn:
+		conn.executemany(
+		    "INSERT INTO file_access (filepath, last_access, hits) VALUES (?, ?, 1) "
+		    "ON CONFLICT(filepath) DO UPDATE SET last_access = excluded.last_access, hits = hits + 1",
+		    pending)
+
+
+# Scan a folder
+def _scan(folder):
+	"""
+	Returns:
+			list: A list of (filepath, size, mtime) for each file of the folder.
+	"""
+	files = []
+	if not os.path.isdir(folder):
+		return files
+	with os.scandir(folder) as entries:
+		for entry in entries:
+			if entry.is_file():
+				stat = entry.stat()
+				files.append((f"{folder}/{entry.name}", stat.st_size, stat.st_mtime))
+	return files
+
+
+def _last_access(filepaths):
+	db.ensure_schema("storage", SCHEMA)
+	conn = db.connect()
+	last_access = {}
+	filepaths = list(filepaths)
+	for i in range(0, len(filepaths), 500):
+		chunk = filepaths[i:i + 500]
+		rows = conn.execute(
+		    f"SELECT filepath, last_access FROM file_access WHERE filepath IN ({', '.join('?' for _ in chunk)})",
+		    chunk).fetchall()
+		last_access.update((row["filepath"], row["last_access"]) for row in rows)
+	return last_access
+
+
+# Remove files and notify the hooks
+def _remove(filepaths):
+	removed = []
+	for filepath in filepaths:
+		try:
+			os.remove(filepath)
+			removed.append(filepath)
+		except FileNotFoundError:
+			removed.append(filepath)
+		except Exception as e:
+			print(f"An error occurred while removing {filepath}: {e}")
+
+	if removed:
+		for hook in EVICTION_HOOKS:
+			try:
+				hook(removed)
+			except Exception as e:
+				print(f"An error occurred in eviction hook {hook.__name__}: {e}")
+		conn = db.connect()
+		with conn:
+			conn.executemany("DELETE FROM file_access WHERE filepath = ?",
+			                 [(filepath, ) for filepath in removed])
+	return removed
+
+
+# Run the storage manager once
+def run_once(now=None):
+	"""
+	Expire the unverified files past their TTL, then evict the least recently
+	used files of every folder above its quota.
+
+	Returns:
+			dict: The stats of the run.
+	"""
+	now = now or time.time()
+	flush_access()
+	stats = {"started_at": now, "expired": 0, "evicted": 0, "freed_bytes": 0}
+
+	for folder, quota in FOLDER_QUOTAS.items():
+		files = _scan(folder)
+		last_access = _last_access(path for path, _, _ in files)
+		# least recently used first, files never accessed count from their creation
+		files = sorted(files, key=lambda f: max(last_access.get(f[0], 0), f[2]))
+
+		expired = []
+		if folder == "unverified":
+			expired = [
+			    f for f in files
+			    if now - max(last_access.get(f[0], 0), f[2]) > UNVERIFIED_TTL
+			]
+			removed = set(_remove([path for path, _, _ in expired]))
+			stats["expired"] += len(removed)
+			stats["freed_bytes"] += sum(size for path, size, _ in expired if path in removed)
+			files = [f for f in files if f[0] not in removed]
+
+		total = sum(size for _, size, _ in files)
+		if total <= quota:
+			continue
+
+		to_evict = []
+		target = quota * LOW_WATERMARK
+		for path, size, mtime in files:
+			if total <= target:
+				break
+			if now - mtime < MIN_AGE:
+				continue
+			to_evict.append((path, size))
+			total -= size
+		removed = set(_remove([path for path, _ in to_evict]))
+		stats["evicted"] += len(removed)
+		stats["freed_bytes"] += sum(size for path, size in to_evict if path in removed)
+
+	stats["duration"] = round(time.time() - now, 3)
+	LAST_RUN.clear()
+	LAST_RUN.update(stats)
+	if stats["expired"] or stats["evicted"]:
+		print(f"Storage manager: expired {stats['expired']}, evicted {stats['evicted']} files, "
+		      f"freed {stats['freed_bytes']} bytes")
+	return stats
+
+
+# Usage stats
+def usage_stats():
+	"""
+	Returns:
+			dict: The usage of every managed folder and the stats of the last run.
+	"""
+	folders = {}
+	for folder, quota in FOLDER_QUOTAS.items():
+		files = _scan(folder)
+		used = sum(size for _, size, _ in files)
+		folders[folder] = {
+		    "files": len(files),
+		    "bytes": used,
+		    "quota_bytes": quota,
+		    "usage": round(used / quota, 4) if quota else None,
+		}
+	return {
+	    "folders": folders,
+	    "unverified_ttl_seconds": UNVERIFIED_TTL,
+	    "last_run": dict(LAST_RUN),
+	}
+
+
+# Background task
+async def run_periodically(interval=RUN_INTERVAL):
+	"""
+	Run the storage manager every `interval` seconds, until cancelled.
+	"""
+	while True:
+		try:
+			await asyncio.to_thread(run_once)
+		except Exception as e:
+			print(f"An error occurred while running the storage manager: {e}")
+		await asyncio.sleep(interval)
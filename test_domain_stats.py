@@ -0,0 +1,79 @@
+import asyncio
+
+import pytest
+
+import crawler
+import db
+import domain_stats
+from crawler import HOOKS
+from crawler.engine import Crawl, Query
+
+
+@pytest.fixture(autouse=True)
+def database(tmp_path, monkeypatch):
+	# a fresh ./logs/scout.db for each test
+	monkeypatch.chdir(tmp_path)
+	monkeypatch.setattr(db, "_local", type(db._local)())
+	monkeypatch.setattr(db, "_applied_schemas", set())
+	domain_stats._pending.clear()
+	domain_stats._cache.clear()
+	yield
+	domain_stats._pending.clear()
+	domain_stats._cache.clear()
+
+
+def crawl_without_hits(url, crawls):
+	for _ in range(crawls):
+		domain_stats.record_crawl(url)
+	domain_stats.flush()
+
+
+def test_crawl_visits():
+	crawl_without_hits("https://new.example/", domain_stats.LIMIT_AFTER - 1)
+	assert domain_stats.crawl_visits("https://new.example/", 10) == 10
+
+	crawl_without_hits("https://www.low.example/", domain_stats.LIMIT_AFTER)
+	assert domain_stats.crawl_visits("https://low.example/a", 10) == 3
+	assert domain_stats.crawl_visits("https://low.example/a", 5) == domain_stats.MIN_VISITS
+
+	crawl_without_hits("https://good.example/", domain_stats.SKIP_AFTER)
+	domain_stats.record_pdf("https://good.example/", "same")
+	domain_stats.flush()
+	assert domain_stats.crawl_visits("https://good.example/", 10) == 10
+
+	crawl_without_hits("https://dead.example/", domain_stats.SKIP_AFTER)
+	assert domain_stats.crawl_visits("https://dead.example/", 10) == 0
+
+
+def test_low_yield_domain_gets_less_work(monkeypatch):
+	# every page of a domain links 20 other pages of the domain
+	fetched = []
+
+	async def search(call, term, max_search_results):
+		return ["https://low.example/", "https://new.example/"]
+
+	async def discover(call, *args):
+		return []
+
+	async def probe(call, session, url, *args):
+		return "page"
+
+	async def fetch(call, session, url, policy):
+		fetched.append(url)
+		return [f"{url.rstrip('/')}/{i}" for i in range(20)]
+
+	hooks = [("search", search), ("discover", discover), ("probe", probe), ("fetch", fetch)]
+	for stage, hook in hooks:
+		HOOKS.register(stage, hook)
+	try:
+		crawl_without_hits("https://low.example/", domain_stats.LIMIT_AFTER)
+		policy = crawler.ModePolicy("test", lambda *args: True, max_domain_visits=10, depth=3)
+		asyncio.run(Crawl(None, [Query(cas="67-56-1")], policy).run())
+	finally:
+		for stage, hook in hooks:
+			HOOKS.unregister(stage, hook)
+
+	low = [url for url in fetched if "low.example" in url]
+	new = [url for url in fetched if "new.example" in url]
+	assert len(new) == 10
+	assert len(low) == 3
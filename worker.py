@@ -0,0 +1,182 @@
+import argparse
+import asyncio
+import multiprocessing
+import os
+import socket
+import time
+import uuid
+
+import aiohttp
+
+import fetch
+import job_queue
+import popularity
+import profiler
+import result_cache
+import scout
+import scout_batch
+import scout_excel
+
+# Seconds between two claims when the queue is empty
+POLL_INTERVAL = 1
+
+
+# Load the heavy dependencies of the crawl
+def prewarm():
+	"""
+	Import the libraries the crawl modules load on first use (PyMuPDF, BeautifulSoup,
+	googlesearch, pandas), so that the first job does not pay for them.
+	"""
+	import fitz
+	import bs4
+	import googlesearch
+	import pandas
+
+
+# Run a job
+async def run_job(session, job):
+	"""
+	Run a claimed job.
+
+	Params:
+			session (aiohttp.ClientSession): The session of the worker.
+			job (dict): The job.
+
+	Returns:
+			The JSON serializable result of the job.
+	"""
+	payload = job["payload"]
+	if job["kind"] == "scout":
+		return await scout.scout(cas=payload["cas"], name=payload["name"])
+	if job["kind"] == "refresh":
+		return await refresh(payload["key"], payload["cas"], payload["name"])
+	if job["kind"] == "excel_batch":
+		return await scout_batch.process_excel_batch(session, job["batch_id"], payload["rows"])
+	if job["kind"] == "scout_batch":
+		queries = await scout_batch.scout_batch(session, payload["queries"], mode="scout")
+		results = []
+		for query in queries:
+			scout.save_report(query.results)
+			results.append(query.to_dict())
+		return results
+	raise ValueError(f"Unknown job kind {job['kind']}")
+
+
+# Refresh the cached result of a popular query
+async def refresh(key, cas, name):
+	"""
+	Run the lookup of a query again and cache its result, recording the cost of the refresh.
+
+	Returns:
+			dict: The cost of the refresh.
+	"""
+	counter, token = fetch.track_bytes()
+	started = time.monotonic()
+	try:
+		result = await scout.scout(cas=cas, name=name)
+	finally:
+		fetch.untrack_bytes(token)
+	seconds = time.monotonic() - started
+	result_cache.put(key, result)
+	pdfs = len(result) if isinstance(result, list) else 0
+	popularity.record_refresh(key, counter[0], seconds, pdfs)
+	return {"key": key, "bytes": counter[0], "seconds": round(seconds, 1), "pdfs": pdfs}
+
+
+# Renew the lease of a running job
+async def _renew_lease(queue, job, worker_id, lease):
+	while True:
+		await asyncio.sleep(lease / 3)
+		try:
+			await asyncio.to_thread(queue.extend, job["id"], worker_id, lease)
+		except Exception as e:
+			print(f"An error occurred while renewing the lease of job {job['id']}: {e}")
+
+
+# Worker loop
+async def work(queue=None, worker_id=None, kinds=None, lease=job_queue.DEFAULT_LEASE):
+	"""
+	Claim and run jobs from the queue until cancelled.
+
+	Params:
+			queue (JobQueue, optional): The queue to pull from. Defaults to the configured queue.
+			worker_id (str, optional): The id of the worker. Generated if not provided.
+			kinds (list, optional): Only run these kinds of job.
+			lease (int, optional): The lease of the claimed jobs in seconds.
+	"""
+	queue = queue or job_queue.get_queue()
+	worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:6]}"
+
+	async with aiohttp.ClientSession() as session:
+		while True:
+			try:
+				job = await asyncio.to_thread(queue.claim, worker_id, kinds, lease)
+			except Exception as e:
+				print(f"An error occurred while claiming a job: {e}")
+				job = None
+			if job is None:
+				await asyncio.sleep(POLL_INTERVAL)
+				continue
+
+			heartbeat = asyncio.create_task(_renew_lease(queue, job, worker_id, lease))
+			try:
+				result = await run_job(session, job)
+				await asyncio.to_thread(queue.complete, job["id"], worker_id, result)
+			except asyncio.CancelledError:
+				# give the job back to the queue
+				await asyncio.shield(
+				    asyncio.to_thread(queue.fail, job["id"], worker_id, "Worker stopped"))
+				raise
+			except Exception as e:
+				print(f"An error occurred while running job {job['id']}: {e}")
+				await asyncio.to_thread(queue.fail, job["id"], worker_id, e)
+			finally:
+				heartbeat.cancel()
+
+
+# Start workers in the running event loop
+def start_workers(count, **kwargs):
+	"""
+	Params:
+			count (int): The number of workers.
+
+	Returns:
+			list: The tasks of the workers, cancel them to stop the workers.
+	"""
+	return [asyncio.create_task(work(**kwargs)) for _ in range(count)]
+
+
+async def _run_process(workers, kinds):
+	profiler.watch_loop()
+	await asyncio.gather(*start_workers(workers, kinds=kinds))
+
+
+def _process_main(workers, kinds):
+	scout.setup_folders()
+	scout_excel.setup_folders()
+	prewarm()
+	asyncio.run(_run_process(workers, kinds))
+
+
+# Run the crawler workers from the command line
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Run scout crawler workers.")
+	parser.add_argument("--processes", type=int, default=1,
+	                    help="The number of worker processes.")
+	parser.add_argument("--workers", type=int, default=4,
+	                    help="The number of concurrent workers per process.")
+	parser.add_argument("--kinds", nargs="*", default=None,
+	                    help="Only run these kinds of job (scout, scout_batch, refresh, excel_batch).")
+	args = parser.parse_args()
+
+	if args.processes == 1:
+		_process_main(args.workers, args.kinds)
+	else:
+		processes = [
+		    multiprocessing.Process(target=_process_main, args=(args.workers, args.kinds))
+		    for _ in range(args.processes)
+		]
+		for process in processes:
+			process.start()
+		for process in processes:
+			process.join()
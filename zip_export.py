@@ -0,0 +1,327 @@
+import bisect
+import csv
+import hashlib
+import io
+import os
+import struct
+import time
+import zlib
+from email.utils import formatdate
+
+import anyio
+from starlette.responses import Response
+
+import excel_checkpoints
+import normalize
+import pdf_server
+import report_store
+
+# Folders the exported pdfs may come from
+EXPORTED_FOLDERS = ("verified", "unverified", "pdfs")
+# Max number of queries of a lookup export
+MAX_QUERIES = int(os.environ.get("SCOUT_EXPORT_MAX_QUERIES", 1000))
+
+MANIFEST_NAME = "manifest.csv"
+MANIFEST_COLUMNS = ["file", "row_id", "cas", "name", "provider", "verified", "url", "sha256", "size"]
+
+# Zip format (APPNOTE.TXT), the archives only hold stored (uncompressed) entries
+LOCAL_HEADER = struct.Struct("<IHHHHHIIIHH")
+CENTRAL_HEADER = struct.Struct("<IHHHHHHIIIHHHHHII")
+ZIP64_END = struct.Struct("<IQHHIIQQQQ")
+ZIP64_LOCATOR = struct.Struct("<IIQI")
+END = struct.Struct("<IHHHHIIH")
+ZIP64_EXTRA = 0x0001
+# Sizes, offsets and counts from these limits are stored in the zip64 records
+ZIP64_LIMIT = 0xFFFFFFFF
+ZIP64_COUNT_LIMIT = 0xFFFF
+VERSION = 20
+VERSION_ZIP64 = 45
+MADE_BY_UNIX = 3 << 8
+FILE_MODE = 0o100644 << 16
+UTF8_NAMES = 0x0800
+
+
+# Path of an exported file
+def _exported_path(filepath):
+	"""
+	Returns:
+			str: The normalized filepath (eg. pdfs/1_methanol_x.pdf), also the name of
+			its zip entry, or None if the file is outside the exported folders.
+	"""
+	if not filepath:
+		return None
+	path = os.path.normpath(filepath).replace(os.sep, "/")
+	if os.path.isabs(path) or path.split("/", 1)[0] not in EXPORTED_FOLDERS:
+		return None
+	return path
+
+
+# Files of an excel job
+def job_entries(batch_id):
+	"""
+	Params:
+			batch_id (str): The id of the excel job.
+
+	Returns:
+			list: The {"filepath", "row_id", "cas", "name", "provider", "verified", "url"} entries, in sheet order.
+	"""
+	entries = []
+	for row in excel_checkpoints.files(batch_id):
+		for result in row["files"]:
+			entries.append({
+			    "filepath": result.get("filepath"),
+			    "row_id": row["id"],
+			    "cas": row["cas"],
+			    "name": row["name"],
+			    "provider": result.get("provider"),
+			    "verified": result.get("verified"),
+			    "url": result.get("url"),
+			})
+	return entries
+
+
+# Files found by the lookups of some queries
+def lookup_entries(queries):
+	"""
+	Params:
+			queries (list): The CAS numbers or names, as given to /scout/{cas_or_name}.
+
+	Returns:
+			list: The entries of the stored lookup reports, in query order then oldest first.
+
+	Raises:
+			normalize.InvalidQuery: If a query is empty or an invalid CAS number.
+	"""
+	entries = []
+	for query in queries:
+		if normalize.is_cas(query):
+			cas, name = normalize.normalize_query(cas=query)
+		else:
+			cas, name = normalize.normalize_query(name=query)
+			cas = normalize.cas_of(name)
+		filters = [{"cas": cas}] if cas else []
+		if name:
+			filters.append({"name": name})
+		for where in filters:
+			for report in report_store.iter_reports(source="scout", **where):
+				if report["filepath"]:
+					entries.append({
+					    "filepath": report["filepath"],
+					    "row_id": None,
+					    "cas": report["cas"],
+					    "name": report["name"],
+					    "provider": report["provider"],
+					    "verified": report["verified"],
+					    "url": report["url"],
+					})
+	return entries
+
+
+# Dos date and time of a zip entry
+def _dos_time(mtime):
+	# UTC, so that the bytes of an archive do not depend on the timezone of the server
+	t = time.gmtime(max(mtime, 315532800))  # 1980-01-01, the dos epoch
+	return (t.tm_hour << 11) | (t.tm_min << 5) | (t.tm_sec // 2), \
+	       ((t.tm_year - 1980) << 9) | (t.tm_mon << 5) | t.tm_mday
+
+
+def _local_header(name, crc32, size, dos_time):
+	zip64 = size >= ZIP64_LIMIT
+	extra = struct.pack("<HHQQ", ZIP64_EXTRA, 16, size, size) if zip64 else b""
+	stored_size = ZIP64_LIMIT if zip64 else size
+	return LOCAL_HEADER.pack(0x04034b50, VERSION_ZIP64 if zip64 else VERSION, UTF8_NAMES, 0, *dos_time,
+	                         crc32, stored_size, stored_size, len(name), len(extra)) + name + extra
+
+
+def _central_header(name, crc32, size, dos_time, offset):
+	fields = [size, size] if size >= ZIP64_LIMIT else []
+	if offset >= ZIP64_LIMIT:
+		fields.append(offset)
+	extra = struct.pack(f"<HH{len(fields)}Q", ZIP64_EXTRA, 8 * len(fields), *fields) if fields else b""
+	version = VERSION_ZIP64 if fields else VERSION
+	return CENTRAL_HEADER.pack(0x02014b50, MADE_BY_UNIX | version, version, UTF8_NAMES, 0, *dos_time, crc32,
+	                           min(size, ZIP64_LIMIT), min(size, ZIP64_LIMIT), len(name), len(extra), 0, 0, 0,
+	                           FILE_MODE, min(offset, ZIP64_LIMIT)) + name + extra
+
+
+def _end_records(count, directory_offset, directory_size):
+	records = b""
+	if count >= ZIP64_COUNT_LIMIT or directory_offset >= ZIP64_LIMIT or directory_size >= ZIP64_LIMIT:
+		records += ZIP64_END.pack(0x06064b50, ZIP64_END.size - 12, MADE_BY_UNIX | VERSION_ZIP64, VERSION_ZIP64, 0, 0,
+		                          count, count, directory_size, directory_offset)
+		records += ZIP64_LOCATOR.pack(0x07064b50, 0, directory_offset + directory_size, 1)
+	return records + END.pack(0x06054b50, 0, 0, min(count, ZIP64_COUNT_LIMIT), min(count, ZIP64_COUNT_LIMIT),
+	                          min(directory_size, ZIP64_LIMIT), min(directory_offset, ZIP64_LIMIT), 0)
+
+
+class ZipArchive:
+	"""
+	Layout of a zip of stored (uncompressed, the pdfs are already compressed)
+	entries: the manifest first, then the files. The checksums of the files are
+	the cached ones (see pdf_server.file_info), so the headers, the size and the
+	ETag of the archive are known before a byte of a file is read, and the same
+	files always give the same bytes (a download can be resumed with a Range).
+	Only the headers are kept in memory, the files are read when sent.
+
+	Params:
+			entries (list): The {"filepath", "row_id", "cas", "name", "provider", "verified", "url"}
+			entries, see job_entries and lookup_entries. A file listed twice is exported once.
+	"""
+
+	def __init__(self, entries):
+		files, rows, seen = [], [], set()
+		for entry in entries:
+			path = _exported_path(entry.get("filepath"))
+			if path is None or path in seen:
+				continue
+			seen.add(path)
+			info = pdf_server.file_info(path)
+			if info is not None:
+				files.append((path, info))
+			# the evicted files stay in the manifest, without a file
+			rows.append([path if info else "", entry.get("row_id"), entry.get("cas"), entry.get("name"),
+			             entry.get("provider"), entry.get("verified"), entry.get("url"),
+			             info["sha256"] if info else "", info["size"] if info else ""])
+		self.filepaths = [path for path, _ in files]
+		self.mtime = max((info["mtime"] for _, info in files), default=0)
+
+		buffer = io.StringIO()
+		writer = csv.writer(buffer)
+		writer.writerow(MANIFEST_COLUMNS)
+		writer.writerows(rows)
+		manifest = buffer.getvalue().encode("utf-8")
+
+		# (offset, bytes) parts and (offset, (path, size, mtime)) parts
+		self.offsets, self.parts = [], []
+		directory = []
+		offset = 0
+		contents = [(MANIFEST_NAME, zlib.crc32(manifest), len(manifest), self.mtime, manifest)]
+		contents += [(path, info["crc32"], info["size"], info["mtime"], (path, info["size"], info["mtime"]))
+		             for path, info in files]
+		for name, crc32, size, mtime, content in contents:
+			name = name.encode("utf-8")
+			dos_time = _dos_time(mtime)
+			directory.append(_central_header(name, crc32, size, dos_time, offset))
+			offset = self._add(offset, _local_header(name, crc32, size, dos_time))
+			offset = self._add(offset, content, size)
+		directory = b"".join(directory)
+		self.count = len(files) + 1
+		directory_offset = offset
+		offset = self._add(offset, directory)
+		self.size = self._add(offset, _end_records(self.count, directory_offset, len(directory)))
+		# the central directory holds the names, checksums, sizes, times and offsets
+		self.etag = f'"{hashlib.sha256(directory).hexdigest()}"'
+
+	def _add(self, offset, content, size=None):
+		self.offsets.append(offset)
+		self.parts.append(content)
+		return offset + (len(content) if size is None else size)
+
+	def _part_size(self, index):
+		part = self.parts[index]
+		return part[1] if isinstance(part, tuple) else len(part)
+
+	async def chunks(self, start, end):
+		"""
+		Iterate over the bytes start to end (inclusive) of the archive.
+
+		Raises:
+				RuntimeError: If a file changed since the layout was computed (the
+				download is cut, the next request gets the new archive).
+		"""
+		index = bisect.bisect_right(self.offsets, start) - 1
+		position = start
+		while position <= end:
+			part = self.parts[index]
+			begin = position - self.offsets[index]
+			count = min(self._part_size(index) - begin, end - position + 1)
+			if isinstance(part, tuple):
+				async for chunk in self._read(part, begin, count):
+					yield chunk
+			elif count:
+				yield part[begin:begin + count]
+			position += count
+			index += 1
+
+	@staticmethod
+	async def _read(part, begin, count):
+		path, size, mtime = part
+		try:
+			stat = os.stat(path)
+		except FileNotFoundError:
+			stat = None
+		if stat is None or stat.st_size != size or stat.st_mtime != mtime:
+			raise RuntimeError(f"{path} changed during the export")
+		async with await anyio.open_file(path, mode="rb") as f:
+			await f.seek(begin)
+			while count > 0:
+				chunk = await f.read(min(pdf_server.CHUNK_SIZE, count))
+				if not chunk:
+					raise RuntimeError(f"{path} was truncated during the export")
+				count -= len(chunk)
+				yield chunk
+
+
+class ZipResponse(Response):
+	"""
+	Stream a ZipArchive, with its ETag, conditional requests (304) and single
+	byte ranges (206, resumed downloads).
+
+	Params:
+			archive (ZipArchive): The archive to send.
+			filename (str): The name of the downloaded file.
+			request_headers (Headers): The headers of the request.
+			method (str): The method of the request (no body is sent for HEAD).
+	"""
+
+	media_type = "application/zip"
+
+	def __init__(self, archive, filename, request_headers, method="GET"):
+		super().__init__(status_code=200, media_type=self.media_type)
+		self.archive = archive
+		self.send_body = method != "HEAD"
+		self.range = None
+
+		size = archive.size
+		self.headers["etag"] = archive.etag
+		self.headers["cache-control"] = pdf_server.NAMED_CACHE_CONTROL
+		self.headers["accept-ranges"] = "bytes"
+		self.headers["last-modified"] = formatdate(archive.mtime, usegmt=True)
+		self.headers["content-disposition"] = f'attachment; filename="{filename}"'
+
+		if pdf_server.PdfResponse._not_modified(request_headers, archive.etag, archive.mtime):
+			self.status_code = 304
+			self.send_body = False
+			del self.headers["content-length"]
+			return
+
+		byte_range = None
+		if_range = request_headers.get("if-range")
+		if not if_range or if_range == archive.etag:
+			byte_range = pdf_server.parse_range(request_headers.get("range"), size)
+
+		if byte_range is False:
+			self.status_code = 416
+			self.send_body = False
+			self.headers["content-range"] = f"bytes */{size}"
+			self.headers["content-length"] = "0"
+		elif byte_range:
+			start, end = byte_range
+			self.status_code = 206
+			self.range = byte_range
+			self.headers["content-range"] = f"bytes {start}-{end}/{size}"
+			self.headers["content-length"] = str(end - start + 1)
+		else:
+			self.headers["content-length"] = str(size)
+
+	async def __call__(self, scope, receive, send):
+		await send({
+		    "type": "http.response.start",
+		    "status": self.status_code,
+		    "headers": self.raw_headers,
+		})
+		if self.send_body:
+			start, end = self.range or (0, self.archive.size - 1)
+			async for chunk in self.archive.chunks(start, end):
+				await send({"type": "http.response.body", "body": chunk, "more_body": True})
+		await send({"type": "http.response.body", "body": b""})